@@ -1,13 +1,85 @@
-import requests
+import asyncio
 import json
 import os
 import base64
+import time
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import structlog
 
+from circuit_breaker import RetryBudget
+from gemini_client import AsyncGeminiClient, ConcurrencyLimit, GeminiAPIError, GeminiUnavailableError
+from hedging import HedgePolicy, create_hedge_budget
+from extraction_cache import ExtractionCache, compute_cache_key, compute_config_hash
+from perceptual_hash import ACTION_FLAG, NearDuplicateIndex
+from image_preprocessing import ImagePreprocessor
+from image_worker import ImageWorkerPool
+from extraction_schema import (
+    RESPONSE_SCHEMA, build_partial_schema, parse_partial_response, parse_structured_response
+)
+from single_flight import SingleFlight
+from extraction_validator import (
+    CHECK_STORE, ISSUE_CHECK_ERROR, failed_fields, load_checks, load_reextract_fields, priced_products,
+    products_sum_matches, score_fields, validate_extraction
+)
+from metrics import (
+    CASCADE_ESCALATIONS, CASCADE_TIER_LATENCY, CASCADE_TIER_REQUESTS, EXTRACTIONS_COALESCED, REEXTRACTED_FIELDS,
+    REEXTRACTIONS, STAGE_GEMINI, STAGE_PARSE, STAGE_STORE_VERIFICATION, TICKET_LATENCY,
+    counter_totals, histogram_summary, stage_timer
+)
+from replay_corpus import ReplayCorpus
+from store_matcher import get_market_store_matcher, normalize_store_name
+
 logger = structlog.get_logger()
 
+
+def matches_market_store(store_name: Optional[str], market_store_names: List[str]) -> bool:
+    """
+    Comprobar si el nombre de la tienda contiene alguna de las tiendas del mercado
+    
+    Para listas que llegan con la petición; las tiendas del ticket service se
+    verifican con el autómata en caché (store_matcher).
+    """
+    if not store_name:
+        return False
+    normalized = normalize_store_name(store_name)
+    return any(
+        normalize_store_name(market_store) in normalized
+        for market_store in market_store_names if normalize_store_name(market_store)
+    )
+
+
+def determine_ticket_status(procesado_correctamente: bool, es_tienda_mercado: bool) -> Tuple[str, str]:
+    """
+    Estado del ticket a partir del resultado de la extracción
+
+    Returns:
+        Tupla (ticket_status, status_message)
+    """
+    if not procesado_correctamente:
+        return "failed", "Error en el procesamiento"
+    if es_tienda_mercado:
+        return "done_approved", "Ticket aprobado - Tienda del mercado"
+    return "done_rejected", "Ticket rechazado - No es tienda del mercado"
+
+
+# Instrucciones de cada campo para la re-extracción con prompt corto
+FIELD_PROMPTS = {
+    'fecha': 'fecha del ticket en formato DD/MM/YYYY',
+    'hora': 'hora del ticket en formato HH:MM',
+    'tienda': 'nombre de la tienda o establecimiento tal y como aparece en la cabecera',
+    'total': 'importe total pagado (solo el número, sin símbolo de moneda)',
+    'productos': 'lista de productos con cantidad, nombre y precio (sin totales ni impuestos)'
+}
+
+
+# Campos del resultado que se guardan en el corpus de replay
+REPLAY_RESULT_FIELDS = (
+    'fecha', 'hora', 'tienda', 'total', 'tipo_ticket', 'productos',
+    'es_tienda_mercado', 'ticket_status', 'modelo', 'validacion', 'campos_reextraidos'
+)
+
+
 class GeminiTicketAI:
     def __init__(self, market_store_service=None):
         """
@@ -20,13 +92,98 @@ class GeminiTicketAI:
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY no encontrada en variables de entorno")
         
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+        # GEMINI_API_BASE permite apuntar a un servidor stub local (stub_gemini_server.py)
+        self.api_base = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com').rstrip('/')
+        
+        # Cascada de modelos: se prueba primero el más barato y se escala al
+        # siguiente solo si la extracción no pasa la validación. Sin cascada
+        # se usa solo GEMINI_MODEL.
+        cascade = os.getenv('GEMINI_MODEL_CASCADE', '')
+        self.model_cascade = [model.strip() for model in cascade.split(',') if model.strip()] \
+            or [os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')]
+        self.cascade_checks = load_checks()
+        
+        # Re-extracción de campos concretos: si la extracción no es coherente y
+        # fallan pocos campos, se vuelven a pedir solo esos con un prompt corto
+        # en lugar de reprocesar el ticket entero
+        self.reextract_fields = load_reextract_fields() \
+            if os.getenv('GEMINI_REEXTRACT_ENABLED', 'true').lower() == 'true' else []
+        self.reextract_max_fields = int(os.getenv('GEMINI_REEXTRACT_MAX_FIELDS', '2'))
+        self.model = self.model_cascade[-1]
+        self.base_url = self.model_url(self.model)
+        
+        # Modo JSON de Gemini con responseSchema: la respuesta se valida en un solo paso
+        self.structured_output = os.getenv('GEMINI_STRUCTURED_OUTPUT', 'true').lower() == 'true'
+        
+        # Cliente asíncrono por modelo con conexiones reutilizables (cada modelo
+        # tiene su propio circuit breaker y sus latencias para la cobertura) y
+        # un único límite de concurrencia y presupuesto de reintentos y de
+        # peticiones de cobertura para todos los modelos
+        self.gemini_concurrency = ConcurrencyLimit()
+        self.gemini_retry_budget = RetryBudget()
+        self.gemini_hedge_budget = create_hedge_budget()
+        self.gemini_clients = {
+            model: AsyncGeminiClient(
+                self.api_key,
+                self.model_url(model),
+                retry_budget=self.gemini_retry_budget,
+                hedge_policy=HedgePolicy(budget=self.gemini_hedge_budget),
+                concurrency=self.gemini_concurrency
+            )
+            for model in self.model_cascade
+        }
+        self.gemini_client = self.gemini_clients[self.model]
+        
+        # Normalización de imágenes antes de codificarlas (tamaño, grises, calidad)
+        self.image_preprocessor = ImagePreprocessor()
+        
+        # Trabajo de CPU con imágenes (hash, redimensionado, base64) fuera del event loop
+        self.image_workers = ImageWorkerPool(self.image_preprocessor)
+        
+        # Caché de extracciones por SHA-256 de la imagen y configuración de extracción
+        self.extraction_config_hash = compute_config_hash(self.get_extraction_config())
+        self.extraction_cache = None
+        if os.getenv('EXTRACTION_CACHE_ENABLED', 'true').lower() == 'true':
+            try:
+                self.extraction_cache = ExtractionCache()
+                print(f"   💾 Caché de extracciones: {self.extraction_cache.db_path} (configuración {self.extraction_config_hash})")
+            except Exception as e:
+                print(f"   ⚠️ Caché de extracciones no disponible: {str(e)}")
+                logger.warning("Extraction cache unavailable", error=str(e))
+        
+        # Índice de hashes perceptuales por usuario para detectar casi duplicados
+        self.near_duplicate_index = None
+        if os.getenv('PHASH_ENABLED', 'true').lower() == 'true':
+            self.near_duplicate_index = NearDuplicateIndex()
+            print(f"   🔁 Detección de casi duplicados: umbral {self.near_duplicate_index.similarity_threshold}")
+        
+        # Extracciones en vuelo por hash de imagen: peticiones idénticas simultáneas comparten una llamada
+        self.extraction_flights = SingleFlight()
+        
+        # Pares petición/respuesta completos para reproducir tráfico real (REPLAY_CORPUS_DIR)
+        self.replay_corpus = ReplayCorpus()
+        if self.replay_corpus.enabled:
+            print(f"   🎞️ Corpus de replay: {self.replay_corpus.directory}")
         
         # Servicio para verificar tiendas del mercado
         self.market_store_service = market_store_service
         
+        # Tiendas del mercado en caché con autómata Aho-Corasick (sin red por ticket)
+        self.store_matcher = get_market_store_matcher()
+        
+        print(f"   🔀 Concurrencia máxima con Gemini: {self.gemini_client.max_concurrency}")
+        print(f"   🧮 Procesos para imágenes: {self.image_workers.processes}")
+        print(f"   🧾 Modelo: {' -> '.join(self.model_cascade)} - salida estructurada: {'sí' if self.structured_output else 'no'}")
+        if len(self.model_cascade) > 1:
+            print(f"   🪜 Escalar de modelo si falla: {', '.join(self.cascade_checks)}")
+        if self.reextract_fields:
+            print(f"   🎯 Re-extracción de campos: {', '.join(self.reextract_fields)} (máximo {self.reextract_max_fields})")
         print("✅ Sistema de IA con Gemini inicializado correctamente")
 
+    def model_url(self, model: str) -> str:
+        """URL de generateContent de un modelo"""
+        return f"{self.api_base}/v1beta/models/{model}:generateContent"
+
     def encode_image_to_base64(self, image_path: str) -> str:
         """
         Codificar imagen a base64 para enviar a Gemini
@@ -38,15 +195,10 @@ class GeminiTicketAI:
             logger.error("Error encoding image to base64", error=str(e), image_path=image_path)
             raise
 
-    def call_gemini_api(self, image_base64: str) -> str:
+    def build_gemini_payload(self, image_base64: str, mime_type: str = "image/jpeg") -> Dict:
         """
-        Llamar a la API de Gemini con la imagen
+        Construir el cuerpo de la petición a Gemini con el prompt y la imagen
         """
-        headers = {
-            'Content-Type': 'application/json',
-            'X-goog-api-key': self.api_key
-        }
-        
         # Prompt específico para procesar tickets
         prompt = """
         Analiza esta imagen de un ticket de compra y extrae la siguiente información en formato JSON:
@@ -85,7 +237,7 @@ class GeminiTicketAI:
                         },
                         {
                             "inline_data": {
-                                "mime_type": "image/jpeg",
+                                "mime_type": mime_type,
                                 "data": image_base64
                             }
                         }
@@ -94,47 +246,94 @@ class GeminiTicketAI:
             ]
         }
         
-        try:
-            print("🌐 Enviando petición a Gemini API...")
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            print(f"📡 Respuesta de Gemini API: Status {response.status_code}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                print("✅ Respuesta exitosa de Gemini API")
-                
-                # Extraer el texto de la respuesta
-                if 'candidates' in result and len(result['candidates']) > 0:
-                    content = result['candidates'][0]['content']
-                    if 'parts' in content and len(content['parts']) > 0:
-                        response_text = content['parts'][0]['text']
-                        print(f"📝 Texto extraído de Gemini: {len(response_text)} caracteres")
-                        print(f"🔍 Primeros 300 caracteres: {response_text[:300]}...")
-                        return response_text
-                
-                print("❌ Respuesta de Gemini no tiene el formato esperado")
-                raise ValueError("Respuesta de Gemini no tiene el formato esperado")
-            else:
-                print(f"❌ Error en API de Gemini: {response.status_code}")
-                print(f"📄 Respuesta de error: {response.text}")
-                logger.error("Error en API de Gemini", status_code=response.status_code, response=response.text)
-                raise ValueError(f"Error en API de Gemini: {response.status_code}")
-                
-        except requests.exceptions.RequestException as e:
-            print(f"💥 Error de conexión con Gemini API: {str(e)}")
-            logger.error("Error de conexión con Gemini API", error=str(e))
-            raise
+        if self.structured_output:
+            payload["generationConfig"] = {
+                "responseMimeType": "application/json",
+                "responseSchema": RESPONSE_SCHEMA
+            }
+        
+        return payload
+
+    async def call_gemini_api(self, image_base64: str, mime_type: str = "image/jpeg", model: Optional[str] = None) -> str:
+        """
+        Llamar a la API de Gemini con la imagen (sin bloquear el event loop)
+        
+        Args:
+            model: Modelo de la cascada a usar (por defecto el último, el más capaz)
+        """
+        payload = self.build_gemini_payload(image_base64, mime_type)
+        return await self.send_gemini_request(payload, model)
+
+    async def send_gemini_request(self, payload: Dict, model: Optional[str] = None) -> str:
+        """
+        Enviar una petición a generateContent y devolver el texto de la respuesta
+        """
+        model = model or self.model
+        
+        print(f"🌐 Enviando petición a Gemini API ({model})...")
+        with stage_timer(STAGE_GEMINI):
+            result = await self.gemini_clients[model].generate_content(payload)
+        print("✅ Respuesta exitosa de Gemini API")
+        
+        # Extraer el texto de la respuesta
+        if 'candidates' in result and len(result['candidates']) > 0:
+            content = result['candidates'][0]['content']
+            if 'parts' in content and len(content['parts']) > 0:
+                response_text = content['parts'][0]['text']
+                print(f"📝 Texto extraído de Gemini: {len(response_text)} caracteres")
+                print(f"🔍 Primeros 300 caracteres: {response_text[:300]}...")
+                return response_text
+        
+        print("❌ Respuesta de Gemini no tiene el formato esperado")
+        raise GeminiAPIError("Respuesta de Gemini no tiene el formato esperado")
+
+    def build_field_payload(self, image_base64: str, mime_type: str, fields: List[str], parsed_data: Dict) -> Dict:
+        """
+        Petición corta para volver a extraer solo algunos campos del ticket
+        
+        Incluye lo que dio la extracción anterior para que el modelo sepa qué
+        revisar (por ejemplo, un total que no cuadra con la suma de productos).
+        """
+        lines = "\n".join(f"- {field}: {FIELD_PROMPTS[field]}" for field in fields)
+        previous = {field: parsed_data.get(field) for field in fields if field != 'productos'}
+        prompt = (
+            "Revisa en esta imagen de un ticket de compra solo estos campos y responde SOLO con un JSON "
+            f"con ellos (null si no aparecen):\n{lines}\n"
+            f"La lectura anterior fue: {json.dumps(previous, ensure_ascii=False)}"
+        )
+        if products_sum_matches(parsed_data) is False:
+            line_sum = sum(price for price, _ in priced_products(parsed_data))
+            prompt += f"\nLa suma de los precios de los productos ({line_sum:.2f}) no cuadra con el total."
+        
+        payload = {
+            "contents": [
+                {
+                    "parts": [
+                        {"text": prompt},
+                        {"inline_data": {"mime_type": mime_type, "data": image_base64}}
+                    ]
+                }
+            ]
+        }
+        if self.structured_output:
+            payload["generationConfig"] = {
+                "responseMimeType": "application/json",
+                "responseSchema": build_partial_schema(fields)
+            }
+        return payload
 
     def parse_gemini_response(self, response_text: str) -> Dict:
         """
         Parsear la respuesta de Gemini y extraer el JSON
+        
+        En modo estructurado la respuesta es JSON puro y se valida contra el
+        esquema; si no, se busca el JSON dentro del texto libre.
         """
+        if self.structured_output:
+            parsed_data = parse_structured_response(response_text)
+            print(f"✅ Respuesta estructurada validada: {len(parsed_data['productos'])} productos")
+            return parsed_data
+        
         try:
             print("🔍 Iniciando parseo de respuesta de Gemini...")
             
@@ -198,54 +397,151 @@ class GeminiTicketAI:
             print("   ⚠️ Nombre de tienda vacío")
             return False
         
-        # Obtener tiendas del mercado desde el ticket service
+        with stage_timer(STAGE_STORE_VERIFICATION):
+            match = self.store_matcher.find(store_name)
+        if match:
+            print(f"   ✅ Coincidencia encontrada para '{store_name}': {match}")
+            return True
+        
+        print(f"   ❌ No es tienda del mercado ({len(self.store_matcher.automaton)} tiendas en caché)")
+        return False
+
+    def annotate_near_duplicate(self, result: Dict, match: Dict):
+        """
+        Anotar en el resultado el ticket casi idéntico; con
+        PHASH_DUPLICATE_ACTION=flag además se marca como duplicado
+        """
+        result['near_duplicate_of'] = {
+            'image_hash': match['image_hash'],
+            'similarity': round(match['similarity'], 4),
+            'confirmed': match['confirmed'] or self.near_duplicate_index.confirm_fields
+        }
+        
+        if self.near_duplicate_index.action == ACTION_FLAG:
+            result['ticket_status'] = 'duplicate'
+            result['status_message'] = 'Ticket duplicado detectado (imagen casi idéntica)'
+            result['duplicate_detected'] = True
+
+    def build_near_duplicate_result(self, match: Dict, image_hash: str) -> Dict:
+        """
+        Resultado para una imagen casi idéntica a otra ya procesada, sin
+        llamar a Gemini: la extracción anterior, marcada como duplicado
+        ('flag') o reutilizada ('reuse')
+        """
+        result = dict(match['result'])
+        result['image_hash'] = image_hash
+        result['timestamp'] = datetime.now().isoformat()
+        result['cache_hit'] = False
+        result['coalesced'] = False
+        self.annotate_near_duplicate(result, match)
+        return result
+
+    async def process_ticket(self, image_path: str, user_id: Optional[str] = None) -> Dict:
+        """
+        Procesar ticket completo usando Gemini API a partir de un fichero
+        
+        Args:
+            image_path: Ruta de la imagen del ticket
+            user_id: Usuario que sube el ticket (activa la detección de casi duplicados)
+        """
+        print(f"🎫 Procesando ticket con Gemini: {image_path}")
+        
         try:
-            import requests
-            response = requests.get("http://ticket-service:8003/market-stores/", timeout=10)
-            if response.status_code == 200:
-                market_stores = response.json()
-                market_store_names = [store.get('name', '') for store in market_stores if store.get('is_active', True)]
-                
-                print(f"   📋 Tiendas del mercado disponibles: {market_store_names}")
-                
-                # Verificar si el nombre de la tienda contiene alguna de las tiendas del mercado
-                store_name_lower = store_name.lower()
-                for market_store in market_store_names:
-                    if market_store.lower() in store_name_lower:
-                        print(f"   ✅ Coincidencia encontrada: '{market_store}' en '{store_name}'")
-                        return True
-                
-                print(f"   ❌ No es tienda del mercado")
-                return False
-            else:
-                print(f"   ⚠️ Error obteniendo tiendas del mercado: {response.status_code}")
-                return False
-                
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
         except Exception as e:
-            print(f"   ⚠️ Error verificando tienda del mercado: {str(e)}")
-            return False
+            logger.error("Error leyendo imagen del ticket", error=str(e), image_path=image_path)
+            return self.build_error_result(e)
+        
+        return await self.process_ticket_bytes(image_bytes, user_id=user_id)
 
-    def process_ticket(self, image_path: str) -> Dict:
+    async def process_ticket_base64(self, image_base64: str, user_id: Optional[str] = None) -> Dict:
         """
-        Procesar ticket completo usando Gemini API
+        Procesar ticket a partir de la imagen ya codificada en base64
+        
+        La imagen solo se decodifica una vez (para la caché y el hash perceptual);
+        si no hace falta normalizarla se reenvía a Gemini el mismo base64.
         """
-        print(f"🎫 Procesando ticket con Gemini: {image_path}")
-        logger.info("Iniciando procesamiento de ticket", image_path=image_path)
+        try:
+            image_bytes = await self.image_workers.decode_base64(image_base64)
+        except Exception as e:
+            logger.error("Imagen base64 inválida", error=str(e))
+            return self.build_error_result(e)
+        
+        return await self.process_ticket_bytes(image_bytes, user_id=user_id, image_base64=image_base64)
+
+    async def process_ticket_bytes(
+        self,
+        image_bytes: bytes,
+        user_id: Optional[str] = None,
+        image_base64: Optional[str] = None,
+        ticket_id: Optional[str] = None
+    ) -> Dict:
+        """
+        Procesar ticket completo usando Gemini API, en memoria
+        
+        Mide la duración total (/metrics). El resultado del ticket lo cuenta
+        quien fija su estado final (record_ticket_outcome): el endpoint tras
+        verificar las tiendas o el procesador automático tras la detección de
+        duplicados del ticket service.
+        
+        Args:
+            image_bytes: Bytes de la imagen del ticket
+            user_id: Usuario que sube el ticket (activa la detección de casi duplicados)
+            image_base64: Base64 de image_bytes si el llamante ya lo tiene
+            ticket_id: Ticket del ticket service (sus reprocesados no son casi duplicados)
+        """
+        with TICKET_LATENCY.time():
+            return await self._process_ticket_bytes(image_bytes, user_id, image_base64, ticket_id)
+
+    async def _process_ticket_bytes(
+        self,
+        image_bytes: bytes,
+        user_id: Optional[str],
+        image_base64: Optional[str],
+        ticket_id: Optional[str]
+    ) -> Dict:
+        """Procesamiento de un ticket (ver process_ticket_bytes)"""
+        logger.info("Iniciando procesamiento de ticket", image_size=len(image_bytes))
         
         try:
-            # Codificar imagen a base64
-            print("📸 Codificando imagen a base64...")
-            image_base64 = self.encode_image_to_base64(image_path)
-            print(f"✅ Imagen codificada: {len(image_base64)} caracteres base64")
+            # Calcular la huella de la imagen (caché) y su hash perceptual en el pool de procesos
+            with_phash = bool(user_id and self.near_duplicate_index)
+            image_hash, phash = await self.image_workers.analyze(image_bytes, with_phash)
             
-            # Llamar a Gemini API
-            print("🤖 Enviando imagen a Gemini API...")
-            gemini_response = self.call_gemini_api(image_base64)
-            print(f"✅ Respuesta de Gemini recibida: {len(gemini_response)} caracteres")
+            if with_phash and phash is None:
+                print("   ⚠️ No se pudo calcular el hash perceptual")
             
-            # Parsear respuesta
-            print("🔍 Parseando respuesta de Gemini...")
-            parsed_data = self.parse_gemini_response(gemini_response)
+            cache_key = compute_cache_key(image_hash, self.extraction_config_hash)
+            cached = await asyncio.to_thread(self.extraction_cache.get, cache_key) if self.extraction_cache else None
+            
+            # Buscar fotos casi idénticas del mismo usuario antes de llamar a Gemini
+            match = self.near_duplicate_index.find(user_id, phash, image_hash, ticket_id) if phash is not None else None
+            if match:
+                print(f"🔁 Imagen casi idéntica a {match['image_hash'][:12]}... (similitud {match['similarity']:.2f})")
+                logger.info("Near-duplicate image detected",
+                           user_id=user_id,
+                           similarity=match['similarity'],
+                           confirmed=match['confirmed'],
+                           action=self.near_duplicate_index.action)
+                if self.near_duplicate_index.should_skip_extraction(match):
+                    return self.build_near_duplicate_result(match, image_hash)
+            coalesced = False
+            gemini_request = None
+            if cached:
+                print(f"⚡ Extracción encontrada en caché: {image_hash[:12]}...")
+                parsed_data = cached['parsed_data']
+                gemini_response = cached['raw_response']
+            else:
+                # Si ya hay una extracción en vuelo para esta imagen, esperar a su resultado
+                (parsed_data, gemini_response, gemini_request), coalesced = await self.extraction_flights.do(
+                    image_hash,
+                    lambda: self.extract_with_gemini(image_bytes, cache_key, image_base64)
+                )
+                if coalesced:
+                    EXTRACTIONS_COALESCED.inc()
+                    print(f"🔗 Petición agrupada con una extracción en curso: {image_hash[:12]}...")
+                    parsed_data = dict(parsed_data)
             
             # Logs detallados de cada elemento extraído
             print("\n📋 ELEMENTOS EXTRAÍDOS DEL TICKET:")
@@ -268,23 +564,14 @@ class GeminiTicketAI:
             print(f"\n🏪 VERIFICANDO TIENDA DEL MERCADO:")
             print(f"   Nombre de tienda: {store_name}")
             
-            es_tienda_mercado = self.verify_market_store(store_name) if store_name else False
+            es_tienda_mercado = await asyncio.to_thread(self.verify_market_store, store_name) if store_name else False
             print(f"   ¿Es tienda del mercado? {'✅ SÍ' if es_tienda_mercado else '❌ NO'}")
             
             # Determinar el estado del ticket
-            if parsed_data.get('procesado_correctamente', True):
-                if es_tienda_mercado:
-                    ticket_status = "done_approved"
-                    status_message = "Ticket aprobado - Tienda del mercado"
-                    print(f"   🎉 RESULTADO: TICKET APROBADO")
-                else:
-                    ticket_status = "done_rejected"
-                    status_message = "Ticket rechazado - No es tienda del mercado"
-                    print(f"   ⚠️ RESULTADO: TICKET RECHAZADO (no es tienda del mercado)")
-            else:
-                ticket_status = "failed"
-                status_message = "Error en el procesamiento"
-                print(f"   💥 RESULTADO: TICKET FALLIDO (error en procesamiento)")
+            ticket_status, status_message = determine_ticket_status(
+                parsed_data.get('procesado_correctamente', True), es_tienda_mercado
+            )
+            print(f"   {'🎉' if ticket_status == 'done_approved' else '⚠️' if ticket_status == 'done_rejected' else '💥'} RESULTADO: {status_message}")
             
             # Estructurar resultado final
             result = {
@@ -300,11 +587,36 @@ class GeminiTicketAI:
                 'es_tienda_mercado': es_tienda_mercado,
                 'ticket_status': ticket_status,
                 'status_message': status_message,
-                'metodo': 'Gemini 2.0 Flash API',
+                'metodo': f"Gemini API ({parsed_data.get('modelo', self.model)})",
+                'modelo': parsed_data.get('modelo', self.model),
+                'validacion': parsed_data.get('validacion', []),
+                'puntuacion_campos': parsed_data.get('puntuacion_campos'),
+                'campos_reextraidos': parsed_data.get('campos_reextraidos', []),
                 'timestamp': datetime.now().isoformat(),
-                'raw_gemini_response': gemini_response[:200] + "..." if len(gemini_response) > 200 else gemini_response
+                'raw_gemini_response': gemini_response[:200] + "..." if len(gemini_response) > 200 else gemini_response,
+                'image_hash': image_hash,
+                'cache_hit': cached is not None,
+                'coalesced': coalesced
             }
             
+            # Coincidencia pendiente de confirmar con los datos extraídos ('annotate'
+            # o PHASH_CONFIRM_FIELDS): solo cuenta si la fecha, el total y la tienda coinciden
+            if match and self.near_duplicate_index.confirm(match, result):
+                self.annotate_near_duplicate(result, match)
+            if phash is not None and not result.get('duplicate_detected'):
+                self.near_duplicate_index.add(user_id, phash, image_hash, result, ticket_id)
+            
+            # Guardar el par petición/respuesta completo (solo extracciones nuevas)
+            if gemini_request is not None and not coalesced and self.replay_corpus.enabled:
+                await asyncio.to_thread(
+                    self.replay_corpus.record,
+                    image_hash,
+                    gemini_request['payload'],
+                    gemini_response,
+                    {key: result[key] for key in REPLAY_RESULT_FIELDS},
+                    gemini_request['image_base64']
+                )
+            
             print(f"\n✅ Ticket procesado con Gemini: {result['tienda']} - {result['num_productos']} productos - Estado: {ticket_status}")
             logger.info("Ticket procesado exitosamente", 
                        tienda=result['tienda'], 
@@ -313,25 +625,246 @@ class GeminiTicketAI:
                        es_tienda_mercado=es_tienda_mercado)
             return result
             
+        except GeminiUnavailableError:
+            # Gemini degradado: el ticket no ha fallado, hay que reintentarlo más tarde
+            raise
         except Exception as e:
-            logger.error("Error procesando ticket con Gemini", error=str(e), image_path=image_path)
-            return {
-                'fecha': None,
-                'hora': None,
-                'tienda': None,
-                'total': None,
-                'tipo_ticket': 'desconocido',
-                'productos': [],
-                'num_productos': 0,
-                'texto_extraido': '',
-                'procesado_correctamente': False,
-                'es_tienda_mercado': False,
-                'ticket_status': 'failed',
-                'status_message': f'Error en el procesamiento: {str(e)}',
-                'error': str(e),
-                'metodo': 'Gemini 2.0 Flash API (error)',
-                'timestamp': datetime.now().isoformat()
-            }
+            logger.error("Error procesando ticket con Gemini", error=str(e))
+            return self.build_error_result(e)
+
+    async def extract_with_gemini(
+        self,
+        image_bytes: bytes,
+        cache_key: str,
+        image_base64: Optional[str] = None
+    ) -> Tuple[Dict, str, Dict]:
+        """
+        Normalizar la imagen, llamar a Gemini, parsear y guardar en caché
+        
+        Returns:
+            Tupla (datos parseados, respuesta en texto de Gemini, petición
+            enviada sin la imagen para el corpus de replay)
+        """
+        # Reducir la imagen y codificarla en base64 en el pool de procesos
+        # (reutilizando el base64 del llamante si la imagen no cambia)
+        prepared = await self.image_workers.prepare(image_bytes, need_base64=not image_base64)
+        mime_type = prepared['mime_type']
+        print(f"🗜️ Imagen normalizada: {len(image_bytes)} -> {prepared['size']} bytes ({mime_type})")
+        if prepared['image_base64'] is not None:
+            image_base64 = prepared['image_base64']
+        print(f"✅ Imagen codificada: {len(image_base64)} caracteres base64")
+        
+        # Llamar a Gemini API (cascada de modelos) y parsear la respuesta
+        print("🤖 Enviando imagen a Gemini API...")
+        parsed_data, gemini_response = await self.run_model_cascade(image_base64, mime_type)
+        
+        if self.extraction_cache:
+            await asyncio.to_thread(self.extraction_cache.set, cache_key, {
+                'parsed_data': parsed_data,
+                'raw_response': gemini_response
+            })
+        
+        # La petición es determinista dada la imagen: se guarda sin los datos de la imagen
+        payload = self.build_gemini_payload(None, mime_type)
+        gemini_request = {
+            'payload': {'model': parsed_data.get('modelo', self.model), **payload},
+            'image_base64': image_base64
+        }
+        return parsed_data, gemini_response, gemini_request
+
+    async def run_model_cascade(self, image_base64: str, mime_type: str) -> Tuple[Dict, str]:
+        """
+        Extraer con cada modelo de la cascada hasta obtener una extracción válida
+        
+        Un modelo escala al siguiente si su respuesta no se puede parsear, si
+        Gemini falla o si la extracción no pasa la validación (total que no
+        cuadra, fecha ausente, tienda desconocida...). El último modelo se
+        acepta siempre; sus problemas quedan en `validacion`.
+        
+        Returns:
+            Tupla (datos parseados con `modelo` y `validacion`, respuesta en texto)
+        """
+        for tier, model in enumerate(self.model_cascade):
+            is_last = tier == len(self.model_cascade) - 1
+            start = time.monotonic()
+            try:
+                gemini_response = await self.call_gemini_api(image_base64, mime_type, model)
+                print(f"✅ Respuesta de Gemini recibida: {len(gemini_response)} caracteres")
+                print("🔍 Parseando respuesta de Gemini...")
+                with stage_timer(STAGE_PARSE):
+                    parsed_data = self.parse_gemini_response(gemini_response)
+            except (GeminiAPIError, ValueError) as e:
+                CASCADE_TIER_LATENCY.labels(model=model).observe(time.monotonic() - start)
+                outcome = 'unavailable' if isinstance(e, GeminiUnavailableError) else 'error'
+                CASCADE_TIER_REQUESTS.labels(model=model, outcome=outcome).inc()
+                if is_last:
+                    raise
+                CASCADE_ESCALATIONS.labels(model=model, reason=outcome).inc()
+                print(f"🪜 {model} falló ({str(e)}), escalando a {self.model_cascade[tier + 1]}")
+                continue
+            CASCADE_TIER_LATENCY.labels(model=model).observe(time.monotonic() - start)
+            
+            issues, scores, reextracted = [], None, []
+            if len(self.model_cascade) > 1 or self.reextract_fields:
+                try:
+                    issues, scores, store_known = await self.check_extraction(parsed_data)
+                    fields = failed_fields(scores, self.reextract_fields)
+                    
+                    # Pocos campos fallidos: pedir solo esos antes de escalar o aceptar con problemas
+                    if issues and fields and len(fields) <= self.reextract_max_fields:
+                        parsed_data, reextracted = await self.reextract_fields_with_model(
+                            image_base64, mime_type, model, parsed_data, fields
+                        )
+                        if reextracted:
+                            issues, scores, _ = await self.check_extraction(
+                                parsed_data, None if 'tienda' in reextracted else store_known
+                            )
+                            REEXTRACTIONS.labels(model=model, outcome='still_invalid' if issues else 'fixed').inc()
+                except GeminiUnavailableError:
+                    raise
+                except Exception as e:
+                    # Una validación que falla no invalida el ticket: cuenta como problema
+                    print(f"   ⚠️ Error validando la extracción de {model}: {str(e)}")
+                    logger.warning("Error validando la extracción", model=model, error=str(e))
+                    issues, scores = [ISSUE_CHECK_ERROR], None
+            
+            if issues and not is_last:
+                CASCADE_TIER_REQUESTS.labels(model=model, outcome='escalated').inc()
+                for issue in issues:
+                    CASCADE_ESCALATIONS.labels(model=model, reason=issue).inc()
+                print(f"🪜 Extracción de {model} no válida ({', '.join(issues)}), escalando a {self.model_cascade[tier + 1]}")
+                continue
+            
+            CASCADE_TIER_REQUESTS.labels(model=model, outcome='accepted_with_issues' if issues else 'accepted').inc()
+            parsed_data['modelo'] = model
+            parsed_data['validacion'] = issues
+            parsed_data['puntuacion_campos'] = scores
+            parsed_data['campos_reextraidos'] = reextracted
+            return parsed_data, gemini_response
+
+    async def check_extraction(
+        self,
+        parsed_data: Dict,
+        store_known: Optional[bool] = None
+    ) -> Tuple[List[str], Dict[str, float], Optional[bool]]:
+        """
+        Validar una extracción y puntuar sus campos
+        
+        La tienda solo se verifica contra el ticket service si alguna decisión
+        depende de ella (cascada con la comprobación de tienda o re-extracción
+        de la tienda).
+        
+        Returns:
+            Tupla (problemas, puntuación por campo, tienda del mercado o None)
+        """
+        check_store = CHECK_STORE in self.cascade_checks and \
+            (len(self.model_cascade) > 1 or 'tienda' in self.reextract_fields)
+        if store_known is None and check_store and parsed_data.get('tienda'):
+            store_known = await asyncio.to_thread(self.verify_market_store, parsed_data['tienda'])
+        issues = validate_extraction(parsed_data, self.cascade_checks, store_known)
+        return issues, score_fields(parsed_data, store_known), store_known
+
+    async def reextract_fields_with_model(
+        self,
+        image_base64: str,
+        mime_type: str,
+        model: str,
+        parsed_data: Dict,
+        fields: List[str]
+    ) -> Tuple[Dict, List[str]]:
+        """
+        Volver a pedir al modelo solo los campos que han fallado
+        
+        Los valores nuevos sustituyen a los anteriores solo si no son nulos. Si
+        la llamada falla se devuelve la extracción original.
+        
+        Returns:
+            Tupla (datos combinados, campos actualizados)
+        """
+        for field in fields:
+            REEXTRACTED_FIELDS.labels(field=field).inc()
+        print(f"🎯 Re-extrayendo campos con {model}: {', '.join(fields)}")
+        
+        try:
+            payload = self.build_field_payload(image_base64, mime_type, fields, parsed_data)
+            response_text = await self.send_gemini_request(payload, model)
+            with stage_timer(STAGE_PARSE):
+                partial = parse_partial_response(response_text, fields)
+        except (GeminiAPIError, ValueError) as e:
+            REEXTRACTIONS.labels(model=model, outcome='error').inc()
+            print(f"   ⚠️ Re-extracción fallida: {str(e)}")
+            logger.warning("Error re-extrayendo campos", model=model, fields=fields, error=str(e))
+            return parsed_data, []
+        
+        updated = [field for field, value in partial.items() if value not in (None, [])]
+        merged = {**parsed_data, **{field: partial[field] for field in updated}}
+        for field in updated:
+            if field != 'productos':
+                print(f"   🔁 {field}: {parsed_data.get(field)} -> {merged[field]}")
+        return merged, updated
+
+    def get_extraction_config(self) -> Dict:
+        """
+        Todo lo que cambia el resultado de una extracción (para la clave de la
+        caché): modelos y validación de la cascada, prompt y esquema, y
+        preprocesado de la imagen
+        """
+        return {
+            "models": self.model_cascade,
+            "checks": self.cascade_checks,
+            "reextract_fields": self.reextract_fields,
+            "reextract_max_fields": self.reextract_max_fields,
+            "payload": self.build_gemini_payload(None),
+            "preprocessing": self.image_preprocessor.get_config()
+        }
+
+    def get_cascade_stats(self) -> Dict:
+        """Modelos de la cascada y resultados y latencia por modelo"""
+        return {
+            "models": self.model_cascade,
+            "checks": self.cascade_checks if len(self.model_cascade) > 1 else [],
+            "tier_requests": counter_totals(CASCADE_TIER_REQUESTS),
+            "escalations": counter_totals(CASCADE_ESCALATIONS),
+            "tier_latency": histogram_summary(CASCADE_TIER_LATENCY),
+            "reextract_fields": self.reextract_fields,
+            "reextractions": counter_totals(REEXTRACTIONS),
+            "reextracted_fields": counter_totals(REEXTRACTED_FIELDS)
+        }
+
+    def build_error_result(self, error: Exception) -> Dict:
+        """
+        Resultado de un ticket que no se ha podido procesar
+        """
+        return {
+            'fecha': None,
+            'hora': None,
+            'tienda': None,
+            'total': None,
+            'tipo_ticket': 'desconocido',
+            'productos': [],
+            'num_productos': 0,
+            'texto_extraido': '',
+            'procesado_correctamente': False,
+            'es_tienda_mercado': False,
+            'ticket_status': 'failed',
+            'status_message': f'Error en el procesamiento: {str(error)}',
+            'error': str(error),
+            # Los modelos anteriores de la cascada escalan: el error es del último
+            'metodo': f"Gemini API ({self.model}) (error)",
+            'modelo': self.model,
+            'timestamp': datetime.now().isoformat()
+        }
+
+    async def aclose(self):
+        """
+        Liberar las conexiones del cliente de Gemini
+        """
+        for client in self.gemini_clients.values():
+            await client.aclose()
+        self.image_workers.shutdown()
+        await asyncio.to_thread(self.replay_corpus.flush)
+        if self.extraction_cache:
+            await asyncio.to_thread(self.extraction_cache.flush)
 
 # Alias para compatibilidad
 FinalTicketAI = GeminiTicketAI 
\ No newline at end of file
@@ -3,15 +3,84 @@
 Módulo para procesamiento automático de tickets pendientes
 """
 
+import os
+import socket
 import time
 import threading
 import requests
 import structlog
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
+
+from metrics import OUTCOME_REPORTED_HEADER, record_ticket_outcome
+from rate_limiter import get_gemini_quota
+from priority_scheduler import PriorityScheduler
+from ticket_listener import TicketNotificationListener
+from store_matcher import get_market_store_matcher
 
 logger = structlog.get_logger()
 
+class ProcessorMetrics:
+    """Métricas de rendimiento del procesador automático (seguras entre hilos)"""
+    
+    def __init__(self, window_seconds: int = 60):
+        self.window_seconds = window_seconds
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.processed_total = 0
+        self.failed_total = 0
+        self.deferred_total = 0
+        self._completions = deque()
+        self._latencies = deque(maxlen=500)
+        self._lock = threading.Lock()
+    
+    def enqueued(self, count: int = 1):
+        with self._lock:
+            self.queue_depth += count
+    
+    def started(self):
+        with self._lock:
+            self.queue_depth -= 1
+            self.in_flight += 1
+    
+    def deferred(self):
+        """Ticket devuelto a pendiente sin llegar a procesarse"""
+        with self._lock:
+            self.queue_depth -= 1
+            self.deferred_total += 1
+    
+    def finished(self, success: bool, elapsed: float, deferred: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if success:
+                self.processed_total += 1
+            elif deferred:
+                self.deferred_total += 1
+            else:
+                self.failed_total += 1
+            self._completions.append(now)
+            self._latencies.append(elapsed)
+    
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            while self._completions and now - self._completions[0] > self.window_seconds:
+                self._completions.popleft()
+            latencies = sorted(self._latencies)
+            return {
+                "queue_depth": self.queue_depth,
+                "in_flight": self.in_flight,
+                "processed_total": self.processed_total,
+                "failed_total": self.failed_total,
+                "deferred_total": self.deferred_total,
+                "throughput_per_minute": round(len(self._completions) * 60 / self.window_seconds, 2),
+                "avg_ticket_seconds": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p95_ticket_seconds": round(latencies[int(0.95 * (len(latencies) - 1))], 3) if latencies else None
+            }
+
 class AutoTicketProcessor:
     def __init__(self, ticket_service_url: str = "http://ticket-service:8003"):
         """
@@ -25,10 +94,52 @@ class AutoTicketProcessor:
         self.thread = None
         self.processing_interval = 30  # segundos entre verificaciones
         
+        # Cola por eventos: Postgres notifica cada ticket nuevo y el sondeo
+        # queda solo como barrido de seguridad
+        self.database_url = os.getenv('DATABASE_URL')
+        self.listener = None
+        self.wake_event = threading.Event()
+        if self.database_url:
+            self.processing_interval = int(os.getenv('AUTO_PROCESSOR_SWEEP_INTERVAL', '300'))
+            self.listener = TicketNotificationListener(self.database_url, self.notify_new_ticket)
+        
+        # Pool de workers; la cuota de Gemini la cobra el cliente por petición
+        # (un ticket puede hacer varias: cascada, re-extracción, reintentos)
+        self.max_workers = int(os.getenv('AUTO_PROCESSOR_WORKERS', '4'))
+        self.gemini_quota = get_gemini_quota()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ticket-worker")
+        self.metrics = ProcessorMetrics()
+        self.queued_ids = set()
+        self._queued_lock = threading.Lock()
+        
+        # Reparto de tickets entre réplicas: cada worker reclama lotes con lease
+        self.worker_id = os.getenv('AUTO_PROCESSOR_WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = int(os.getenv('AUTO_PROCESSOR_LEASE_SECONDS', '300'))
+        self.claim_batch_size = min(100, int(os.getenv('AUTO_PROCESSOR_CLAIM_BATCH', str(self.max_workers * 2))))
+        self.more_pending = False
+        
+        # Próximo reintento programado en el ticket service (epoch): el bucle se
+        # despierta a esa hora en lugar de esperar al barrido
+        self.next_retry_at: Optional[float] = None
+        
+        # Orden de procesamiento: prioridad de la clase (interactive, retry, backfill) x tiempo en cola
+        self.scheduler = PriorityScheduler()
+        
+        # Tiendas del mercado en caché: la IA verifica la tienda sin recibir la lista
+        self.store_matcher = get_market_store_matcher()
+        
+        # Pausa cuando la IA responde 503 (circuit breaker de Gemini abierto)
+        self.paused_until = 0.0
+        
         print("🤖 Inicializando Auto Ticket Processor...")
         print(f"   📡 Ticket Service URL: {ticket_service_url}")
-        print("   ⏰ Procesamiento continuo: verificar cada 30 segundos")
-        print("   📋 Procesar tickets en orden de llegada (más antiguo primero)")
+        if self.listener:
+            print(f"   ⚡ Procesamiento por eventos (LISTEN/NOTIFY) - barrido de seguridad cada {self.processing_interval} segundos")
+        else:
+            print(f"   ⏰ Procesamiento continuo: verificar cada {self.processing_interval} segundos")
+        print(f"   📋 Procesar tickets por prioridad con envejecimiento (pesos: {self.scheduler.weights})")
+        print(f"   🪪 Worker ID: {self.worker_id} (lease de {self.lease_seconds} segundos)")
+        print(f"   👷 Workers: {self.max_workers} - Límite Gemini: {self.gemini_quota.request_limiter.rate_per_minute:.0f} RPM / {self.gemini_quota.token_limiter.rate_per_minute:.0f} TPM")
         
     def check_ticket_service_health(self) -> bool:
         """Verificar que el ticket service esté disponible"""
@@ -39,15 +150,16 @@ class AutoTicketProcessor:
             logger.warning("Ticket service no disponible", error=str(e))
             return False
     
-    def get_pending_tickets(self) -> List[Dict]:
-        """Obtener lista de tickets pendientes ordenados por fecha de creación"""
+    def get_pending_tickets(self, limit: int = 100) -> List[Dict]:
+        """Obtener tickets pendientes (solo metadatos) ordenados por fecha de creación"""
         try:
-            response = requests.get(f"{self.ticket_service_url}/tickets/pending/", timeout=10)
+            response = requests.get(
+                f"{self.ticket_service_url}/tickets/pending/",
+                params={"limit": limit},
+                timeout=10
+            )
             if response.status_code == 200:
-                tickets = response.json()
-                # Ordenar por fecha de creación (más antiguo primero)
-                tickets.sort(key=lambda x: x.get('created_at', ''))
-                return tickets
+                return response.json()
             return []
         except Exception as e:
             logger.error("Error obteniendo tickets pendientes", error=str(e))
@@ -55,78 +167,79 @@ class AutoTicketProcessor:
     
     def get_pending_tickets_count(self) -> int:
         """Obtener cantidad de tickets pendientes"""
-        tickets = self.get_pending_tickets()
-        return len(tickets)
+        try:
+            response = requests.get(f"{self.ticket_service_url}/tickets/pending/count", timeout=10)
+            if response.status_code == 200:
+                return response.json().get('count', 0)
+            return 0
+        except Exception as e:
+            logger.error("Error obteniendo número de tickets pendientes", error=str(e))
+            return 0
     
-    def get_market_stores(self) -> List[str]:
-        """Obtener lista de tiendas del mercado desde el ticket service"""
+    def claim_tickets(self, batch_size: int) -> List[Dict]:
+        """Reclamar un lote de tickets pendientes para este worker"""
         try:
-            response = requests.get(f"{self.ticket_service_url}/market-stores/", timeout=10)
+            response = requests.post(
+                f"{self.ticket_service_url}/tickets/claim/",
+                json={
+                    "worker_id": self.worker_id,
+                    "batch_size": batch_size,
+                    "lease_seconds": self.lease_seconds,
+                    "priority_weights": self.scheduler.weights,
+                    "default_priority": self.scheduler.default_priority,
+                    "max_age_seconds": self.scheduler.max_age_seconds
+                },
+                timeout=10
+            )
             if response.status_code == 200:
-                stores = response.json()
-                return [store.get('name', '') for store in stores if store.get('is_active', True)]
+                data = response.json()
+                self.next_retry_at = self.parse_timestamp(data.get('next_attempt_at'))
+                return data.get('tickets', [])
+            logger.warning("No se pudieron reclamar tickets", status_code=response.status_code)
             return []
         except Exception as e:
-            logger.error("Error obteniendo tiendas del mercado", error=str(e))
+            logger.error("Error reclamando tickets", error=str(e))
             return []
     
-    def is_market_store(self, store_name: str) -> bool:
-        """Verificar si una tienda es del mercado"""
-        if not store_name:
-            return False
-        
-        market_stores = self.get_market_stores()
-        if not market_stores:
-            logger.warning("No se pudieron obtener las tiendas del mercado")
-            return False
-        
-        # Verificar si el nombre de la tienda contiene alguna de las tiendas del mercado
-        store_name_lower = store_name.lower()
-        for market_store in market_stores:
-            if market_store.lower() in store_name_lower:
-                return True
+    def release_ticket(self, ticket_id: str, error: Optional[str] = None, retry_after: Optional[float] = None):
+        """
+        Devolver a pendiente un ticket reclamado que no se ha podido procesar
         
-        return False
-    
-    def check_duplicate_before_processing(self, ticket: Dict, ai_result: Dict) -> bool:
-        """Verificar si el ticket es un duplicado antes de procesarlo"""
+        Con `error` el ticket service cuenta el intento y programa el reintento
+        con backoff; con `retry_after` solo lo aplaza.
+        """
         try:
-            # Extraer información del resultado de la IA
-            fecha = ai_result.get('fecha', '')
-            productos = ai_result.get('productos', [])
-            user_id = ticket.get('user_id', '')
-            
-            if not fecha or not productos or not user_id:
-                print(f"      ⚠️ Información insuficiente para verificar duplicados")
-                return False
-            
-            # Llamar al endpoint de verificación de duplicados
-            response = requests.post(
-                f"{self.ticket_service_url}/check-duplicate",
-                json={
-                    "user_id": user_id,
-                    "fecha": fecha,
-                    "productos": productos
-                },
-                timeout=30
+            requests.post(
+                f"{self.ticket_service_url}/tickets/{ticket_id}/release/",
+                json={"worker_id": self.worker_id, "error": error, "retry_after": retry_after},
+                timeout=10
             )
-            
+        except Exception as e:
+            # Si falla, el lease caduca y otro worker lo recupera
+            logger.warning("Error liberando ticket", error=str(e), ticket_id=ticket_id)
+    
+    def get_ticket_image(self, ticket_id: str) -> Optional[bytes]:
+        """Descargar la imagen de un ticket en binario desde el ticket service"""
+        try:
+            response = requests.get(f"{self.ticket_service_url}/tickets/{ticket_id}/image", timeout=30)
             if response.status_code == 200:
-                result = response.json()
-                if result.get('is_duplicate', False):
-                    print(f"      ⚠️ Ticket duplicado detectado: {result.get('reason', '')}")
-                    return True
-                else:
-                    print(f"      ✅ No es duplicado: {result.get('reason', '')}")
-                    return False
-            else:
-                print(f"      ⚠️ Error verificando duplicados: {response.status_code}")
-                return False
-                
+                return response.content
+            logger.warning("No se pudo obtener la imagen del ticket",
+                          ticket_id=ticket_id,
+                          status_code=response.status_code)
+            return None
         except Exception as e:
-            print(f"      ⚠️ Error verificando duplicados: {str(e)}")
-            return False
-
+            logger.error("Error obteniendo imagen del ticket", error=str(e), ticket_id=ticket_id)
+            return None
+    
+    def get_market_stores(self) -> List[str]:
+        """Tiendas del mercado (caché compartida con el sistema de IA)"""
+        return self.store_matcher.names
+    
+    def is_market_store(self, store_name: str) -> bool:
+        """Verificar si una tienda es del mercado"""
+        return self.store_matcher.matches(store_name)
+    
     def process_single_ticket(self, ticket: Dict) -> Dict:
         """Procesar un ticket individual"""
         ticket_id = ticket.get('id')
@@ -138,78 +251,216 @@ class AutoTicketProcessor:
             # Primero, procesar con IA para extraer información
             print(f"      🤖 Procesando con IA para extraer información...")
             
-            # Obtener la imagen en base64 del ticket
-            image_base64 = ticket.get('image_base64', '')
-            print(f"      📁 Imagen en base64: {'Sí' if image_base64 else 'No'}")
-            if not image_base64:
-                print(f"      ❌ No se encontró la imagen en base64")
-                return {"success": False, "ticket_id": ticket_id, "error": "No se encontró la imagen en base64"}
+            # Obtener la imagen del ticket en binario
+            image_bytes = self.get_ticket_image(ticket_id)
+            if not image_bytes:
+                print(f"      ❌ No se encontró la imagen del ticket")
+                self.release_ticket(ticket_id, error="No se encontró la imagen del ticket")
+                return {"success": False, "ticket_id": ticket_id, "error": "No se encontró la imagen del ticket"}
             
-            print(f"      ✅ Imagen obtenida correctamente ({len(image_base64)} caracteres)")
+            print(f"      ✅ Imagen obtenida correctamente ({len(image_bytes)} bytes)")
             
-            # Procesar con IA
+            # Procesar con IA (transporte binario, metadatos en cabeceras)
             print(f"      🤖 Enviando a IA para procesamiento...")
             ai_response = requests.post(
                 f"http://ai-ticket-processor:8004/process-ticket-api",
-                json={
-                    "image_base64": image_base64,
-                    "market_stores": self.get_market_stores()
+                data=image_bytes,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "X-User-Id": str(ticket.get('user_id', '')),
+                    "X-Ticket-Id": str(ticket_id),
+                    OUTCOME_REPORTED_HEADER: "true"
                 },
                 timeout=60
             )
             print(f"      📡 Respuesta de IA: {ai_response.status_code}")
             
+            if ai_response.status_code == 503:
+                # Gemini degradado: el ticket vuelve a pendiente y se deja de enviar trabajo un tiempo
+                retry_after = self.parse_retry_after(ai_response)
+                self.pause_processing(retry_after)
+                record_ticket_outcome('deferred')
+                print(f"      ⏸️ Gemini no disponible, ticket devuelto a pendiente (reintento en {retry_after:.0f}s)")
+                self.release_ticket(ticket_id, retry_after=retry_after)
+                return {"success": False, "ticket_id": ticket_id, "error": "Gemini no disponible", "retry_after": retry_after}
+            
             if ai_response.status_code != 200:
                 error_msg = f"Error procesando con IA: {ai_response.status_code}"
+                record_ticket_outcome('failed')
                 print(f"      ❌ {error_msg}")
+                self.release_ticket(ticket_id, error=error_msg)
                 return {"success": False, "ticket_id": ticket_id, "error": error_msg}
             
             ai_result = ai_response.json()
             print(f"      ✅ IA procesó correctamente - Fecha: {ai_result.get('fecha', 'N/A')}, Productos: {len(ai_result.get('productos', []))}")
             
-            # Verificar si es un duplicado antes de procesar
-            if self.check_duplicate_before_processing(ticket, ai_result):
-                # Si es duplicado, marcar el ticket como duplicado directamente
-                print(f"      ⚠️ Ticket duplicado detectado, marcando como duplicado...")
-                duplicate_response = requests.patch(
-                    f"{self.ticket_service_url}/tickets/{ticket_id}/mark-duplicate",
-                    json={
-                        "processing_result": ai_result,
-                        "status_message": "Ticket duplicado detectado"
-                    },
-                    timeout=30
-                )
-                
-                if duplicate_response.status_code == 200:
-                    print(f"      ✅ Ticket marcado como duplicado")
-                    return {"success": True, "ticket_id": ticket_id, "result": {"ticket_status": "duplicate"}}
-                else:
-                    print(f"      ❌ Error marcando como duplicado: {duplicate_response.status_code}")
-                    return {"success": False, "ticket_id": ticket_id, "error": "Error marcando como duplicado"}
-            
-            # Si no es duplicado, procesar normalmente
-            print(f"      ✅ No es duplicado, procesando normalmente...")
+            # Guardar el resultado firmado en el ticket service: la detección de
+            # duplicados se hace allí y no se vuelve a llamar a Gemini
+            signature = ai_result.get('result_signature')
+            if not signature:
+                print(f"      ⚠️ Resultado sin firma, el ticket service volverá a procesar la imagen")
             response = requests.post(
                 f"{self.ticket_service_url}/tickets/{ticket_id}/process/",
+                json={
+                    "processing_result": ai_result,
+                    "signature": signature,
+                    "worker_id": self.worker_id
+                },
                 timeout=120  # 2 minutos de timeout por ticket
             )
             
             if response.status_code == 200:
                 result = response.json()
+                # Estado final, después de la detección de duplicados del ticket service
+                record_ticket_outcome((result.get('processing_result') or {}).get('ticket_status'))
+                if result.get('retry_scheduled') or result.get('ticket', {}).get('status') == 'dead_letter':
+                    print(f"      🔁 {result.get('message')}")
+                    return {"success": False, "ticket_id": ticket_id, "error": result.get('message'), "result": result}
                 print(f"      ✅ Procesado exitosamente")
                 return {"success": True, "ticket_id": ticket_id, "result": result}
             else:
                 error_msg = f"Error procesando ticket {ticket_id}: {response.status_code}"
+                record_ticket_outcome('deferred' if response.status_code == 503 else 'failed')
                 print(f"      ❌ {error_msg}")
+                # Devolver el ticket en lugar de esperar a que caduque el lease
+                # (con 409 lo tiene otro worker y no hay nada que liberar)
+                if response.status_code == 503:
+                    self.release_ticket(ticket_id, retry_after=self.parse_retry_after(response))
+                elif response.status_code != 409:
+                    self.release_ticket(ticket_id, error=error_msg)
                 return {"success": False, "ticket_id": ticket_id, "error": error_msg}
                 
         except Exception as e:
             error_msg = f"Error procesando ticket {ticket_id}: {str(e)}"
             print(f"      💥 {error_msg}")
+            self.release_ticket(ticket_id, error=error_msg)
             return {"success": False, "ticket_id": ticket_id, "error": error_msg}
     
+    @staticmethod
+    def parse_retry_after(response, default: float = 30.0) -> float:
+        """Leer la cabecera Retry-After de una respuesta 503"""
+        try:
+            return float(response.headers.get('Retry-After', default))
+        except (TypeError, ValueError):
+            return default
+    
+    @staticmethod
+    def parse_timestamp(value: Optional[str]) -> Optional[float]:
+        """Convertir una fecha ISO del ticket service a epoch"""
+        if not value:
+            return None
+        try:
+            return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return None
+    
+    def next_wakeup(self) -> float:
+        """Segundos hasta la próxima comprobación: fin de la pausa, próximo reintento o barrido"""
+        if self.pause_remaining() > 0:
+            return self.pause_remaining()
+        timeout = self.processing_interval
+        if self.next_retry_at and self.next_retry_at > time.time():
+            # Margen de 1s por la diferencia de reloj con la base de datos
+            timeout = min(timeout, self.next_retry_at - time.time() + 1)
+        return timeout
+    
+    def pause_processing(self, seconds: float):
+        """Dejar de enviar tickets a la IA durante `seconds` segundos"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        logger.warning("Procesamiento pausado por Gemini no disponible", seconds=seconds)
+    
+    def pause_remaining(self) -> float:
+        """Segundos que quedan de pausa (0 si no está pausado)"""
+        return max(0.0, self.paused_until - time.monotonic())
+    
+    def process_next_ticket(self) -> Dict:
+        """
+        Esperar cuota de Gemini y procesar el ticket más prioritario (se ejecuta en un worker)
+        
+        El ticket se elige cuando hay cuota, de modo que una subida interactiva
+        que llega mientras se espera pasa por delante del backfill. La cuota la
+        consume el cliente de Gemini en cada petición que hace el ticket.
+        """
+        if self.pause_remaining() > 0:
+            # Ticket reclamado antes de la pausa: devolverlo sin gastar una llamada
+            ticket = self.scheduler.pop()
+            if ticket is None:
+                return {"success": False, "error": "Cola vacía"}
+            self.release_ticket(ticket.get('id'))
+            self.metrics.deferred()
+            with self._queued_lock:
+                self.queued_ids.discard(ticket.get('id'))
+            return {"success": False, "ticket_id": ticket.get('id'), "error": "Procesamiento pausado"}
+        
+        self.gemini_quota.wait_available()
+        
+        ticket = self.scheduler.pop()
+        if ticket is None:
+            return {"success": False, "error": "Cola vacía"}
+        
+        self.metrics.started()
+        start = time.monotonic()
+        result = {"success": False, "ticket_id": ticket.get('id')}
+        try:
+            result = self.process_single_ticket(ticket)
+            return result
+        finally:
+            self.metrics.finished(result.get('success', False), time.monotonic() - start, deferred='retry_after' in result)
+            with self._queued_lock:
+                self.queued_ids.discard(ticket.get('id'))
+            # El último lote venía lleno: reclamar más en cuanto haya hueco
+            if self.more_pending and self.is_running:
+                self.wake_event.set()
+    
+    def notify_new_ticket(self, ticket_id: Optional[str] = None):
+        """Despertar el bucle de procesamiento (llamado al recibir un NOTIFY)"""
+        logger.info("Ticket pendiente notificado", ticket_id=ticket_id)
+        self.wake_event.set()
+    
+    def dispatch_pending_tickets(self) -> List:
+        """
+        Reclamar tickets pendientes y encolarlos en el pool
+        
+        Solo se reclaman tantos tickets como huecos hay en la cola local, para
+        que los leases no caduquen mientras esperan turno y el resto de
+        réplicas pueda repartirse la carga.
+        
+        Returns:
+            Lista de futures de los tickets encolados
+        """
+        if self.pause_remaining() > 0:
+            print(f"   ⏸️ Procesamiento pausado {self.pause_remaining():.0f}s más (Gemini no disponible)")
+            return []
+        
+        with self._queued_lock:
+            free_slots = self.claim_batch_size - len(self.queued_ids)
+        if free_slots <= 0:
+            # Cola local llena: volver a reclamar cuando un worker termine
+            self.more_pending = True
+            return []
+        
+        # Reclamar tickets (los de mayor prioridad con envejecimiento) de forma atómica en el ticket service
+        claimed_tickets = self.claim_tickets(free_slots)
+        self.more_pending = len(claimed_tickets) == free_slots
+        print(f"   📋 Tickets reclamados: {len(claimed_tickets)}")
+        
+        # Descartar los que ya están en cola o en proceso en este procesador
+        with self._queued_lock:
+            new_tickets = [ticket for ticket in claimed_tickets if ticket.get('id') not in self.queued_ids]
+            self.queued_ids.update(ticket.get('id') for ticket in new_tickets)
+        
+        if not new_tickets:
+            return []
+        
+        # Encolar en el planificador; cada worker saca el más prioritario cuando
+        # el token bucket le da paso
+        self.metrics.enqueued(len(new_tickets))
+        for ticket in new_tickets:
+            self.scheduler.push(ticket)
+        return [self.executor.submit(self.process_next_ticket) for _ in new_tickets]
+    
     def process_pending_tickets(self) -> Dict:
-        """Procesar tickets pendientes uno por uno en orden de llegada"""
+        """Procesar tickets pendientes en paralelo con el pool de workers y esperar el resultado"""
         print(f"\n🔄 PROCESAMIENTO AUTOMÁTICO - {datetime.now().strftime('%H:%M:%S')}")
         
         try:
@@ -218,42 +469,36 @@ class AutoTicketProcessor:
                 print("   ⚠️ Ticket service no disponible, saltando procesamiento")
                 return {"error": "Ticket service no disponible"}
             
-            # Obtener tickets pendientes ordenados
-            pending_tickets = self.get_pending_tickets()
-            print(f"   📋 Tickets pendientes encontrados: {len(pending_tickets)}")
+            futures = self.dispatch_pending_tickets()
             
-            if not pending_tickets:
+            if not futures:
                 print("   ✅ No hay tickets pendientes")
                 return {"message": "No hay tickets pendientes"}
             
-            # Procesar tickets uno por uno
             processed_count = 0
             failed_count = 0
             results = []
             
-            for ticket in pending_tickets:
-                result = self.process_single_ticket(ticket)
+            for future in futures:
+                result = future.result()
                 results.append(result)
                 
                 if result.get('success'):
                     processed_count += 1
                 else:
                     failed_count += 1
-                
-                # Pequeña pausa entre tickets para no sobrecargar
-                time.sleep(2)
             
             print(f"   📊 RESUMEN:")
             print(f"      Total procesados: {processed_count}")
             print(f"      Fallidos: {failed_count}")
             
             logger.info("Procesamiento automático completado", 
-                       total=len(pending_tickets),
+                       total=len(futures),
                        processed=processed_count,
                        failed=failed_count)
             
             return {
-                "total_tickets": len(pending_tickets),
+                "total_tickets": len(futures),
                 "processed_count": processed_count,
                 "failed_count": failed_count,
                 "results": results
@@ -273,31 +518,39 @@ class AutoTicketProcessor:
         
         print("🚀 Iniciando procesador automático continuo...")
         
-        # Procesar inmediatamente al iniciar
-        print("🔄 Procesamiento inicial...")
-        self.process_pending_tickets()
-        
         self.is_running = True
         
+        # Procesar inmediatamente al iniciar (dentro del hilo, sin bloquear el arranque)
+        self.wake_event.set()
+        
+        if self.listener:
+            self.listener.start()
+        
         # Ejecutar procesador en un hilo separado
         def run_processor():
             while self.is_running:
                 try:
-                    # Verificar si hay tickets pendientes
-                    pending_tickets = self.get_pending_tickets()
-                    if pending_tickets:
-                        print(f"🔄 Encontrados {len(pending_tickets)} tickets pendientes, procesando...")
-                        self.process_pending_tickets()
+                    # Esperar a una notificación, al próximo reintento programado o al barrido de seguridad
+                    timeout = self.next_wakeup()
+                    woken = self.wake_event.wait(timeout=timeout)
+                    self.wake_event.clear()
+                    if not self.is_running:
+                        break
+                    
+                    if not woken and timeout >= self.processing_interval:
+                        print("🧹 Barrido de seguridad de tickets pendientes...")
+                    
+                    # Encolar sin esperar: los workers procesan mientras se atienden nuevas notificaciones
+                    futures = self.dispatch_pending_tickets()
+                    if futures:
+                        print(f"🔄 Encolados {len(futures)} tickets pendientes")
                     else:
                         print("⏳ No hay tickets pendientes, esperando...")
                     
-                    # Esperar antes de la siguiente verificación
-                    time.sleep(self.processing_interval)
-                    
                 except Exception as e:
                     print(f"💥 Error en procesador automático: {str(e)}")
                     logger.error("Error en procesador automático", error=str(e))
-                    time.sleep(self.processing_interval)
+                    time.sleep(5)
         
         self.thread = threading.Thread(target=run_processor, daemon=True)
         self.thread.start()
@@ -312,6 +565,10 @@ class AutoTicketProcessor:
         
         print("🛑 Deteniendo procesador automático...")
         self.is_running = False
+        self.wake_event.set()
+        
+        if self.listener:
+            self.listener.stop()
         
         if self.thread:
             self.thread.join(timeout=5)
@@ -325,7 +582,17 @@ class AutoTicketProcessor:
             "is_running": self.is_running,
             "ticket_service_url": self.ticket_service_url,
             "last_check": datetime.now().isoformat(),
-            "pending_tickets": self.get_pending_tickets_count() if self.check_ticket_service_health() else "N/A"
+            "pending_tickets": self.get_pending_tickets_count() if self.check_ticket_service_health() else "N/A",
+            "workers": self.max_workers,
+            "worker_id": self.worker_id,
+            "lease_seconds": self.lease_seconds,
+            "paused_seconds": round(self.pause_remaining(), 1),
+            "sweep_interval_seconds": self.processing_interval,
+            "next_retry_in_seconds": round(self.next_retry_at - time.time(), 1) if self.next_retry_at else None,
+            "listener": self.listener.get_stats() if self.listener else None,
+            "metrics": self.metrics.snapshot(),
+            "scheduler": self.scheduler.get_stats(),
+            "rate_limits": self.gemini_quota.get_stats()
         }
 
 # Instancia global
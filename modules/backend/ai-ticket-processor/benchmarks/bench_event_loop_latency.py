@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark de latencia del event loop: p99 de /health y de peticiones pequeñas
+mientras el AI processor procesa lotes de imágenes grandes
+
+Uso:
+    # Terminal 1: Gemini simulado y AI processor apuntando a él
+    python stub_gemini_server.py --port 8090 --latency-ms 800
+    GEMINI_API_KEY=stub GEMINI_API_BASE=http://localhost:8090 PORT=8004 python main.py
+
+    # Terminal 2
+    python benchmarks/bench_event_loop_latency.py images/ --url http://localhost:8004
+
+Para comparar, repetir con IMAGE_WORKER_PROCESSES=0 (todo el trabajo de
+imagen en hilos del proceso principal) y con el valor por defecto.
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_image_preprocessing import load_images, percentile  # noqa: E402
+
+
+def synthetic_image(megapixels: float) -> bytes:
+    """Imagen JPEG con ruido (se comprime mal, como una foto real)"""
+    from PIL import Image
+
+    side = int((megapixels * 1e6) ** 0.5)
+    image = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=92)
+    return buffer.getvalue()
+
+
+async def probe(client, path, stop, latencies, interval):
+    """Medir la latencia de una petición pequeña repetida hasta `stop`"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            await client.get(path)
+            latencies.append((time.perf_counter() - start) * 1000)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def load(client, images, concurrency, rounds):
+    """Enviar las imágenes a /process-ticket-api con `concurrency` peticiones en paralelo"""
+    semaphore = asyncio.Semaphore(concurrency)
+    # Un byte distinto al final evita la caché y la agrupación por hash
+    counter = iter(range(1_000_000))
+
+    async def send(image_bytes):
+        async with semaphore:
+            body = image_bytes + next(counter).to_bytes(4, 'big')
+            await client.post(
+                '/process-ticket-api',
+                content=body,
+                headers={'Content-Type': 'application/octet-stream', 'X-Market-Stores': '[]'},
+                timeout=120
+            )
+
+    await asyncio.gather(*[send(image) for _ in range(rounds) for _, image in images])
+
+
+async def measure(url, images, concurrency, rounds, interval, duration_idle):
+    async with httpx.AsyncClient(base_url=url, timeout=10) as client:
+        health = await client.get('/health')
+        print(f"Servidor: {health.json().get('image_workers')}")
+
+        # Línea base sin carga
+        stop = asyncio.Event()
+        idle = []
+        probe_task = asyncio.create_task(probe(client, '/health', stop, idle, interval))
+        await asyncio.sleep(duration_idle)
+        stop.set()
+        await probe_task
+
+        # Con carga de imágenes grandes
+        stop = asyncio.Event()
+        loaded_health, loaded_small = [], []
+        probes = [
+            asyncio.create_task(probe(client, '/health', stop, loaded_health, interval)),
+            asyncio.create_task(probe(client, '/', stop, loaded_small, interval)),
+        ]
+        start = time.perf_counter()
+        await load(client, images, concurrency, rounds)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*probes)
+
+    total = len(images) * rounds
+    print(f"\nCarga: {total} imágenes en {elapsed:.1f}s ({total / elapsed:.1f} img/s, concurrencia {concurrency})")
+    print(f"{'':18}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, values in (("/health sin carga", idle), ("/health con carga", loaded_health), ("/ con carga", loaded_small)):
+        if values:
+            print(f"{name:18}{len(values):>6}{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}"
+                  f"{percentile(values, 99):>10.1f}{max(values):>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='Directorio con imágenes de tickets (por defecto imágenes sintéticas)')
+    parser.add_argument('--url', default='http://localhost:8004')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=3, help='Veces que se envía cada imagen')
+    parser.add_argument('--synthetic', type=int, default=8, help='Imágenes sintéticas si no se indica directorio')
+    parser.add_argument('--megapixels', type=float, default=12.0)
+    parser.add_argument('--interval', type=float, default=0.02, help='Segundos entre sondas')
+    parser.add_argument('--idle-seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    if args.path:
+        images = load_images(args.path)
+    else:
+        images = [(f"synthetic_{i}.jpg", synthetic_image(args.megapixels)) for i in range(args.synthetic)]
+    if not images:
+        print("No se encontraron imágenes")
+        return 1
+
+    size_mb = sum(len(image) for _, image in images) / 1e6
+    print(f"Imágenes: {len(images)} ({size_mb:.1f} MB)")
+    asyncio.run(measure(args.url, images, args.concurrency, args.rounds, args.interval, args.idle_seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark de las peticiones de cobertura (hedging) a Gemini: latencia por
+ticket y peticiones extra con y sin cobertura
+
+Uso:
+    # Terminal 1: Gemini simulado con cola de latencia (2% de peticiones a 20s)
+    python stub_gemini_server.py --port 8090 --latency-ms 3000 --tail-rate 0.02 --tail-latency-ms 20000
+
+    # Terminal 2
+    python benchmarks/bench_hedging.py --url http://localhost:8090 --requests 300
+
+Cada modo envía las mismas peticiones con AsyncGeminiClient; las peticiones
+extra se cuentan con /stats del stub.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_image_preprocessing import percentile  # noqa: E402
+from gemini_client import AsyncGeminiClient  # noqa: E402
+from hedging import HedgePolicy, LatencyTracker  # noqa: E402
+from rate_limiter import GeminiQuota  # noqa: E402
+
+PAYLOAD = {"contents": [{"parts": [{"text": "Analiza este ticket"}]}]}
+
+
+async def stub_requests(url: str) -> int:
+    async with httpx.AsyncClient(base_url=url) as client:
+        return (await client.get('/stats')).json()['requests']
+
+
+async def run_mode(url, model, hedged, total, concurrency, warmup):
+    policy = HedgePolicy(enabled=hedged, tracker=LatencyTracker(min_samples=warmup))
+    client = AsyncGeminiClient(
+        'stub',
+        f"{url}/v1beta/models/{model}:generateContent",
+        max_concurrency=concurrency * 2,  # hueco para las peticiones de cobertura
+        max_retries=0,
+        hedge_policy=policy,
+        quota=GeminiQuota(requests_per_minute=1e9, tokens_per_minute=1e12)  # sin límite contra el stub
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with semaphore:
+            start = time.perf_counter()
+            await client.generate_content(PAYLOAD)
+            return time.perf_counter() - start
+
+    try:
+        # Calentamiento: llenar la ventana de latencias antes de medir
+        await asyncio.gather(*[call() for _ in range(warmup)])
+        before = await stub_requests(url)
+        latencies = await asyncio.gather(*[call() for _ in range(total)])
+        extra = await stub_requests(url) - before - total
+    finally:
+        await client.aclose()
+
+    return latencies, extra, policy.get_stats()
+
+
+async def measure(args):
+    rows = []
+    for hedged in (False, True):
+        latencies, extra, stats = await run_mode(
+            args.url, args.model, hedged, args.requests, args.concurrency, args.warmup
+        )
+        rows.append(("con cobertura" if hedged else "sin cobertura", latencies, extra, stats))
+
+    print(f"\n{'':15}{'n':>6}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'max s':>9}{'extra':>8}")
+    for name, latencies, extra, _ in rows:
+        print(f"{name:15}{len(latencies):>6}{percentile(latencies, 50):>9.2f}{percentile(latencies, 95):>9.2f}"
+              f"{percentile(latencies, 99):>9.2f}{max(latencies):>9.2f}"
+              f"{extra / len(latencies):>7.1%}")
+    print(f"\nCobertura: {rows[1][3]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8090')
+    parser.add_argument('--model', default='gemini-2.0-flash')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=50, help='Peticiones para estimar el percentil antes de medir')
+    args = parser.parse_args()
+
+    asyncio.run(measure(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Benchmark del preprocesado de imágenes: bytes enviados y latencia antes/después
+
+Uso:
+    python benchmarks/bench_image_preprocessing.py images/
+    python benchmarks/bench_image_preprocessing.py images/ --gemini   # requiere GEMINI_API_KEY
+
+Sin --gemini solo mide el tamaño del payload y el coste del preprocesado.
+Con --gemini envía cada ticket dos veces (original y normalizado), mide la
+latencia extremo a extremo y compara los campos extraídos para detectar
+pérdidas de precisión.
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_preprocessing import ImagePreprocessor  # noqa: E402
+
+COMPARED_FIELDS = ['fecha', 'hora', 'tienda', 'total']
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+def percentile(values, pct):
+    """Percentil simple por interpolación al vecino más cercano"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_images(path):
+    """Cargar las imágenes de un directorio (o un único fichero)"""
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        )
+    images = []
+    for image_path in paths:
+        with open(image_path, 'rb') as f:
+            images.append((os.path.basename(image_path), f.read()))
+    return images
+
+
+async def extract(ai, image_bytes, mime_type):
+    """Llamar a Gemini y devolver (datos parseados, latencia en segundos)"""
+    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    start = time.perf_counter()
+    response = await ai.call_gemini_api(image_base64, mime_type)
+    elapsed = time.perf_counter() - start
+    return ai.parse_gemini_response(response), elapsed
+
+
+async def run_gemini_comparison(images, preprocessor):
+    """Comparar latencia y campos extraídos entre imagen original y normalizada"""
+    from ai_system import GeminiTicketAI
+
+    ai = GeminiTicketAI()
+    raw_latencies, norm_latencies = [], []
+    field_matches = {field: 0 for field in COMPARED_FIELDS}
+    product_matches = 0
+
+    try:
+        for name, image_bytes in images:
+            normalized, mime_type = preprocessor.normalize(image_bytes)
+            raw_data, raw_elapsed = await extract(ai, image_bytes, 'image/jpeg')
+            norm_data, norm_elapsed = await extract(ai, normalized, mime_type)
+            raw_latencies.append(raw_elapsed)
+            norm_latencies.append(norm_elapsed)
+
+            diffs = []
+            for field in COMPARED_FIELDS:
+                if str(raw_data.get(field)) == str(norm_data.get(field)):
+                    field_matches[field] += 1
+                else:
+                    diffs.append(f"{field}: {raw_data.get(field)!r} -> {norm_data.get(field)!r}")
+            if len(raw_data.get('productos') or []) == len(norm_data.get('productos') or []):
+                product_matches += 1
+            else:
+                diffs.append("num_productos distinto")
+
+            print(f"  {name}: {raw_elapsed:.2f}s -> {norm_elapsed:.2f}s {'OK' if not diffs else '; '.join(diffs)}")
+    finally:
+        await ai.aclose()
+
+    total = len(images)
+    print("\nLatencia Gemini (original -> normalizada):")
+    print(f"  p50: {percentile(raw_latencies, 50):.2f}s -> {percentile(norm_latencies, 50):.2f}s")
+    print(f"  p95: {percentile(raw_latencies, 95):.2f}s -> {percentile(norm_latencies, 95):.2f}s")
+    print("\nCoincidencia de campos extraídos:")
+    for field in COMPARED_FIELDS:
+        print(f"  {field}: {field_matches[field]}/{total}")
+    print(f"  num_productos: {product_matches}/{total}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='Directorio con imágenes de tickets o una imagen')
+    parser.add_argument('--max-side', type=int, default=None)
+    parser.add_argument('--quality', type=int, default=None)
+    parser.add_argument('--format', dest='output_format', default=None, choices=['JPEG', 'WEBP'])
+    parser.add_argument('--color', action='store_true', help='No convertir a escala de grises')
+    parser.add_argument('--gemini', action='store_true', help='Medir también la latencia y precisión con Gemini')
+    args = parser.parse_args()
+
+    preprocessor = ImagePreprocessor(
+        enabled=True,
+        max_side=args.max_side,
+        grayscale=False if args.color else None,
+        output_format=args.output_format,
+        quality=args.quality,
+    )
+    images = load_images(args.path)
+    if not images:
+        print("No se encontraron imágenes")
+        return 1
+
+    print(f"Configuración: {preprocessor.get_config()}")
+    print(f"Imágenes: {len(images)}\n")
+
+    raw_sizes, norm_sizes, timings = [], [], []
+    for name, image_bytes in images:
+        start = time.perf_counter()
+        normalized, mime_type = preprocessor.normalize(image_bytes)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        raw_sizes.append(len(base64.b64encode(image_bytes)))
+        norm_sizes.append(len(base64.b64encode(normalized)))
+        timings.append(elapsed_ms)
+        print(f"  {name}: {len(image_bytes)} -> {len(normalized)} bytes ({mime_type}) en {elapsed_ms:.1f} ms")
+
+    total_raw, total_norm = sum(raw_sizes), sum(norm_sizes)
+    print("\nPayload base64 enviado a Gemini:")
+    print(f"  total: {total_raw / 1e6:.2f} MB -> {total_norm / 1e6:.2f} MB ({100 * (1 - total_norm / total_raw):.1f}% menos)")
+    print(f"  media por ticket: {statistics.mean(raw_sizes) / 1e3:.0f} KB -> {statistics.mean(norm_sizes) / 1e3:.0f} KB")
+    print(f"Coste del preprocesado: p50 {percentile(timings, 50):.1f} ms, p95 {percentile(timings, 95):.1f} ms")
+
+    if args.gemini:
+        print("\nComparando extracción con Gemini...")
+        asyncio.run(run_gemini_comparison(images, preprocessor))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark del recorte del ticket: bytes enviados, coste del preprocesado y
+latencia de extracción con y sin recorte
+
+Uso:
+    python benchmarks/bench_receipt_crop.py images/
+    python benchmarks/bench_receipt_crop.py --synthetic 20         # fotos sintéticas
+    python benchmarks/bench_receipt_crop.py images/ --gemini       # requiere GEMINI_API_KEY
+
+Con --gemini (o GEMINI_API_BASE apuntando a stub_gemini_server.py) envía
+cada ticket normalizado con y sin recorte y compara latencia y campos.
+Requiere opencv-python-headless.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_image_preprocessing import COMPARED_FIELDS, extract, load_images, percentile  # noqa: E402
+from image_preprocessing import ImagePreprocessor  # noqa: E402
+
+
+def synthetic_photo(seed: int, width: int = 3000, height: int = 4000) -> bytes:
+    """Foto simulada: ticket blanco con texto, girado, sobre una mesa con textura"""
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = random.Random(seed)
+    background = Image.effect_noise((width, height), 40).convert('RGB')
+    background = Image.blend(background, Image.new('RGB', (width, height), (110, 80, 55)), 0.7)
+
+    receipt_w, receipt_h = int(width * rng.uniform(0.35, 0.5)), int(height * rng.uniform(0.5, 0.7))
+    receipt = Image.new('RGB', (receipt_w, receipt_h), (245, 245, 240))
+    draw = ImageDraw.Draw(receipt)
+    for line in range(40, receipt_h - 40, 60):
+        draw.text((40, line), f"PRODUCTE {line // 60:02d} ........ {rng.uniform(0.5, 9.9):.2f} EUR", fill=(20, 20, 20))
+    receipt = receipt.rotate(rng.uniform(-12, 12), expand=True, fillcolor=(0, 0, 0))
+
+    mask = receipt.convert('L').point(lambda value: 255 if value > 0 else 0)
+    x = rng.randint(0, width - receipt.width)
+    y = rng.randint(0, height - receipt.height)
+    background.paste(receipt, (x, y), mask)
+
+    buffer = io.BytesIO()
+    background.filter(ImageFilter.GaussianBlur(1)).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+async def run_gemini_comparison(images, plain, cropped):
+    """Latencia de extracción y campos con la imagen completa y recortada"""
+    from ai_system import GeminiTicketAI
+
+    ai = GeminiTicketAI()
+    latencies = {"sin recorte": [], "con recorte": []}
+    matches = {field: 0 for field in COMPARED_FIELDS}
+    try:
+        for name, image_bytes in images:
+            plain_bytes, plain_mime = plain.normalize(image_bytes)
+            crop_bytes, crop_mime = cropped.normalize(image_bytes)
+            plain_data, plain_elapsed = await extract(ai, plain_bytes, plain_mime)
+            crop_data, crop_elapsed = await extract(ai, crop_bytes, crop_mime)
+            latencies["sin recorte"].append(plain_elapsed)
+            latencies["con recorte"].append(crop_elapsed)
+            for field in COMPARED_FIELDS:
+                matches[field] += str(plain_data.get(field)) == str(crop_data.get(field))
+            print(f"  {name}: {plain_elapsed:.2f}s -> {crop_elapsed:.2f}s")
+    finally:
+        await ai.aclose()
+
+    print("\nLatencia de extracción:")
+    for name, values in latencies.items():
+        print(f"  {name}: p50 {percentile(values, 50):.2f}s, p95 {percentile(values, 95):.2f}s")
+    print("Campos iguales con y sin recorte: " + ", ".join(f"{f} {matches[f]}/{len(images)}" for f in COMPARED_FIELDS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='Directorio con fotos de tickets o una imagen')
+    parser.add_argument('--synthetic', type=int, default=10, help='Fotos sintéticas si no se indica directorio')
+    parser.add_argument('--gemini', action='store_true', help='Medir también la latencia de extracción')
+    args = parser.parse_args()
+
+    plain = ImagePreprocessor(enabled=True, crop=False)
+    cropped = ImagePreprocessor(enabled=True, crop=True)
+    if not cropped.cropper.available:
+        print("opencv-python-headless no está instalado")
+        return 1
+
+    if args.path:
+        images = load_images(args.path)
+    else:
+        images = [(f"synthetic_{i}.jpg", synthetic_photo(i)) for i in range(args.synthetic)]
+    if not images:
+        print("No se encontraron imágenes")
+        return 1
+
+    print(f"Configuración: {cropped.get_config()}")
+    print(f"Imágenes: {len(images)}\n")
+
+    sizes = {"original": [], "sin recorte": [], "con recorte": []}
+    timings = {"sin recorte": [], "con recorte": []}
+    for name, image_bytes in images:
+        sizes["original"].append(len(base64.b64encode(image_bytes)))
+        for label, preprocessor in (("sin recorte", plain), ("con recorte", cropped)):
+            start = time.perf_counter()
+            normalized, _ = preprocessor.normalize(image_bytes)
+            timings[label].append((time.perf_counter() - start) * 1000)
+            sizes[label].append(len(base64.b64encode(normalized)))
+        print(f"  {name}: {sizes['sin recorte'][-1] / 1e3:.0f} KB -> {sizes['con recorte'][-1] / 1e3:.0f} KB base64")
+
+    print("\nPayload base64 enviado a Gemini:")
+    for label, values in sizes.items():
+        print(f"  {label:12} total {sum(values) / 1e6:.2f} MB, media {sum(values) / len(values) / 1e3:.0f} KB")
+    saved = 1 - sum(sizes["con recorte"]) / sum(sizes["sin recorte"])
+    print(f"  el recorte ahorra un {100 * saved:.1f}% sobre la imagen normalizada")
+    print("Coste del preprocesado:")
+    for label, values in timings.items():
+        print(f"  {label:12} p50 {percentile(values, 50):.1f} ms, p95 {percentile(values, 95):.1f} ms")
+
+    if args.gemini:
+        print("\nComparando extracción...")
+        asyncio.run(run_gemini_comparison(images, plain, cropped))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Replay offline del corpus de respuestas de Gemini: throughput, tasa de
+fallos de parseo y diferencias por campo entre versiones
+
+Uso:
+    # Grabar tráfico real: REPLAY_CORPUS_DIR=/app/cache/replay en el AI processor
+    python benchmarks/replay_benchmark.py /app/cache/replay --stores stores.json
+    python benchmarks/replay_benchmark.py corpus/ --save antes.jsonl.zst          # guardar resultados
+    python benchmarks/replay_benchmark.py corpus/ --baseline antes.jsonl.zst      # comparar con otra versión
+
+Cada respuesta grabada pasa por parse_gemini_response, la verificación de
+tienda del mercado y determine_ticket_status, sin red. Sin --baseline se
+compara con el resultado grabado en producción. --stores es un JSON con la
+lista de nombres de tiendas del mercado (GET /market-stores/); si no se
+indica se usan las tiendas aprobadas en el propio corpus.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Sin llamadas a Gemini ni efectos secundarios: solo se usa el parser
+os.environ.setdefault('GEMINI_API_KEY', 'replay')
+os.environ['EXTRACTION_CACHE_ENABLED'] = 'false'
+os.environ['PHASH_ENABLED'] = 'false'
+os.environ['REPLAY_CORPUS_DIR'] = ''
+os.environ.setdefault('IMAGE_WORKER_PROCESSES', '0')
+
+from ai_system import GeminiTicketAI, determine_ticket_status  # noqa: E402
+from replay_corpus import iter_records, write_records  # noqa: E402
+from store_matcher import StoreAutomaton  # noqa: E402
+
+COMPARED_FIELDS = ['fecha', 'hora', 'tienda', 'total', 'tipo_ticket', 'num_productos', 'productos',
+                   'es_tienda_mercado', 'ticket_status']
+
+
+def load_stores(path, records):
+    """Tiendas del mercado: fichero JSON o, si no hay, tiendas aprobadas en el corpus"""
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            stores = json.load(f)
+        return [store['name'] if isinstance(store, dict) else store for store in stores
+                if not isinstance(store, dict) or store.get('is_active', True)]
+    return sorted({
+        record['result']['tienda'] for record in records
+        if record['result'].get('es_tienda_mercado') and record['result'].get('tienda')
+    })
+
+
+def is_structured(request):
+    return (request.get('generationConfig') or {}).get('responseMimeType') == 'application/json'
+
+
+def replay(ai, record, stores):
+    """Reprocesar un registro del corpus con el código actual"""
+    ai.structured_output = is_structured(record['request'])
+    try:
+        parsed = ai.parse_gemini_response(record['response'])
+    except Exception as e:
+        return {'parse_error': str(e)[:200]}
+
+    es_tienda_mercado = stores.matches(parsed.get('tienda'))
+    ticket_status, _ = determine_ticket_status(parsed.get('procesado_correctamente', True), es_tienda_mercado)
+    return {
+        'fecha': parsed.get('fecha'),
+        'hora': parsed.get('hora'),
+        'tienda': parsed.get('tienda'),
+        'total': parsed.get('total'),
+        'tipo_ticket': parsed.get('tipo_ticket', 'otros'),
+        'productos': parsed.get('productos', []),
+        'es_tienda_mercado': es_tienda_mercado,
+        'ticket_status': ticket_status,
+    }
+
+
+def reextracted_fields(result):
+    """Campos del resultado grabado que vienen de una re-extracción"""
+    fields = set(result.get('campos_reextraidos') or [])
+    if 'productos' in fields:
+        fields.add('num_productos')
+    if 'tienda' in fields:
+        fields.update(('es_tienda_mercado', 'ticket_status'))
+    return fields
+
+
+def normalize(result, field):
+    if field == 'num_productos':
+        return len(result.get('productos') or [])
+    value = result.get(field)
+    if field == 'productos':
+        return [(p.get('cantidad'), p.get('nombre'), p.get('precio')) for p in value or []]
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', help='Fichero .jsonl.zst o directorio del corpus')
+    parser.add_argument('--stores', help='JSON con las tiendas del mercado')
+    parser.add_argument('--baseline', help='Resultados guardados con --save de otra versión')
+    parser.add_argument('--save', help='Guardar los resultados de esta versión (.jsonl.zst)')
+    parser.add_argument('--repeat', type=int, default=1, help='Repeticiones para medir el throughput')
+    parser.add_argument('--examples', type=int, default=5, help='Ejemplos de diferencias a mostrar por campo')
+    args = parser.parse_args()
+
+    records = list(iter_records(args.corpus))
+    if not records:
+        print("Corpus vacío")
+        return 1
+
+    stores = StoreAutomaton(load_stores(args.stores, records))
+    baseline = {record['image_hash']: record['result'] for record in records}
+    if args.baseline:
+        baseline = {record['image_hash']: record['result'] for record in iter_records(args.baseline)}
+
+    ai = GeminiTicketAI()
+    print(f"\nRegistros: {len(records)} - tiendas del mercado: {len(stores)}")
+
+    # Los prints del parser no cuentan en el throughput
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            results = [(record['image_hash'], replay(ai, record, stores)) for record in records]
+        elapsed = time.perf_counter() - start
+    total = len(records) * args.repeat
+
+    parse_errors = Counter(result['parse_error'] for _, result in results if 'parse_error' in result)
+    failures = sum(parse_errors.values())
+    print(f"Throughput: {total / elapsed:,.0f} tickets/s ({elapsed * 1000 / total:.3f} ms por ticket)")
+    print(f"Fallos de parseo: {failures}/{len(records)} ({100 * failures / len(records):.2f}%)")
+    for error, count in parse_errors.most_common(args.examples):
+        print(f"  {count}x {error}")
+
+    compared = [(image_hash, result, baseline[image_hash]) for image_hash, result in results
+                if 'parse_error' not in result and image_hash in baseline]
+    print(f"\nDiferencias por campo ({len(compared)} tickets comparados con "
+          f"{'--baseline' if args.baseline else 'el resultado grabado'}):")
+    for field in COMPARED_FIELDS:
+        # Los campos re-extraídos en producción salen de una segunda llamada que no se reproduce
+        diffs = [(image_hash, normalize(before, field), normalize(after, field))
+                 for image_hash, after, before in compared
+                 if normalize(before, field) != normalize(after, field)
+                 and field not in reextracted_fields(before)]
+        print(f"  {field:18} {len(diffs):>6}")
+        for image_hash, before, after in diffs[:args.examples]:
+            print(f"      {image_hash[:12]}: {before!r} -> {after!r}")
+
+    if args.save:
+        write_records(args.save, [{'image_hash': image_hash, 'result': result} for image_hash, result in results])
+        print(f"\nResultados guardados en {args.save}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Circuit breaker y presupuesto de reintentos para las llamadas a Gemini
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import structlog
+
+logger = structlog.get_logger()
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de tres estados.
+
+    - closed: las peticiones pasan; tras `failure_threshold` fallos seguidos se abre.
+    - open: se rechazan las peticiones sin llamar a Gemini durante `recovery_timeout`.
+    - half_open: se dejan pasar hasta `half_open_max_calls` peticiones de prueba;
+      si una tiene éxito se cierra y si falla se vuelve a abrir.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: Optional[int] = None,
+        recovery_timeout: Optional[float] = None,
+        half_open_max_calls: Optional[int] = None,
+    ):
+        self.failure_threshold = failure_threshold or int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', '5'))
+        self.recovery_timeout = recovery_timeout or float(os.getenv('GEMINI_BREAKER_RECOVERY_TIMEOUT', '30'))
+        self.half_open_max_calls = half_open_max_calls or int(os.getenv('GEMINI_BREAKER_HALF_OPEN_CALLS', '1'))
+
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_in_flight = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """
+        Comprobar si se puede llamar a Gemini
+
+        Returns:
+            True si la petición puede pasar (en half-open cuenta como prueba)
+        """
+        with self._lock:
+            if self.state == STATE_OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = STATE_HALF_OPEN
+                self.half_open_in_flight = 0
+                logger.info("Circuit breaker half-open, probando Gemini")
+
+            if self.state == STATE_HALF_OPEN:
+                if self.half_open_in_flight >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self.half_open_in_flight += 1
+
+            return True
+
+    def record_success(self):
+        """Registrar una llamada correcta"""
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                logger.info("Circuit breaker cerrado, Gemini recuperado")
+            self.state = STATE_CLOSED
+            self.consecutive_failures = 0
+            self.half_open_in_flight = 0
+
+    def record_failure(self):
+        """Registrar un fallo transitorio (timeout, 429 o 5xx)"""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def release(self):
+        """Liberar una plaza de prueba que no llegó a registrar resultado"""
+        with self._lock:
+            if self.state == STATE_HALF_OPEN and self.half_open_in_flight > 0:
+                self.half_open_in_flight -= 1
+
+    def _open(self):
+        if self.state != STATE_OPEN:
+            self.times_opened += 1
+            print(f"🔌 Circuit breaker de Gemini ABIERTO tras {self.consecutive_failures} fallos")
+            logger.warning("Circuit breaker abierto", failures=self.consecutive_failures)
+        self.state = STATE_OPEN
+        self.opened_at = time.monotonic()
+        self.half_open_in_flight = 0
+
+    def retry_after(self) -> float:
+        """Segundos hasta que el breaker vuelva a admitir peticiones de prueba"""
+        with self._lock:
+            if self.state != STATE_OPEN:
+                return 0.0
+            return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def get_stats(self) -> Dict:
+        """Estado actual del breaker"""
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "recovery_timeout": self.recovery_timeout,
+                "retry_after": round(retry_after, 1),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected
+            }
+
+
+class RetryBudget:
+    """
+    Presupuesto global de reintentos.
+
+    En una ventana deslizante solo se permiten `min_retries` reintentos más un
+    `ratio` de las peticiones originales, de modo que con Gemini degradado los
+    reintentos no multiplican la carga.
+    """
+
+    def __init__(
+        self,
+        ratio: Optional[float] = None,
+        min_retries: Optional[int] = None,
+        window_seconds: Optional[float] = None,
+    ):
+        self.ratio = ratio if ratio is not None else float(os.getenv('GEMINI_RETRY_BUDGET_RATIO', '0.2'))
+        self.min_retries = min_retries if min_retries is not None else int(os.getenv('GEMINI_RETRY_BUDGET_MIN', '3'))
+        self.window_seconds = window_seconds or float(os.getenv('GEMINI_RETRY_BUDGET_WINDOW', '60'))
+
+        self._requests = deque()
+        self._retries = deque()
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        cutoff = now - self.window_seconds
+        while self._requests and self._requests[0] < cutoff:
+            self._requests.popleft()
+        while self._retries and self._retries[0] < cutoff:
+            self._retries.popleft()
+
+    def record_request(self):
+        """Registrar una petición original (no reintento)"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_acquire_retry(self) -> bool:
+        """
+        Consumir un reintento del presupuesto
+
+        Returns:
+            True si queda presupuesto para reintentar
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            allowed = self.min_retries + self.ratio * len(self._requests)
+            if len(self._retries) >= allowed:
+                self.exhausted += 1
+                return False
+            self._retries.append(now)
+            return True
+
+    def get_stats(self) -> Dict:
+        """Uso actual del presupuesto"""
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                "ratio": self.ratio,
+                "window_seconds": self.window_seconds,
+                "requests_in_window": len(self._requests),
+                "retries_in_window": len(self._retries),
+                "exhausted": self.exhausted
+            }
@@ -0,0 +1,182 @@
+"""
+Caché persistente de extracciones indexada por el SHA-256 de la imagen y la
+configuración de extracción (modelos, prompt, esquema y preprocesado)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+import structlog
+
+logger = structlog.get_logger()
+
+
+def compute_image_hash(image_bytes: bytes) -> str:
+    """Calcular el SHA-256 (hex) de los bytes de la imagen"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def compute_config_hash(config: Dict) -> str:
+    """Huella corta de la configuración de extracción (cambia si cambia cualquier valor)"""
+    serialized = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:16]
+
+
+def compute_cache_key(image_hash: str, config_hash: str) -> str:
+    """Clave de la caché: la misma imagen con otra configuración es otra entrada"""
+    return f"{image_hash}:{config_hash}"
+
+
+class ExtractionCache:
+    """
+    Caché LRU con TTL guardada en SQLite.
+
+    Cada entrada guarda el resultado parseado de Gemini para una imagen
+    concreta y una configuración de extracción (compute_cache_key), de modo
+    que volver a subir la misma foto no vuelve a pagar una llamada a la API.
+    Sobrevive a reinicios del contenedor.
+
+    Los métodos bloquean (SQLite): desde código asíncrono se llaman con
+    asyncio.to_thread. Los aciertos no escriben en disco; la fecha de último
+    acceso del LRU se actualiza por lotes de EXTRACTION_CACHE_TOUCH_BATCH.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[int] = None,
+        touch_batch_size: Optional[int] = None,
+    ):
+        self.db_path = db_path or os.getenv('EXTRACTION_CACHE_PATH', '/app/cache/extraction_cache.db')
+        self.max_entries = max_entries or int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', '5000'))
+        self.ttl_seconds = ttl_seconds or int(os.getenv('EXTRACTION_CACHE_TTL', str(7 * 24 * 3600)))
+        self.touch_batch_size = touch_batch_size or int(os.getenv('EXTRACTION_CACHE_TOUCH_BATCH', '64'))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        # Últimos accesos pendientes de guardar (clave -> timestamp)
+        self._touches: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        cache_dir = os.path.dirname(self.db_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extractions (
+                -- image_hash guarda la clave de compute_cache_key (imagen + configuración)
+                image_hash TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_last_access ON extractions(last_access)")
+        self._conn.commit()
+
+    def _flush_touches(self):
+        """Guardar los últimos accesos pendientes en una sola transacción (con el lock)"""
+        if not self._touches:
+            return
+        self._conn.executemany(
+            "UPDATE extractions SET last_access = ? WHERE image_hash = ?",
+            [(accessed_at, key) for key, accessed_at in self._touches.items()]
+        )
+        self._conn.commit()
+        self._touches.clear()
+
+    def flush(self):
+        """Guardar los últimos accesos pendientes (al apagar el servicio)"""
+        with self._lock:
+            self._flush_touches()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Obtener una extracción guardada (None si no existe o ha caducado)"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at FROM extractions WHERE image_hash = ?",
+                (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            payload, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._touches.pop(key, None)
+                self._conn.execute("DELETE FROM extractions WHERE image_hash = ?", (key,))
+                self._conn.commit()
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._touches[key] = now
+            if len(self._touches) >= self.touch_batch_size:
+                self._flush_touches()
+            self.hits += 1
+
+        return json.loads(payload)
+
+    def set(self, key: str, value: Dict):
+        """Guardar una extracción y expulsar las menos usadas si se supera el límite"""
+        now = time.time()
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            # El LRU tiene que ver los últimos accesos antes de expulsar
+            self._touches.pop(key, None)
+            self._flush_touches()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (image_hash, payload, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, payload, now, now)
+            )
+
+            count = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM extractions WHERE image_hash IN "
+                    "(SELECT image_hash FROM extractions ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,)
+                )
+                self.evictions += overflow
+
+            self._conn.commit()
+
+    def get_stats(self) -> Dict:
+        """Contadores de aciertos y fallos de la caché"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": size,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "pending_touches": len(self._touches),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def clear(self):
+        """Vaciar la caché"""
+        with self._lock:
+            self._touches.clear()
+            self._conn.execute("DELETE FROM extractions")
+            self._conn.commit()
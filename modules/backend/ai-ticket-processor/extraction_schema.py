@@ -0,0 +1,106 @@
+"""
+Esquema de la extracción de tickets: respuesta estructurada de Gemini y
+validación estricta de la respuesta
+"""
+
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+TIPOS_TICKET = ["supermercado", "restaurante", "gasolinera", "farmacia", "otros"]
+
+# responseSchema para el modo JSON de Gemini (subconjunto OpenAPI que admite la API)
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "fecha": {"type": "STRING", "nullable": True, "description": "Fecha del ticket en formato DD/MM/YYYY"},
+        "hora": {"type": "STRING", "nullable": True, "description": "Hora del ticket en formato HH:MM"},
+        "tienda": {"type": "STRING", "nullable": True, "description": "Nombre de la tienda o establecimiento"},
+        "total": {"type": "NUMBER", "nullable": True, "description": "Importe total del ticket"},
+        "tipo_ticket": {"type": "STRING", "nullable": True, "enum": TIPOS_TICKET},
+        "productos": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "cantidad": {"type": "NUMBER", "nullable": True},
+                    "nombre": {"type": "STRING"},
+                    "precio": {"type": "NUMBER", "nullable": True}
+                },
+                "required": ["nombre"],
+                "propertyOrdering": ["cantidad", "nombre", "precio"]
+            }
+        }
+    },
+    "required": ["fecha", "hora", "tienda", "total", "tipo_ticket", "productos"],
+    "propertyOrdering": ["fecha", "hora", "tienda", "total", "tipo_ticket", "productos"]
+}
+
+
+class ProductoExtraido(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+    cantidad: Optional[float] = None
+    nombre: str
+    precio: Optional[float] = None
+
+
+class TicketExtraction(BaseModel):
+    """Datos extraídos de un ticket, tal y como los devuelve Gemini en modo JSON"""
+    model_config = ConfigDict(extra='ignore')
+
+    fecha: Optional[str] = None
+    hora: Optional[str] = None
+    tienda: Optional[str] = None
+    total: Optional[float] = None
+    tipo_ticket: Optional[Literal["supermercado", "restaurante", "gasolinera", "farmacia", "otros"]] = None
+    productos: List[ProductoExtraido] = Field(default_factory=list)
+
+
+def parse_structured_response(response_text: str) -> Dict:
+    """
+    Validar la respuesta JSON de Gemini contra el esquema
+
+    Returns:
+        Diccionario con los campos tipados
+
+    Raises:
+        ValueError: si la respuesta no es JSON o no cumple el esquema
+    """
+    try:
+        return TicketExtraction.model_validate_json(response_text).model_dump()
+    except ValidationError as e:
+        raise ValueError(f"Respuesta de Gemini no cumple el esquema: {e.error_count()} errores ({e.errors()[0]['msg']})")
+
+
+def build_partial_schema(fields: List[str]) -> Dict:
+    """responseSchema con solo algunos campos (re-extracción de campos concretos)"""
+    return {
+        "type": "OBJECT",
+        "properties": {field: RESPONSE_SCHEMA["properties"][field] for field in fields},
+        "required": list(fields),
+        "propertyOrdering": list(fields)
+    }
+
+
+def parse_partial_response(response_text: str, fields: List[str]) -> Dict:
+    """
+    Validar una respuesta con solo algunos campos del ticket
+
+    Acepta JSON puro o JSON dentro de texto libre.
+
+    Returns:
+        Diccionario con los campos pedidos que trae la respuesta
+
+    Raises:
+        ValueError: si la respuesta no es JSON o no cumple el esquema
+    """
+    start_idx = response_text.find('{')
+    end_idx = response_text.rfind('}') + 1
+    if start_idx == -1 or end_idx == 0:
+        raise ValueError("No se encontró JSON válido en la respuesta")
+    try:
+        extraction = TicketExtraction.model_validate_json(response_text[start_idx:end_idx])
+    except ValidationError as e:
+        raise ValueError(f"Respuesta de Gemini no cumple el esquema: {e.error_count()} errores ({e.errors()[0]['msg']})")
+    return extraction.model_dump(include=set(fields) & extraction.model_fields_set)
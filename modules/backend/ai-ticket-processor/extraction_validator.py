@@ -0,0 +1,173 @@
+"""
+Validación de coherencia de una extracción: decide si el resultado de un
+modelo rápido es fiable, qué campos hay que volver a pedir al modelo o si
+hay que escalar al siguiente modelo de la cascada
+"""
+
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Comprobaciones disponibles (GEMINI_CASCADE_CHECKS)
+CHECK_DATE = "fecha"
+CHECK_TOTAL = "total"
+CHECK_SUM = "suma"
+CHECK_PRODUCTS = "productos"
+CHECK_STORE = "tienda"
+ALL_CHECKS = (CHECK_DATE, CHECK_TOTAL, CHECK_SUM, CHECK_PRODUCTS, CHECK_STORE)
+
+# Problemas que puede devolver la validación
+ISSUE_MISSING_DATE = "fecha_ausente"
+ISSUE_MISSING_TOTAL = "total_ausente"
+ISSUE_SUM_MISMATCH = "suma_no_cuadra"
+ISSUE_NO_PRODUCTS = "sin_productos"
+ISSUE_UNKNOWN_STORE = "tienda_desconocida"
+ISSUE_CHECK_ERROR = "validacion_fallida"
+
+# Campos puntuados y que se pueden volver a extraer por separado
+SCORED_FIELDS = ("fecha", "hora", "tienda", "total", "productos")
+
+DATE_PATTERN = re.compile(r'^\d{2}/\d{2}/\d{4}$')
+TIME_PATTERN = re.compile(r'^\d{2}:\d{2}$')
+AMOUNT_PATTERN = re.compile(r'-?\d+(?:[.,]\d+)*')
+
+
+def load_checks() -> List[str]:
+    """Comprobaciones activas según GEMINI_CASCADE_CHECKS (por defecto todas)"""
+    value = os.getenv('GEMINI_CASCADE_CHECKS', ','.join(ALL_CHECKS))
+    return [check.strip() for check in value.split(',') if check.strip() in ALL_CHECKS]
+
+
+def load_reextract_fields() -> List[str]:
+    """Campos que se pueden volver a pedir por separado (GEMINI_REEXTRACT_FIELDS)"""
+    value = os.getenv('GEMINI_REEXTRACT_FIELDS', 'fecha,total,productos')
+    return [field.strip() for field in value.split(',') if field.strip() in SCORED_FIELDS]
+
+
+def parse_amount(value) -> Optional[float]:
+    """
+    Importe como número: acepta números y textos como "12,50", "12.50 €" o
+    "1.234,56" (sin salida estructurada Gemini devuelve texto)
+
+    Returns:
+        None si no hay valor o no es numérico
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    match = AMOUNT_PATTERN.search(value.replace(' ', ''))
+    if not match:
+        return None
+    number = match.group()
+    # El último separador con 1-2 decimales detrás es el decimal; el resto son miles
+    head, sep, tail = number.replace(',', '.').rpartition('.')
+    if sep and len(tail) <= 2:
+        number = head.replace('.', '') + '.' + tail
+    else:
+        number = number.replace(',', '').replace('.', '')
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+
+def priced_products(parsed: Dict) -> List[Tuple[float, float]]:
+    """(precio, cantidad) de los productos con precio numérico"""
+    priced = []
+    for product in parsed.get('productos') or []:
+        if not isinstance(product, dict):
+            continue
+        price = parse_amount(product.get('precio'))
+        if price is not None:
+            priced.append((price, parse_amount(product.get('cantidad')) or 1))
+    return priced
+
+
+def products_sum_matches(parsed: Dict, tolerance: float = 0.05, ratio: float = 0.01) -> Optional[bool]:
+    """
+    Comprobar que los precios de los productos suman el total
+
+    Se acepta tanto `precio` como importe de línea como `precio` unitario x
+    `cantidad`, con una tolerancia de `tolerance` euros más un `ratio` del
+    total (redondeos, bolsas, descuentos pequeños).
+
+    Returns:
+        None si no hay datos numéricos para comprobarlo
+    """
+    total = parse_amount(parsed.get('total'))
+    priced = priced_products(parsed)
+    if total is None or not priced:
+        return None
+
+    allowed = tolerance + ratio * abs(total)
+    line_sum = sum(price for price, _ in priced)
+    unit_sum = sum(price * quantity for price, quantity in priced)
+    return abs(line_sum - total) <= allowed or abs(unit_sum - total) <= allowed
+
+
+def validate_extraction(parsed: Dict, checks: List[str], store_known: Optional[bool] = None) -> List[str]:
+    """
+    Problemas de coherencia de una extracción
+
+    Args:
+        parsed: Datos extraídos (ya validados contra el esquema)
+        checks: Comprobaciones a aplicar
+        store_known: Si la tienda es del mercado (None si no se ha verificado)
+
+    Returns:
+        Lista de problemas; vacía si la extracción es fiable
+    """
+    issues = []
+    if CHECK_DATE in checks and not parsed.get('fecha'):
+        issues.append(ISSUE_MISSING_DATE)
+    if CHECK_TOTAL in checks and parsed.get('total') is None:
+        issues.append(ISSUE_MISSING_TOTAL)
+    if CHECK_PRODUCTS in checks and not parsed.get('productos'):
+        issues.append(ISSUE_NO_PRODUCTS)
+    if CHECK_SUM in checks and products_sum_matches(parsed) is False:
+        issues.append(ISSUE_SUM_MISMATCH)
+    if CHECK_STORE in checks and store_known is False:
+        issues.append(ISSUE_UNKNOWN_STORE)
+    return issues
+
+
+def score_fields(parsed: Dict, store_known: Optional[bool] = None) -> Dict[str, float]:
+    """
+    Puntuación de fiabilidad de cada campo de una extracción
+
+    1.0 si el campo está y es coherente, 0.5 si está pero no cuadra (formato
+    inesperado, total no numérico o que no suma) y 0.0 si falta. Si la suma no cuadra se
+    penaliza el total y no los productos: volver a leer un número es mucho
+    más barato que volver a leer toda la lista.
+
+    Args:
+        parsed: Datos extraídos (ya validados contra el esquema)
+        store_known: Si la tienda es del mercado (None si no se ha verificado)
+    """
+    sum_matches = products_sum_matches(parsed)
+
+    def pattern_score(value, pattern) -> float:
+        if not value:
+            return 0.0
+        return 1.0 if pattern.match(str(value)) else 0.5
+
+    def total_score(value) -> float:
+        if value in (None, ''):
+            return 0.0
+        return 0.5 if parse_amount(value) is None or sum_matches is False else 1.0
+
+    return {
+        "fecha": pattern_score(parsed.get('fecha'), DATE_PATTERN),
+        "hora": pattern_score(parsed.get('hora'), TIME_PATTERN),
+        "tienda": 0.0 if not parsed.get('tienda') else 0.5 if store_known is False else 1.0,
+        "total": total_score(parsed.get('total')),
+        "productos": 1.0 if parsed.get('productos') else 0.0,
+    }
+
+
+def failed_fields(scores: Dict[str, float], fields: List[str], threshold: float = 1.0) -> List[str]:
+    """Campos (de entre `fields`) cuya puntuación no llega al umbral"""
+    return [field for field in fields if scores.get(field, 1.0) < threshold]
@@ -0,0 +1,318 @@
+"""
+Cliente asíncrono para la API de Gemini con conexiones reutilizables
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, Optional
+
+import httpx
+import structlog
+
+from circuit_breaker import CircuitBreaker, RetryBudget
+from hedging import HedgePolicy
+from metrics import GEMINI_REQUEST_BYTES, GEMINI_RESPONSES
+from rate_limiter import GeminiQuota, get_gemini_quota
+
+logger = structlog.get_logger()
+
+# Códigos que indican un problema transitorio de Gemini y merecen reintento
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class GeminiAPIError(Exception):
+    """Error devuelto por la API de Gemini (status != 200 o respuesta inválida)"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retryable: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+
+class GeminiUnavailableError(GeminiAPIError):
+    """Gemini no está disponible ahora mismo; el ticket debe reintentarse más tarde"""
+
+    def __init__(self, message: str, retry_after: float, status_code: Optional[int] = None):
+        super().__init__(message, status_code, retryable=True)
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimit:
+    """
+    Límite de peticiones simultáneas a Gemini.
+
+    Los clientes de los modelos de la cascada comparten una misma instancia,
+    de modo que GEMINI_MAX_CONCURRENCY es el total de la réplica y no un
+    límite por modelo.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None):
+        self.max_concurrency = max_concurrency or int(os.getenv('GEMINI_MAX_CONCURRENCY', '32'))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+
+
+class AsyncGeminiClient:
+    """
+    Cliente HTTP asíncrono para Gemini.
+
+    Mantiene un único httpx.AsyncClient con conexiones keep-alive y limita el
+    número de peticiones simultáneas con un semáforo, de forma que una réplica
+    puede tener muchas extracciones en vuelo sin bloquear el event loop.
+
+    Los fallos transitorios (timeout, 429, 5xx) se reintentan con backoff
+    exponencial y jitter mientras quede presupuesto de reintentos, y un
+    circuit breaker corta las llamadas cuando Gemini está degradado.
+
+    Con cobertura activada (GEMINI_HEDGE_ENABLED), si un intento no ha
+    respondido en el percentil configurado de latencia se lanza una segunda
+    petición idéntica; gana la primera respuesta y la otra se cancela.
+
+    Cada petición HTTP (reintentos y coberturas incluidos) consume cuota de
+    Gemini (GEMINI_RPM/GEMINI_TPM), compartida por todos los clientes.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        max_concurrency: Optional[int] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        max_connections: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        retry_budget: Optional[RetryBudget] = None,
+        hedge_policy: Optional[HedgePolicy] = None,
+        quota: Optional[GeminiQuota] = None,
+        concurrency: Optional[ConcurrencyLimit] = None,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = base_url.rsplit('/models/', 1)[-1].split(':', 1)[0]
+        self.concurrency = concurrency or ConcurrencyLimit(max_concurrency)
+        self.max_concurrency = self.concurrency.max_concurrency
+        self.timeout = timeout or float(os.getenv('GEMINI_TIMEOUT', '30'))
+        self.connect_timeout = connect_timeout or float(os.getenv('GEMINI_CONNECT_TIMEOUT', '5'))
+        self.max_connections = max_connections or int(os.getenv('GEMINI_MAX_CONNECTIONS', str(self.max_concurrency)))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+        self.backoff_base = float(os.getenv('GEMINI_BACKOFF_BASE', '0.5'))
+        self.backoff_max = float(os.getenv('GEMINI_BACKOFF_MAX', '10'))
+
+        self.breaker = breaker or CircuitBreaker()
+        self.retry_budget = retry_budget or RetryBudget()
+        self.hedge_policy = hedge_policy or HedgePolicy()
+        self.quota = quota or get_gemini_quota()
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self.retries = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self.concurrency.in_flight
+
+    @property
+    def waiting(self) -> int:
+        return self.concurrency.waiting
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Crear el cliente HTTP bajo demanda (dentro del event loop)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-goog-api-key': self.api_key
+                },
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+        return self._client
+
+    async def generate_content(self, payload: Dict, timeout: Optional[float] = None) -> Dict:
+        """
+        Enviar una petición generateContent y devolver el JSON de respuesta
+
+        Args:
+            payload: Cuerpo de la petición para Gemini
+            timeout: Tiempo máximo total de cada intento (segundos)
+
+        Returns:
+            JSON de respuesta de Gemini
+
+        Raises:
+            GeminiUnavailableError: si el breaker está abierto o se agotaron los
+                reintentos ante un fallo transitorio
+            GeminiAPIError: ante un error no recuperable (p. ej. 400)
+        """
+        self.retry_budget.record_request()
+        self.hedge_policy.record_request()
+        attempt = 0
+
+        while True:
+            if not self.breaker.allow_request():
+                retry_after = self.breaker.retry_after() or self.breaker.recovery_timeout
+                raise GeminiUnavailableError(
+                    f"Circuit breaker de Gemini abierto, reintentar en {retry_after:.0f}s",
+                    retry_after=retry_after
+                )
+
+            try:
+                response = await self._post_hedged(payload, timeout)
+            except GeminiAPIError as e:
+                if not e.retryable:
+                    self.breaker.release()
+                    raise
+                self.breaker.record_failure()
+                error, retry_after_header = e, None
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    data = response.json()
+                    self.quota.record_usage(
+                        self.quota.estimated_tokens_per_request,
+                        (data.get('usageMetadata') or {}).get('totalTokenCount')
+                    )
+                    return data
+
+                print(f"❌ Error en API de Gemini: {response.status_code}")
+                logger.error("Error en API de Gemini", status_code=response.status_code, response=response.text)
+
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    # Error de la petición (imagen o payload inválido): no es culpa de Gemini
+                    self.breaker.release()
+                    raise GeminiAPIError(f"Error en API de Gemini: {response.status_code}", response.status_code)
+
+                self.breaker.record_failure()
+                error = GeminiAPIError(f"Error en API de Gemini: {response.status_code}", response.status_code, retryable=True)
+                retry_after_header = self._parse_retry_after(response)
+
+            attempt += 1
+            if attempt > self.max_retries or not self.retry_budget.try_acquire_retry():
+                raise GeminiUnavailableError(
+                    f"{error} (sin reintentos disponibles)",
+                    retry_after=self.breaker.retry_after() or self.backoff_max,
+                    status_code=error.status_code
+                )
+
+            # Backoff exponencial con jitter completo (respetando Retry-After si Gemini lo envía)
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+            if retry_after_header is not None:
+                delay = max(delay, min(retry_after_header, self.backoff_max))
+            self.retries += 1
+            logger.warning("Reintentando petición a Gemini", attempt=attempt, delay=round(delay, 2), error=str(error))
+            await asyncio.sleep(delay)
+
+    async def _post_hedged(self, payload: Dict, timeout: Optional[float] = None) -> httpx.Response:
+        """
+        Un intento contra Gemini con petición de cobertura si tarda demasiado
+
+        La cobertura solo se lanza si queda presupuesto y no hay peticiones
+        esperando al semáforo (con la concurrencia saturada la segunda
+        petición solo haría cola). Si una de las dos falla se espera a la
+        otra; si fallan ambas se propaga el resultado de la última.
+        """
+        delay = self.hedge_policy.delay()
+        if delay is None:
+            return await self._post(payload, timeout)
+
+        primary = asyncio.ensure_future(self._post(payload, timeout))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+
+            if self.waiting > 0 or not self.hedge_policy.try_acquire():
+                return await primary
+
+            logger.info("Lanzando petición de cobertura a Gemini", delay=round(delay, 2))
+            hedge = asyncio.ensure_future(self._post(payload, timeout))
+            pending = {primary, hedge}
+            last = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    last = task
+                    if task.exception() is None and task.result().status_code == 200:
+                        if task is hedge:
+                            self.hedge_policy.record_win()
+                        return task.result()
+            return last.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _post(self, payload: Dict, timeout: Optional[float] = None) -> httpx.Response:
+        """Un único intento contra Gemini, limitado por la cuota y el semáforo de concurrencia"""
+        request_timeout = timeout or self.timeout
+        client = self._get_client()
+        body = json.dumps(payload).encode('utf-8')
+
+        await self.quota.acquire()
+
+        limit = self.concurrency
+        limit.waiting += 1
+        async with limit.semaphore:
+            limit.waiting -= 1
+            limit.in_flight += 1
+            start = time.monotonic()
+            try:
+                GEMINI_REQUEST_BYTES.labels(model=self.model).inc(len(body))
+                response = await asyncio.wait_for(
+                    client.post(self.base_url, content=body),
+                    timeout=request_timeout
+                )
+            except asyncio.TimeoutError:
+                GEMINI_RESPONSES.labels(model=self.model, status='timeout').inc()
+                logger.error("Timeout en petición a Gemini API", timeout=request_timeout)
+                raise GeminiAPIError(f"Timeout en API de Gemini tras {request_timeout}s", retryable=True)
+            except httpx.HTTPError as e:
+                GEMINI_RESPONSES.labels(model=self.model, status='connection_error').inc()
+                logger.error("Error de conexión con Gemini API", error=str(e))
+                raise GeminiAPIError(f"Error de conexión con Gemini API: {str(e)}", retryable=True)
+            finally:
+                limit.in_flight -= 1
+
+        GEMINI_RESPONSES.labels(model=self.model, status=str(response.status_code)).inc()
+        print(f"📡 Respuesta de Gemini API: Status {response.status_code}")
+        if response.status_code == 200:
+            self.hedge_policy.tracker.record(time.monotonic() - start)
+        return response
+
+    @staticmethod
+    def _parse_retry_after(response: httpx.Response) -> Optional[float]:
+        """Leer la cabecera Retry-After (en segundos) si existe"""
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    def get_stats(self) -> Dict:
+        """Estado actual del cliente"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "timeout": self.timeout,
+            "retries": self.retries,
+            "circuit_breaker": self.breaker.get_stats(),
+            "retry_budget": self.retry_budget.get_stats(),
+            "hedging": self.hedge_policy.get_stats()
+        }
+
+    async def aclose(self):
+        """Cerrar las conexiones abiertas"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
@@ -0,0 +1,145 @@
+"""
+Peticiones de cobertura (hedging) para recortar la cola de latencia de Gemini
+"""
+
+import os
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+from circuit_breaker import RetryBudget
+
+
+class LatencyTracker:
+    """
+    Latencias recientes de las peticiones correctas a Gemini.
+
+    El umbral de cobertura es un percentil de las últimas `window_size`
+    latencias: si una petición tarda más que el p95 habitual, probablemente
+    ha caído en la cola lenta y vale la pena lanzar una segunda.
+    """
+
+    def __init__(
+        self,
+        percentile: Optional[float] = None,
+        window_size: Optional[int] = None,
+        min_samples: Optional[int] = None,
+        min_delay: Optional[float] = None,
+    ):
+        self.percentile = percentile or float(os.getenv('GEMINI_HEDGE_PERCENTILE', '95'))
+        self.window_size = window_size or int(os.getenv('GEMINI_HEDGE_WINDOW', '500'))
+        self.min_samples = min_samples or int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+        self.min_delay = min_delay if min_delay is not None else float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '1.0'))
+
+        self._samples = deque(maxlen=self.window_size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        """Registrar la latencia de una petición correcta"""
+        with self._lock:
+            self._samples.append(seconds)
+
+    def threshold(self) -> Optional[float]:
+        """
+        Segundos que se espera antes de lanzar la petición de cobertura
+
+        Returns:
+            El percentil configurado (como mínimo `min_delay`), o None si aún
+            no hay muestras suficientes para estimarlo
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(self.percentile / 100 * len(ordered)))
+        return max(self.min_delay, ordered[index])
+
+    def get_stats(self) -> Dict:
+        """Percentil configurado y umbral actual"""
+        threshold = self.threshold()
+        with self._lock:
+            samples = len(self._samples)
+        return {
+            "percentile": self.percentile,
+            "samples": samples,
+            "threshold_seconds": round(threshold, 3) if threshold is not None else None
+        }
+
+
+def create_hedge_budget(budget_ratio: Optional[float] = None) -> RetryBudget:
+    """
+    Presupuesto de peticiones de cobertura (el mismo mecanismo que el de
+    reintentos, sin mínimo); se puede compartir entre varias políticas
+    """
+    return RetryBudget(
+        ratio=budget_ratio if budget_ratio is not None else float(os.getenv('GEMINI_HEDGE_BUDGET_RATIO', '0.05')),
+        min_retries=0,
+        window_seconds=float(os.getenv('GEMINI_HEDGE_BUDGET_WINDOW', '300'))
+    )
+
+
+class HedgePolicy:
+    """
+    Decide cuándo lanzar una petición de cobertura y lleva la cuenta.
+
+    El coste extra está acotado por un presupuesto: como mucho `budget_ratio`
+    peticiones extra por cada petición original en la ventana. Varias
+    políticas (una por modelo, cada una con sus latencias) pueden compartir el
+    mismo presupuesto. Desactivado por defecto.
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        tracker: Optional[LatencyTracker] = None,
+        budget_ratio: Optional[float] = None,
+        budget: Optional[RetryBudget] = None,
+    ):
+        self.enabled = enabled if enabled is not None else os.getenv('GEMINI_HEDGE_ENABLED', 'false').lower() == 'true'
+        self.tracker = tracker or LatencyTracker()
+        self.budget = budget or create_hedge_budget(budget_ratio)
+
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped_budget = 0
+        self._lock = threading.Lock()
+
+    def delay(self) -> Optional[float]:
+        """Espera antes de cubrir una petición (None si no se cubre)"""
+        if not self.enabled:
+            return None
+        return self.tracker.threshold()
+
+    def record_request(self):
+        """Registrar una petición original en el presupuesto"""
+        self.budget.record_request()
+
+    def try_acquire(self) -> bool:
+        """Consumir una petición de cobertura del presupuesto"""
+        if self.budget.try_acquire_retry():
+            with self._lock:
+                self.hedges += 1
+            return True
+        with self._lock:
+            self.skipped_budget += 1
+        return False
+
+    def record_win(self):
+        """La petición de cobertura respondió antes que la original"""
+        with self._lock:
+            self.hedge_wins += 1
+
+    def get_stats(self) -> Dict:
+        """Configuración y contadores de cobertura"""
+        with self._lock:
+            counters = {
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "skipped_budget": self.skipped_budget
+            }
+        return {
+            "enabled": self.enabled,
+            "budget_ratio": self.budget.ratio,
+            **counters,
+            "latency": self.tracker.get_stats()
+        }
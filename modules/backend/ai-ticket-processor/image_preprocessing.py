@@ -0,0 +1,108 @@
+"""
+Normalización de imágenes de tickets antes de enviarlas a Gemini
+"""
+
+import io
+import os
+from typing import Optional, Tuple
+
+import structlog
+from PIL import Image, ImageOps
+
+from receipt_crop import ReceiptCropper
+
+logger = structlog.get_logger()
+
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+}
+
+
+class ImagePreprocessor:
+    """
+    Reduce el tamaño de las fotos de tickets antes de codificarlas en base64.
+
+    Corrige la orientación EXIF, recorta el ticket si está activado
+    (IMAGE_CROP_ENABLED), limita el lado mayor, pasa a escala de grises y
+    vuelve a codificar con la calidad configurada. Si el resultado no es más
+    pequeño que el original se envía la imagen original.
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        max_side: Optional[int] = None,
+        grayscale: Optional[bool] = None,
+        output_format: Optional[str] = None,
+        quality: Optional[int] = None,
+        crop: Optional[bool] = None,
+    ):
+        self.enabled = enabled if enabled is not None else os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+        self.max_side = max_side or int(os.getenv('IMAGE_MAX_SIDE', '1600'))
+        self.grayscale = grayscale if grayscale is not None else os.getenv('IMAGE_GRAYSCALE', 'true').lower() == 'true'
+        self.output_format = (output_format or os.getenv('IMAGE_OUTPUT_FORMAT', 'JPEG')).upper()
+        self.quality = quality or int(os.getenv('IMAGE_QUALITY', '85'))
+        self.cropper = ReceiptCropper(enabled=crop)
+
+        if self.output_format not in MIME_TYPES:
+            raise ValueError(f"Formato de imagen no soportado: {self.output_format}")
+
+    def normalize(self, image_bytes: bytes, mime_type: str = 'image/jpeg') -> Tuple[bytes, str]:
+        """
+        Normalizar una imagen
+
+        Args:
+            image_bytes: Bytes de la imagen original
+            mime_type: Tipo MIME de la imagen original
+
+        Returns:
+            Tupla (bytes, mime_type) de la imagen a enviar a Gemini
+        """
+        if not self.enabled:
+            return image_bytes, mime_type
+
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                original_mime = Image.MIME.get(image.format, mime_type)
+
+                # Decodificar JPEG directamente a escala reducida cuando es posible
+                image.draft('L' if self.grayscale else 'RGB', (self.max_side, self.max_side))
+                image = ImageOps.exif_transpose(image)
+
+                # Recortar antes de reducir: el ticket conserva toda la resolución disponible
+                image = self.cropper.crop(image)
+
+                if max(image.size) > self.max_side:
+                    image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+
+                image = image.convert('L' if self.grayscale else 'RGB')
+
+                buffer = io.BytesIO()
+                save_kwargs = {'quality': self.quality}
+                if self.output_format == 'JPEG':
+                    save_kwargs['optimize'] = True
+                elif self.output_format == 'WEBP':
+                    save_kwargs['method'] = 4
+                image.save(buffer, format=self.output_format, **save_kwargs)
+                normalized = buffer.getvalue()
+        except Exception as e:
+            logger.warning("Error normalizando imagen, se envía la original", error=str(e))
+            return image_bytes, mime_type
+
+        if len(normalized) >= len(image_bytes):
+            return image_bytes, original_mime
+
+        return normalized, MIME_TYPES[self.output_format]
+
+    def get_config(self) -> dict:
+        """Configuración activa del preprocesado"""
+        return {
+            "enabled": self.enabled,
+            "max_side": self.max_side,
+            "grayscale": self.grayscale,
+            "output_format": self.output_format,
+            "quality": self.quality,
+            "crop": self.cropper.get_config()
+        }
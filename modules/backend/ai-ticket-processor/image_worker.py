@@ -0,0 +1,198 @@
+"""
+Pool de procesos para el trabajo de CPU con imágenes (hash, decodificación,
+recorte, redimensionado y codificación base64) fuera del event loop
+"""
+
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import structlog
+from PIL import Image
+
+from extraction_cache import compute_image_hash
+from image_preprocessing import ImagePreprocessor
+from metrics import STAGE_DECODE, STAGE_HASH, STAGE_PREPROCESS, stage_timer
+from perceptual_hash import compute_dhash
+
+logger = structlog.get_logger()
+
+# Preprocesador de cada proceso del pool (se crea en el initializer)
+_worker_preprocessor: Optional[ImagePreprocessor] = None
+
+
+def _init_worker(preprocess_config: Dict):
+    """Crear el preprocesador en cada proceso con la configuración del padre"""
+    global _worker_preprocessor
+    _worker_preprocessor = ImagePreprocessor(
+        enabled=preprocess_config['enabled'],
+        max_side=preprocess_config['max_side'],
+        grayscale=preprocess_config['grayscale'],
+        output_format=preprocess_config['output_format'],
+        quality=preprocess_config['quality'],
+        crop=preprocess_config['crop']['enabled'],
+    )
+
+
+def analyze_image(image_bytes: bytes, with_phash: bool) -> Tuple[str, Optional[int]]:
+    """
+    Huellas de la imagen
+
+    Returns:
+        Tupla (SHA-256, dHash o None si no se pide o falla)
+    """
+    image_hash = compute_image_hash(image_bytes)
+    phash = None
+    if with_phash:
+        try:
+            phash = compute_dhash(image_bytes)
+        except Exception:
+            phash = None
+    return image_hash, phash
+
+
+def prepare_for_gemini(image_bytes: bytes, need_base64: bool, preprocessor: Optional[ImagePreprocessor] = None) -> Dict:
+    """
+    Normalizar la imagen y codificarla en base64
+
+    Args:
+        image_bytes: Bytes de la imagen original
+        need_base64: Codificar aunque la imagen no cambie (el llamante no tiene base64)
+
+    Returns:
+        Diccionario con mime_type, changed, size y image_base64 (None si no
+        cambió y no se pidió)
+    """
+    preprocessor = preprocessor or _worker_preprocessor
+    gemini_bytes, mime_type = preprocessor.normalize(image_bytes)
+    changed = gemini_bytes is not image_bytes
+
+    image_base64 = None
+    if changed or need_base64:
+        image_base64 = base64.b64encode(gemini_bytes).decode('utf-8')
+
+    return {
+        "mime_type": mime_type,
+        "changed": changed,
+        "size": len(gemini_bytes),
+        "image_base64": image_base64
+    }
+
+
+def decode_base64(image_base64: str) -> bytes:
+    """Decodificar una imagen en base64 (lanza ValueError si no es válida)"""
+    return base64.b64decode(image_base64)
+
+
+def verify_image(image_bytes: bytes) -> str:
+    """
+    Comprobar que los bytes son una imagen que se puede decodificar
+
+    Returns:
+        Formato de la imagen (JPEG, PNG...)
+
+    Raises:
+        ValueError: si no es una imagen válida
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.load()
+            return image.format
+    except Exception:
+        raise ValueError("Invalid image: the file could not be decoded")
+
+
+class ImageWorkerPool:
+    """
+    Ejecuta el trabajo de imagen en un ProcessPoolExecutor.
+
+    Con varios MB por imagen, redimensionar y codificar en el hilo del event
+    loop retiene el GIL y retrasa el resto de peticiones. Las imágenes
+    pequeñas (por debajo de `min_bytes`) se procesan en un hilo, porque copiar
+    los bytes al otro proceso cuesta más que el propio trabajo. Con
+    `processes=0` no se crea pool y todo va a hilos.
+    """
+
+    def __init__(
+        self,
+        preprocessor: ImagePreprocessor,
+        processes: Optional[int] = None,
+        min_bytes: Optional[int] = None,
+    ):
+        self.preprocessor = preprocessor
+        self.processes = processes if processes is not None else int(
+            os.getenv('IMAGE_WORKER_PROCESSES', str(min(4, os.cpu_count() or 1)))
+        )
+        self.min_bytes = min_bytes if min_bytes is not None else int(os.getenv('IMAGE_WORKER_MIN_BYTES', '262144'))
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.pool_tasks = 0
+        self.thread_tasks = 0
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        """Crear el pool bajo demanda"""
+        if self.processes <= 0:
+            return None
+        if self._executor is None:
+            # spawn: el proceso principal tiene hilos (auto processor, listener) y fork no es seguro
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.preprocessor.get_config(),)
+            )
+        return self._executor
+
+    async def _run(self, size: int, fn, *args):
+        executor = self._get_executor() if size >= self.min_bytes else None
+        if executor is None:
+            self.thread_tasks += 1
+            return await asyncio.to_thread(fn, *args)
+        self.pool_tasks += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, fn, *args)
+
+    # Los tiempos de cada etapa incluyen la espera por un proceso libre del pool
+
+    async def analyze(self, image_bytes: bytes, with_phash: bool) -> Tuple[str, Optional[int]]:
+        """SHA-256 y hash perceptual de la imagen"""
+        with stage_timer(STAGE_HASH):
+            return await self._run(len(image_bytes), analyze_image, image_bytes, with_phash)
+
+    async def prepare(self, image_bytes: bytes, need_base64: bool) -> Dict:
+        """Normalizar y codificar la imagen para Gemini"""
+        with stage_timer(STAGE_PREPROCESS):
+            if len(image_bytes) < self.min_bytes or self.processes <= 0:
+                # En hilo se reutiliza el preprocesador del proceso principal
+                self.thread_tasks += 1
+                return await asyncio.to_thread(prepare_for_gemini, image_bytes, need_base64, self.preprocessor)
+            return await self._run(len(image_bytes), prepare_for_gemini, image_bytes, need_base64)
+
+    async def decode_base64(self, image_base64: str) -> bytes:
+        """Decodificar una imagen recibida en base64"""
+        with stage_timer(STAGE_DECODE):
+            return await self._run(len(image_base64), decode_base64, image_base64)
+
+    async def verify(self, image_bytes: bytes) -> str:
+        """Comprobar que la imagen se puede decodificar (ValueError si no)"""
+        with stage_timer(STAGE_DECODE):
+            return await self._run(len(image_bytes), verify_image, image_bytes)
+
+    def get_stats(self) -> Dict:
+        """Configuración y uso del pool"""
+        return {
+            "processes": self.processes,
+            "min_bytes": self.min_bytes,
+            "pool_tasks": self.pool_tasks,
+            "thread_tasks": self.thread_tasks
+        }
+
+    def shutdown(self):
+        """Cerrar los procesos del pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
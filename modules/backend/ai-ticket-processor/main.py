@@ -1,17 +1,23 @@
-
 import os
-import logging
-from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+import asyncio
+import json
+import math
+from typing import Optional
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import uvicorn
 from dotenv import load_dotenv
 import structlog
-import tempfile
-import shutil
 
 # Importar el sistema de IA
-from ai_system import GeminiTicketAI
+from ai_system import GeminiTicketAI, determine_ticket_status, matches_market_store
+from gemini_client import GeminiUnavailableError
+from metrics import OUTCOME_REPORTED_HEADER, record_ticket_outcome
+
+# Firma de resultados para el ticket service
+from result_signing import SIGNATURE_FIELD, sign_result
 
 # Importar procesador automático
 from auto_processor import get_auto_processor
@@ -40,6 +46,11 @@ structlog.configure(
 
 logger = structlog.get_logger()
 
+# Lotes: tickets de un mismo lote procesados a la vez (la concurrencia global con Gemini la limita el cliente)
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '4'))
+BATCH_ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
 # Crear aplicación FastAPI
 app = FastAPI(
     title="AI Ticket Processor API",
@@ -76,6 +87,12 @@ async def startup_event():
         logger.error("Failed to initialize AI processor", error=str(e))
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Cerrar las conexiones con Gemini al detener la aplicación"""
+    if ai_processor is not None:
+        await ai_processor.aclose()
+
 @app.get("/")
 async def root():
     """Endpoint de salud"""
@@ -85,21 +102,81 @@ async def root():
         "version": "1.0.0"
     }
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Métricas en formato Prometheus: duración de cada etapa (decode, hash,
+    preprocess, gemini, parse, store_verification), resultados de los
+    tickets, códigos de estado y bytes enviados a Gemini y cascada de modelos
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/health")
 async def health_check():
     """Endpoint de verificación de salud"""
     return {
         "status": "healthy",
-        "ai_processor_ready": ai_processor is not None
+        "ai_processor_ready": ai_processor is not None,
+        "gemini_client": ai_processor.gemini_client.get_stats() if ai_processor else None,
+        "single_flight": ai_processor.extraction_flights.get_stats() if ai_processor else None,
+        "replay_corpus": ai_processor.replay_corpus.get_stats() if ai_processor else None,
+        "market_stores": ai_processor.store_matcher.get_stats() if ai_processor else None,
+        "image_workers": ai_processor.image_workers.get_stats() if ai_processor else None
     }
 
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Obtener contadores de la caché de extracciones"""
+    if ai_processor is None:
+        raise HTTPException(status_code=503, detail="AI processor not initialized")
+    
+    if ai_processor.extraction_cache is None:
+        return {"enabled": False}
+    
+    stats = await asyncio.to_thread(ai_processor.extraction_cache.get_stats)
+    return {"enabled": True, "config_hash": ai_processor.extraction_config_hash, **stats}
+
+@app.get("/near-duplicates/stats")
+async def get_near_duplicate_stats():
+    """Obtener contadores del índice de casi duplicados"""
+    if ai_processor is None:
+        raise HTTPException(status_code=503, detail="AI processor not initialized")
+    
+    if ai_processor.near_duplicate_index is None:
+        return {"enabled": False}
+    
+    return {"enabled": True, **ai_processor.near_duplicate_index.get_stats()}
+
+def gemini_unavailable(error: GeminiUnavailableError) -> HTTPException:
+    """
+    Respuesta 503 con Retry-After cuando Gemini está degradado, para que el
+    llamante deje el ticket pendiente en lugar de marcarlo como fallido
+    """
+    retry_after = max(1, math.ceil(error.retry_after))
+    return HTTPException(
+        status_code=503,
+        detail=f"Gemini temporalmente no disponible: {str(error)}",
+        headers={"Retry-After": str(retry_after)}
+    )
+
 @app.post("/process-ticket-api")
 async def process_ticket_api(request: Request):
     """
-    Procesar ticket desde base64 y verificar tiendas del mercado
+    Procesar ticket y verificar tiendas del mercado
+    
+    Acepta dos formatos:
+    - application/octet-stream (o image/*): bytes de la imagen en el cuerpo y
+      metadatos en las cabeceras X-User-Id, X-Ticket-Id y X-Market-Stores (lista JSON)
+    - application/json: image_base64, market_stores y opcionalmente user_id y ticket_id
+    
+    El resultado del ticket se cuenta en las métricas salvo que el llamante
+    envíe la cabecera X-Outcome-Reported-By-Caller: true (lo contará él).
+    
+    La lista de tiendas es opcional: sin ella la tienda se verifica con la
+    caché de tiendas del mercado del propio servicio.
     
     Args:
-        request: JSON con image_base64 y market_stores
+        request: Petición con la imagen y sus metadatos
         
     Returns:
         JSON con la información procesada del ticket
@@ -107,69 +184,90 @@ async def process_ticket_api(request: Request):
     if ai_processor is None:
         raise HTTPException(status_code=503, detail="AI processor not initialized")
     
+    ticket_id = None
+    outcome_reported_by_caller = request.headers.get(OUTCOME_REPORTED_HEADER, "").lower() == "true"
     try:
-        # Obtener datos del request
-        data = await request.json()
-        image_base64 = data.get("image_base64")
-        market_stores = data.get("market_stores", [])
+        content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
         
-        if not image_base64:
-            raise HTTPException(status_code=400, detail="image_base64 is required")
-        
-        # Decodificar imagen base64
-        import base64
-        import tempfile
-        
-        try:
-            image_data = base64.b64decode(image_base64)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid base64 image: {str(e)}")
+        if content_type == "application/octet-stream" or content_type.startswith("image/"):
+            # Transporte binario: la imagen viaja tal cual, sin base64 ni JSON
+            image_data = await request.body()
+            image_base64 = None
+            user_id = request.headers.get("x-user-id")
+            ticket_id = request.headers.get("x-ticket-id")
+            try:
+                market_stores = json.loads(request.headers.get("x-market-stores", "[]"))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="X-Market-Stores must be a JSON list")
+            
+            if not image_data:
+                raise HTTPException(status_code=400, detail="Image body is required")
+        else:
+            # Obtener datos del request
+            data = await request.json()
+            image_base64 = data.get("image_base64")
+            market_stores = data.get("market_stores", [])
+            user_id = data.get("user_id")
+            ticket_id = data.get("ticket_id")
+            
+            if not image_base64:
+                raise HTTPException(status_code=400, detail="image_base64 is required")
+            
+            # Decodificar imagen base64 (una sola vez, fuera del event loop)
+            try:
+                image_data = await ai_processor.image_workers.decode_base64(image_base64)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Invalid base64 image: {str(e)}")
         
-        # Guardar imagen temporalmente
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            temp_file.write(image_data)
-            temp_path = temp_file.name
+        # Procesar con IA reutilizando el base64 recibido si lo hay
+        result = await ai_processor.process_ticket_bytes(
+            image_data, user_id=user_id, image_base64=image_base64, ticket_id=ticket_id
+        )
         
-        try:
-            # Procesar con IA
-            result = ai_processor.process_ticket(temp_path)
-            
-            # Verificar si es tienda del mercado
+        # Los casi duplicados ya vienen marcados por el índice perceptual; sin
+        # lista de tiendas en la petición vale la verificación con la caché
+        if market_stores and not result.get('duplicate_detected', False):
+            # Verificar si es tienda del mercado con la lista recibida
             tienda = result.get('tienda', '')
-            es_tienda_mercado = any(store.lower() in tienda.lower() for store in market_stores) if tienda else False
+            es_tienda_mercado = matches_market_store(tienda, market_stores)
             
             # Determinar estado del ticket
-            if result.get('procesado_correctamente', False):
-                if es_tienda_mercado:
-                    result['ticket_status'] = "done_approved"
-                    result['status_message'] = "Ticket aprobado - Tienda del mercado"
-                else:
-                    result['ticket_status'] = "done_rejected"
-                    result['status_message'] = "Ticket rechazado - No es tienda del mercado"
-            else:
-                result['ticket_status'] = "failed"
-                result['status_message'] = "Error en el procesamiento"
+            result['ticket_status'], result['status_message'] = determine_ticket_status(
+                result.get('procesado_correctamente', False), es_tienda_mercado
+            )
             
             result['es_tienda_mercado'] = es_tienda_mercado
-            
-            return JSONResponse(content=result)
-            
-        finally:
-            # Limpiar archivo temporal
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        
+        # El procesador automático cuenta el resultado con el estado final del ticket service
+        if not outcome_reported_by_caller:
+            record_ticket_outcome(result.get('ticket_status'))
+        
+        # Firmar el resultado para que el ticket service pueda usarlo sin volver a llamar a Gemini
+        signature = sign_result(result)
+        if signature:
+            result[SIGNATURE_FIELD] = signature
+        
+        return JSONResponse(content=result)
                 
+    except HTTPException:
+        raise
+    except GeminiUnavailableError as e:
+        logger.warning("Gemini unavailable, ticket must be retried", error=str(e), retry_after=e.retry_after)
+        if not outcome_reported_by_caller:
+            record_ticket_outcome('deferred')
+        raise gemini_unavailable(e)
     except Exception as e:
         logger.error("Error processing ticket via API", error=str(e))
         raise HTTPException(status_code=500, detail=f"Error processing ticket: {str(e)}")
 
 @app.post("/process-ticket")
-async def process_ticket(file: UploadFile = File(...)):
+async def process_ticket(file: UploadFile = File(...), user_id: Optional[str] = Form(None)):
     """
     Procesar una imagen de ticket y extraer información
     
     Args:
         file: Archivo de imagen del ticket
+        user_id: Usuario que sube el ticket (opcional, para detectar casi duplicados)
         
     Returns:
         JSON con la información extraída del ticket
@@ -187,89 +285,127 @@ async def process_ticket(file: UploadFile = File(...)):
     if file_extension not in allowed_extensions:
         raise HTTPException(status_code=400, detail=f"File extension {file_extension} not allowed. Use: {allowed_extensions}")
     
-    temp_path = None
     try:
-        # Guardar archivo temporalmente
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            shutil.copyfileobj(file.file, temp_file)
-            temp_path = temp_file.name
+        # Leer el archivo en memoria
+        image_bytes = await file.read()
         
         # Procesar con IA
         logger.info("Processing ticket", filename=file.filename)
-        result = ai_processor.process_ticket(temp_path)
+        result = await ai_processor.process_ticket_bytes(image_bytes, user_id=user_id)
+        record_ticket_outcome(result.get('ticket_status'))
         
         logger.info("Ticket processed successfully", filename=file.filename)
         return JSONResponse(content=result)
         
+    except GeminiUnavailableError as e:
+        logger.warning("Gemini unavailable", error=str(e), filename=file.filename)
+        record_ticket_outcome('deferred')
+        raise gemini_unavailable(e)
     except Exception as e:
         logger.error("Error processing ticket", error=str(e), filename=file.filename)
         raise HTTPException(status_code=500, detail=f"Error processing ticket: {str(e)}")
-    finally:
-        # Limpiar archivo temporal al final
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.unlink(temp_path)
-            except Exception as e:
-                logger.warning("Could not delete temporary file", error=str(e), temp_path=temp_path)
+
+async def process_batch_item(index: int, filename: str, image_bytes: Optional[bytes], error: Optional[str],
+                             semaphore: asyncio.Semaphore) -> dict:
+    """Procesar un ticket del lote respetando el límite de concurrencia del lote"""
+    if error:
+        return {"index": index, "filename": filename, "error": error}
+    
+    try:
+        async with semaphore:
+            logger.info("Processing ticket in batch", filename=filename)
+            result = await ai_processor.process_ticket_bytes(image_bytes)
+        record_ticket_outcome(result.get('ticket_status'))
+        return {"index": index, "filename": filename, **result}
+    except GeminiUnavailableError as e:
+        logger.warning("Gemini unavailable in batch", error=str(e), filename=filename)
+        record_ticket_outcome('deferred')
+        return {
+            "index": index,
+            "filename": filename,
+            "error": str(e),
+            "retryable": True,
+            "retry_after": math.ceil(e.retry_after)
+        }
+    except Exception as e:
+        logger.error("Error processing ticket in batch", error=str(e), filename=filename)
+        return {"index": index, "filename": filename, "error": str(e)}
 
 @app.post("/process-ticket-batch")
-async def process_ticket_batch(files: list[UploadFile] = File(...)):
+async def process_ticket_batch(request: Request, files: list[UploadFile] = File(...)):
     """
     Procesar múltiples imágenes de tickets en lote
     
+    Los tickets se procesan a la vez (como mucho BATCH_MAX_CONCURRENCY).
+    Por defecto la respuesta es {"results": [...]} en el orden del lote. Con
+    `Accept: application/x-ndjson` cada resultado se envía en cuanto termina
+    como una línea NDJSON, en orden de finalización; la última línea es un
+    resumen con `done: true`. Cada resultado lleva `index` (posición en el
+    lote) y `filename`.
+    
     Args:
+        request: Petición (para la cabecera Accept)
         files: Lista de archivos de imagen de tickets
         
     Returns:
-        Lista de resultados procesados
+        JSON con la lista de resultados o respuesta application/x-ndjson
     """
     if ai_processor is None:
         raise HTTPException(status_code=503, detail="AI processor not initialized")
     
-    results = []
+    # Validar, leer y decodificar los archivos antes de empezar a responder:
+    # una imagen corrupta es un error de su elemento, no se envía a Gemini
+    items = []
+    for index, file in enumerate(files):
+        file_extension = os.path.splitext(file.filename or '')[1].lower()
+        if not (file.content_type or '').startswith('image/'):
+            items.append((index, file.filename, None, "File must be an image"))
+        elif file_extension not in BATCH_ALLOWED_EXTENSIONS:
+            items.append((index, file.filename, None, f"File extension {file_extension} not allowed"))
+        else:
+            image_bytes = await file.read()
+            try:
+                await ai_processor.image_workers.verify(image_bytes)
+            except ValueError as e:
+                items.append((index, file.filename, None, str(e)))
+            else:
+                items.append((index, file.filename, image_bytes, None))
+    
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
     
-    for file in files:
+    if NDJSON_MEDIA_TYPE not in request.headers.get("accept", ""):
+        results = await asyncio.gather(*(process_batch_item(*item, semaphore) for item in items), return_exceptions=True)
+        return JSONResponse(content={"results": [
+            {"index": index, "filename": filename, "error": str(result)} if isinstance(result, Exception) else result
+            for (index, filename, _, _), result in zip(items, results)
+        ]})
+    
+    async def stream_results():
+        tasks = {asyncio.create_task(process_batch_item(*item, semaphore)): item for item in items}
+        pending = set(tasks)
+        failed = 0
         try:
-            # Validar tipo de archivo
-            if not file.content_type.startswith('image/'):
-                results.append({
-                    "filename": file.filename,
-                    "error": "File must be an image"
-                })
-                continue
-            
-            # Validar extensión
-            allowed_extensions = {'.jpg', '.jpeg', '.png'}
-            file_extension = os.path.splitext(file.filename)[1].lower()
-            if file_extension not in allowed_extensions:
-                results.append({
-                    "filename": file.filename,
-                    "error": f"File extension {file_extension} not allowed"
-                })
-                continue
-            
-            # Guardar archivo temporalmente
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-                shutil.copyfileobj(file.file, temp_file)
-                temp_path = temp_file.name
-            
-            # Procesar con IA
-            logger.info("Processing ticket in batch", filename=file.filename)
-            result = ai_processor.process_ticket(temp_path)
-            result["filename"] = file.filename
-            results.append(result)
-            
-            # Limpiar archivo temporal
-            os.unlink(temp_path)
-            
-        except Exception as e:
-            logger.error("Error processing ticket in batch", error=str(e), filename=file.filename)
-            results.append({
-                "filename": file.filename,
-                "error": str(e)
-            })
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # Con la respuesta ya empezada un error solo se puede enviar como línea
+                    index, filename = tasks[task][:2]
+                    try:
+                        item_result = task.result()
+                        line = json.dumps(item_result, ensure_ascii=False, default=str)
+                    except Exception as e:
+                        logger.error("Error processing ticket in batch", error=str(e), filename=filename)
+                        item_result = {"index": index, "filename": filename, "error": str(e)}
+                        line = json.dumps(item_result, ensure_ascii=False, default=str)
+                    failed += bool(item_result.get("error"))
+                    yield line + "\n"
+            yield json.dumps({"done": True, "total": len(tasks), "failed": failed}) + "\n"
+        finally:
+            # Si el cliente se desconecta no se sigue gastando cuota de Gemini
+            for task in tasks:
+                task.cancel()
     
-    return JSONResponse(content={"results": results})
+    return StreamingResponse(stream_results(), media_type=NDJSON_MEDIA_TYPE)
 
 @app.get("/model-info")
 async def get_model_info():
@@ -278,7 +414,8 @@ async def get_model_info():
         raise HTTPException(status_code=503, detail="AI processor not initialized")
     
     return {
-        "model_type": "Gemini 2.0 Flash API",
+        "model_type": f"Gemini API ({ai_processor.model})",
+        "model_cascade": ai_processor.get_cascade_stats(),
         "supported_languages": ["es", "en"],
         "supported_formats": ["jpg", "jpeg", "png"],
         "features": [
@@ -290,7 +427,8 @@ async def get_model_info():
             "Ticket type classification",
             "AI-powered text recognition",
             "Structured JSON output"
-        ]
+        ],
+        "image_preprocessing": ai_processor.image_preprocessor.get_config()
     }
 
 # Endpoints para el procesador automático
@@ -299,7 +437,7 @@ async def get_auto_processor_status():
     """Obtener estado del procesador automático"""
     try:
         auto_processor = get_auto_processor()
-        return auto_processor.get_status()
+        return await asyncio.to_thread(auto_processor.get_status)
     except Exception as e:
         logger.error("Error getting auto processor status", error=str(e))
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
@@ -331,7 +469,7 @@ async def process_now():
     """Procesar tickets pendientes inmediatamente"""
     try:
         auto_processor = get_auto_processor()
-        result = auto_processor.process_pending_tickets()
+        result = await asyncio.to_thread(auto_processor.process_pending_tickets)
         return result
     except Exception as e:
         logger.error("Error in manual processing", error=str(e))
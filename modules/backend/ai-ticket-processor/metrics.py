@@ -0,0 +1,139 @@
+"""
+Métricas Prometheus del AI Ticket Processor
+"""
+
+from typing import Dict
+
+from prometheus_client import Counter, Histogram
+
+# Buckets de latencia de Gemini: la mediana ronda los segundos y la cola llega a 30s
+GEMINI_LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+
+# Buckets de las etapas del procesamiento: desde decodificar (milisegundos) hasta Gemini
+STAGE_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+
+# Etapas del procesamiento de un ticket
+STAGE_DECODE = "decode"
+STAGE_HASH = "hash"
+STAGE_PREPROCESS = "preprocess"
+STAGE_GEMINI = "gemini"
+STAGE_PARSE = "parse"
+STAGE_STORE_VERIFICATION = "store_verification"
+
+STAGE_LATENCY = Histogram(
+    'ai_stage_latency_seconds',
+    'Duración de cada etapa del procesamiento de un ticket',
+    ['stage'],
+    buckets=STAGE_LATENCY_BUCKETS
+)
+TICKET_LATENCY = Histogram(
+    'ai_ticket_processing_seconds',
+    'Duración total del procesamiento de un ticket',
+    buckets=STAGE_LATENCY_BUCKETS
+)
+
+# Una vez por ticket, con su estado final (después de verificar tiendas y duplicados)
+TICKET_OUTCOMES = Counter(
+    'ai_ticket_outcomes_total',
+    'Tickets procesados por resultado (approved, rejected, failed, duplicate, deferred)',
+    ['outcome']
+)
+
+# Peticiones HTTP a Gemini (cada intento, incluidos reintentos y peticiones de cobertura)
+GEMINI_RESPONSES = Counter(
+    'ai_gemini_responses_total',
+    'Respuestas de Gemini por código de estado (timeout y connection_error si no hay respuesta)',
+    ['model', 'status']
+)
+GEMINI_REQUEST_BYTES = Counter(
+    'ai_gemini_request_bytes_total',
+    'Bytes de cuerpo enviados a Gemini',
+    ['model']
+)
+
+# Extracciones que esperaron a otra igual en vuelo en lugar de llamar a Gemini
+EXTRACTIONS_COALESCED = Counter(
+    'ai_extractions_coalesced_total',
+    'Extracciones agrupadas con una extracción en curso de la misma imagen'
+)
+
+# Cascada de modelos
+CASCADE_TIER_REQUESTS = Counter(
+    'ai_cascade_tier_requests_total',
+    'Extracciones intentadas en cada modelo de la cascada por resultado',
+    ['model', 'outcome']
+)
+CASCADE_TIER_LATENCY = Histogram(
+    'ai_cascade_tier_latency_seconds',
+    'Latencia de la llamada y el parseo en cada modelo de la cascada',
+    ['model'],
+    buckets=GEMINI_LATENCY_BUCKETS
+)
+CASCADE_ESCALATIONS = Counter(
+    'ai_cascade_escalations_total',
+    'Escaladas al siguiente modelo por motivo',
+    ['model', 'reason']
+)
+
+# Re-extracción de campos concretos
+REEXTRACTIONS = Counter(
+    'ai_reextractions_total',
+    'Re-extracciones de campos concretos por resultado',
+    ['model', 'outcome']
+)
+REEXTRACTED_FIELDS = Counter(
+    'ai_reextracted_fields_total',
+    'Campos pedidos de nuevo al modelo',
+    ['field']
+)
+
+
+# Resultado de cada ticket según su ticket_status
+TICKET_STATUS_OUTCOMES = {
+    'done_approved': 'approved',
+    'done_rejected': 'rejected',
+    'failed': 'failed',
+    'duplicate': 'duplicate'
+}
+
+# Cabecera con la que el llamante indica que contará él el resultado del
+# ticket (el procesador automático lo hace con el estado final)
+OUTCOME_REPORTED_HEADER = 'X-Outcome-Reported-By-Caller'
+
+
+def stage_timer(stage: str):
+    """Context manager que mide una etapa en STAGE_LATENCY"""
+    return STAGE_LATENCY.labels(stage=stage).time()
+
+
+def record_ticket_outcome(ticket_status: str):
+    """Contar el resultado de un ticket a partir de su ticket_status"""
+    TICKET_OUTCOMES.labels(outcome=TICKET_STATUS_OUTCOMES.get(ticket_status, ticket_status)).inc()
+
+
+def counter_totals(counter: Counter) -> Dict[str, float]:
+    """Valores actuales de un contador agrupados por etiquetas (para endpoints JSON)"""
+    totals = {}
+    for metric in counter.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_total'):
+                key = '/'.join(sample.labels.values())
+                totals[key] = sample.value
+    return totals
+
+
+def histogram_summary(histogram: Histogram) -> Dict[str, Dict]:
+    """Número de observaciones y media de un histograma por etiquetas"""
+    summary: Dict[str, Dict] = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_count') or sample.name.endswith('_sum'):
+                key = '/'.join(sample.labels.values())
+                summary.setdefault(key, {})[sample.name.rsplit('_', 1)[1]] = sample.value
+    return {
+        key: {
+            "count": int(values.get('count', 0)),
+            "avg_seconds": round(values['sum'] / values['count'], 3) if values.get('count') else None
+        }
+        for key, values in summary.items()
+    }
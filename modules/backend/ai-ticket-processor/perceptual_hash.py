@@ -0,0 +1,246 @@
+"""
+Detección de imágenes casi duplicadas mediante hash perceptual (dHash),
+opcionalmente confirmada con los datos extraídos del ticket
+"""
+
+import io
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import structlog
+from PIL import Image
+
+from store_matcher import normalize_store_name
+
+logger = structlog.get_logger()
+
+
+# Lado del dHash (16 -> 256 bits)
+DEFAULT_HASH_SIZE = int(os.getenv('PHASH_HASH_SIZE', '16'))
+
+# Acciones ante un casi duplicado
+ACTION_FLAG = 'flag'
+ACTION_REUSE = 'reuse'
+ACTION_ANNOTATE = 'annotate'
+DUPLICATE_ACTIONS = (ACTION_FLAG, ACTION_REUSE, ACTION_ANNOTATE)
+
+
+def compute_dhash(image_bytes: bytes, hash_size: int = DEFAULT_HASH_SIZE) -> int:
+    """
+    Calcular el dHash de una imagen.
+
+    Se reduce la imagen a escala de grises de (hash_size + 1) x hash_size y se
+    compara cada píxel con su vecino de la derecha. Fotos del mismo ticket con
+    pequeños cambios de encuadre o iluminación dan hashes muy parecidos.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('L', (hash_size * 16, hash_size * 16))
+        small = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = list(small.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+    return value
+
+
+def hash_similarity(hash_a: int, hash_b: int, bits: int = DEFAULT_HASH_SIZE * DEFAULT_HASH_SIZE) -> float:
+    """Similitud entre dos hashes (1.0 = idénticos) según la distancia de Hamming"""
+    return 1.0 - bin(hash_a ^ hash_b).count('1') / bits
+
+
+def _same_total(total_a, total_b) -> bool:
+    try:
+        return abs(float(total_a) - float(total_b)) < 0.01
+    except (TypeError, ValueError):
+        return False
+
+
+def _same_text(text_a, text_b) -> bool:
+    return normalize_store_name(str(text_a)) == normalize_store_name(str(text_b))
+
+
+def extracted_fields_agree(result_a: Dict, result_b: Dict) -> bool:
+    """
+    Confirmar que dos extracciones son del mismo ticket
+
+    fecha, total y tienda tienen que estar en las dos y coincidir; la hora
+    también si las dos la tienen.
+    """
+    for field in ('fecha', 'total', 'tienda'):
+        if result_a.get(field) in (None, '') or result_b.get(field) in (None, ''):
+            return False
+    if not _same_text(result_a['fecha'], result_b['fecha']) or not _same_text(result_a['tienda'], result_b['tienda']):
+        return False
+    if not _same_total(result_a['total'], result_b['total']):
+        return False
+    if result_a.get('hora') and result_b.get('hora') and not _same_text(result_a['hora'], result_b['hora']):
+        return False
+    return True
+
+
+class NearDuplicateIndex:
+    """
+    Índice en memoria de los tickets procesados recientemente por usuario.
+
+    Guarda el dHash y el resultado de cada imagen para poder responder a una
+    nueva foto del mismo ticket sin volver a llamar a Gemini: con 'flag' se
+    marca como duplicado y con 'reuse' se reutiliza la extracción anterior.
+
+    Un hash global no separa del todo tickets distintos con la misma
+    maquetación (misma tienda, mismo encuadre). Con PHASH_CONFIRM_FIELDS
+    la coincidencia por hash solo es candidata y se confirma cuando la
+    fecha, el total y la tienda extraídos coinciden, a costa de hacer la
+    extracción. Los mismos bytes de otro ticket son siempre un duplicado
+    confirmado.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: Optional[float] = None,
+        max_per_user: Optional[int] = None,
+        window_seconds: Optional[int] = None,
+        action: Optional[str] = None,
+        confirm_fields: Optional[bool] = None,
+    ):
+        self.similarity_threshold = similarity_threshold or float(os.getenv('PHASH_SIMILARITY_THRESHOLD', '0.97'))
+        self.max_per_user = max_per_user or int(os.getenv('PHASH_MAX_PER_USER', '50'))
+        self.window_seconds = window_seconds or int(os.getenv('PHASH_WINDOW_SECONDS', str(7 * 24 * 3600)))
+        self.hash_bits = DEFAULT_HASH_SIZE * DEFAULT_HASH_SIZE
+        # 'flag': marcar como duplicado; 'reuse': reutilizar la extracción existente;
+        # 'annotate': extraer igualmente y solo añadir near_duplicate_of
+        self.action = (action or os.getenv('PHASH_DUPLICATE_ACTION', ACTION_FLAG)).lower()
+        if self.action not in DUPLICATE_ACTIONS:
+            logger.warning("PHASH_DUPLICATE_ACTION no soportada, se usa 'flag'", action=self.action)
+            self.action = ACTION_FLAG
+        self.confirm_fields = confirm_fields if confirm_fields is not None else \
+            os.getenv('PHASH_CONFIRM_FIELDS', 'false').lower() == 'true'
+
+        self._entries: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.matches = 0
+        self.confirmed = 0
+        self.rejected = 0
+        self.skipped_extractions = 0
+
+    @staticmethod
+    def _same_ticket(entry: Dict, image_hash: Optional[str], ticket_id: Optional[str]) -> bool:
+        """
+        La entrada es una pasada anterior del mismo ticket
+
+        Con ticket_id en los dos lados se compara el ticket (los mismos bytes
+        de otro ticket son un duplicado); si falta, la identidad es la imagen.
+        """
+        if ticket_id and entry.get('ticket_id'):
+            return entry['ticket_id'] == ticket_id
+        return entry['image_hash'] == image_hash
+
+    def should_skip_extraction(self, match: Dict) -> bool:
+        """Con esta coincidencia se puede responder sin llamar a Gemini"""
+        skip = self.action in (ACTION_FLAG, ACTION_REUSE) and (match['confirmed'] or not self.confirm_fields)
+        if skip:
+            with self._lock:
+                self.skipped_extractions += 1
+        return skip
+
+    def find(
+        self,
+        user_id: str,
+        phash: int,
+        image_hash: Optional[str] = None,
+        ticket_id: Optional[str] = None
+    ) -> Optional[Dict]:
+        """
+        Buscar una imagen casi idéntica del mismo usuario
+
+        Las pasadas anteriores del mismo ticket (reprocesado tras caducar el
+        lease, fallback sin firma) no cuentan.
+
+        Args:
+            user_id: Usuario que sube el ticket
+            phash: dHash de la imagen
+            image_hash: SHA-256 de la imagen
+            ticket_id: Ticket del ticket service, si se conoce
+
+        Returns:
+            Entrada más parecida por encima del umbral (con su similitud y
+            `confirmed` si son los mismos bytes) o None
+        """
+        now = time.time()
+        best = None
+        with self._lock:
+            self.lookups += 1
+            entries = self._entries.get(user_id)
+            if not entries:
+                return None
+
+            while entries and now - entries[0]['timestamp'] > self.window_seconds:
+                entries.popleft()
+
+            for entry in entries:
+                if self._same_ticket(entry, image_hash, ticket_id):
+                    continue
+                identical = entry['image_hash'] == image_hash
+                similarity = 1.0 if identical else hash_similarity(phash, entry['phash'], self.hash_bits)
+                if similarity >= self.similarity_threshold and (
+                    best is None or (identical, similarity) > (best['confirmed'], best['similarity'])
+                ):
+                    best = {**entry, 'similarity': similarity, 'confirmed': identical}
+
+            if best is not None:
+                self.matches += 1
+                if best['confirmed']:
+                    self.confirmed += 1
+        return best
+
+    def confirm(self, match: Dict, result: Dict) -> bool:
+        """Confirmar una coincidencia por hash con los datos extraídos (si está activado)"""
+        if match['confirmed'] or not self.confirm_fields:
+            return True
+        confirmed = extracted_fields_agree(match['result'], result)
+        with self._lock:
+            if confirmed:
+                self.confirmed += 1
+            else:
+                self.rejected += 1
+        return confirmed
+
+    def add(self, user_id: str, phash: int, image_hash: str, result: Dict, ticket_id: Optional[str] = None):
+        """Registrar una imagen procesada (sustituye las pasadas anteriores del mismo ticket)"""
+        with self._lock:
+            entries = self._entries.setdefault(user_id, deque(maxlen=self.max_per_user))
+            for entry in [entry for entry in entries if self._same_ticket(entry, image_hash, ticket_id)]:
+                entries.remove(entry)
+            entries.append({
+                'phash': phash,
+                'image_hash': image_hash,
+                'ticket_id': ticket_id,
+                'result': result,
+                'timestamp': time.time()
+            })
+
+    def get_stats(self) -> Dict:
+        """Contadores del índice"""
+        with self._lock:
+            indexed = sum(len(entries) for entries in self._entries.values())
+            users = len(self._entries)
+        return {
+            "action": self.action,
+            "similarity_threshold": self.similarity_threshold,
+            "confirm_fields": self.confirm_fields,
+            "users": users,
+            "indexed_images": indexed,
+            "hash_bits": self.hash_bits,
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "confirmed": self.confirmed,
+            "rejected": self.rejected,
+            "skipped_extractions": self.skipped_extractions
+        }
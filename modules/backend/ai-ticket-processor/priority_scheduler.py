@@ -0,0 +1,121 @@
+"""
+Planificador por prioridades con envejecimiento para la cola de tickets
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Clases de prioridad de los tickets (ticket_metadata['priority'])
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_RETRY = "retry"
+PRIORITY_BACKFILL = "backfill"
+
+
+def load_priority_weights() -> Dict[str, float]:
+    """Peso de cada clase de prioridad (configurable por entorno)"""
+    return {
+        PRIORITY_INTERACTIVE: float(os.getenv('PRIORITY_WEIGHT_INTERACTIVE', '100')),
+        PRIORITY_RETRY: float(os.getenv('PRIORITY_WEIGHT_RETRY', '10')),
+        PRIORITY_BACKFILL: float(os.getenv('PRIORITY_WEIGHT_BACKFILL', '1')),
+    }
+
+
+def ticket_priority(ticket: Dict, default: str = PRIORITY_INTERACTIVE) -> str:
+    """Clase de prioridad de un ticket según sus metadatos"""
+    return (ticket.get('ticket_metadata') or {}).get('priority') or default
+
+
+def ticket_queued_at(ticket: Dict) -> float:
+    """Momento (epoch) en que el ticket entró en la cola"""
+    value = ticket.get('queued_at') or ticket.get('created_at')
+    if not value:
+        return time.time()
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return time.time()
+
+
+class PriorityScheduler:
+    """
+    Cola local de tickets reclamados, ordenada por peso x tiempo en cola.
+
+    La puntuación crece con la espera, así que un ticket de backfill acaba
+    pasando por delante de los interactivos recientes (sin inanición), pero
+    como el envejecimiento tiene un tope una subida de un usuario adelanta
+    enseguida a miles de tickets de backfill por antiguos que sean. Es la
+    misma fórmula que usa el ticket service al reclamar, de modo que el orden
+    es coherente entre réplicas.
+
+    La puntuación relativa de dos tickets cambia con el tiempo, por eso se
+    calcula al sacar cada ticket; la cola local es pequeña (un lote de claim).
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        default_priority: str = PRIORITY_INTERACTIVE,
+        max_age_seconds: Optional[float] = None,
+    ):
+        self.weights = weights or load_priority_weights()
+        self.default_priority = default_priority
+        # Tope del envejecimiento: con pesos 100/1 y 3600s, un ticket interactivo
+        # nunca espera más de ~36s detrás del backfill
+        self.max_age_seconds = max_age_seconds or float(os.getenv('PRIORITY_MAX_AGE_SECONDS', '3600'))
+        self._queue: List[Dict] = []
+        self._lock = threading.Lock()
+        self.dispatched: Dict[str, int] = {name: 0 for name in self.weights}
+        self.wait_seconds: Dict[str, float] = {name: 0.0 for name in self.weights}
+
+    def score(self, ticket: Dict, now: Optional[float] = None) -> float:
+        """Puntuación actual de un ticket"""
+        now = now or time.time()
+        weight = self.weights.get(ticket_priority(ticket, self.default_priority),
+                                  self.weights.get(self.default_priority, 1.0))
+        waited = min(max(0.0, now - ticket_queued_at(ticket)), self.max_age_seconds)
+        return weight * (waited + 1)
+
+    def push(self, ticket: Dict):
+        """Añadir un ticket reclamado a la cola local"""
+        with self._lock:
+            self._queue.append(ticket)
+
+    def pop(self) -> Optional[Dict]:
+        """Sacar el ticket con mayor puntuación en este momento"""
+        now = time.time()
+        with self._lock:
+            if not self._queue:
+                return None
+            best = max(range(len(self._queue)), key=lambda i: self.score(self._queue[i], now))
+            ticket = self._queue.pop(best)
+
+        priority = ticket_priority(ticket, self.default_priority)
+        with self._lock:
+            self.dispatched[priority] = self.dispatched.get(priority, 0) + 1
+            self.wait_seconds[priority] = self.wait_seconds.get(priority, 0.0) + max(0.0, now - ticket_queued_at(ticket))
+        return ticket
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def get_stats(self) -> Dict:
+        """Tamaño de la cola y espera media por clase"""
+        with self._lock:
+            queued = {name: 0 for name in self.weights}
+            for ticket in self._queue:
+                priority = ticket_priority(ticket, self.default_priority)
+                queued[priority] = queued.get(priority, 0) + 1
+            return {
+                "weights": self.weights,
+                "max_age_seconds": self.max_age_seconds,
+                "queued": queued,
+                "dispatched": dict(self.dispatched),
+                "avg_wait_seconds": {
+                    name: round(self.wait_seconds[name] / count, 1)
+                    for name, count in self.dispatched.items() if count
+                }
+            }
@@ -0,0 +1,179 @@
+"""
+Limitador de ritmo tipo token bucket para respetar la cuota de Gemini
+"""
+
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    Token bucket seguro entre hilos.
+
+    Se rellena de forma continua a `rate_per_minute` y admite ráfagas de hasta
+    `capacity` unidades. Sirve tanto para peticiones por minuto (RPM) como
+    para tokens por minuto (TPM).
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute debe ser mayor que 0")
+        self.rate_per_minute = rate_per_minute
+        self.rate_per_second = rate_per_minute / 60.0
+        # Por defecto se permite una ráfaga equivalente a 10 segundos de cuota
+        self.capacity = capacity or max(1.0, self.rate_per_second * 10)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.total_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+        self.last_refill = now
+
+    def _take(self, amount: float, consume: bool = True) -> float:
+        """Consumir `amount` si hay suficientes; si no, segundos que faltan"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                if consume:
+                    self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate_per_second
+
+    def acquire(self, amount: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """
+        Consumir `amount` unidades, esperando si no hay suficientes
+
+        Returns:
+            True si se consumieron, False si se agotó el timeout
+        """
+        amount = min(amount, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            wait = self._take(amount)
+            if not wait:
+                return True
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            time.sleep(wait)
+            with self._lock:
+                self.total_wait_seconds += wait
+
+    async def acquire_async(self, amount: float = 1.0):
+        """Consumir `amount` unidades esperando sin bloquear el event loop"""
+        amount = min(amount, self.capacity)
+        while True:
+            wait = self._take(amount)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+            with self._lock:
+                self.total_wait_seconds += wait
+
+    def wait_available(self, amount: float = 1.0):
+        """Esperar (bloqueando el hilo) a que haya `amount` unidades, sin consumirlas"""
+        amount = min(amount, self.capacity)
+        while True:
+            wait = self._take(amount, consume=False)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def adjust(self, amount: float):
+        """Corregir lo consumido: positivo cobra más unidades, negativo devuelve"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def get_stats(self) -> Dict:
+        """Estado actual del bucket"""
+        with self._lock:
+            self._refill()
+            return {
+                "rate_per_minute": self.rate_per_minute,
+                "capacity": round(self.capacity, 2),
+                "available": round(self.tokens, 2),
+                "total_wait_seconds": round(self.total_wait_seconds, 2)
+            }
+
+
+class GeminiQuota:
+    """
+    Cuota de Gemini de la réplica: peticiones (RPM) y tokens (TPM) por minuto.
+
+    La comparten todos los clientes de Gemini del proceso y se cobra por
+    petición HTTP (cascada, re-extracción, coberturas y reintentos incluidos).
+    Antes de cada petición se reserva una estimación de tokens y, con la
+    respuesta, se corrige con el consumo real (usageMetadata).
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        estimated_tokens_per_request: Optional[int] = None,
+    ):
+        self.request_limiter = TokenBucket(requests_per_minute or float(os.getenv('GEMINI_RPM', '60')))
+        self.token_limiter = TokenBucket(tokens_per_minute or float(os.getenv('GEMINI_TPM', '1000000')))
+        self.estimated_tokens_per_request = estimated_tokens_per_request or int(
+            os.getenv('GEMINI_TOKENS_PER_REQUEST', os.getenv('GEMINI_TOKENS_PER_TICKET', '2000'))
+        )
+        self.requests = 0
+        self.tokens_used = 0
+
+    async def acquire(self) -> int:
+        """
+        Reservar cuota para una petición
+
+        Returns:
+            Tokens reservados (para corregirlos con record_usage)
+        """
+        await self.request_limiter.acquire_async(1)
+        await self.token_limiter.acquire_async(self.estimated_tokens_per_request)
+        self.requests += 1
+        return self.estimated_tokens_per_request
+
+    def record_usage(self, reserved_tokens: int, used_tokens: Optional[int]):
+        """Corregir la reserva de tokens con el consumo real de la petición"""
+        if used_tokens is None:
+            return
+        self.tokens_used += used_tokens
+        self.token_limiter.adjust(used_tokens - reserved_tokens)
+
+    def wait_available(self):
+        """Esperar a que haya cuota para una petición (sin consumirla)"""
+        self.request_limiter.wait_available(1)
+        self.token_limiter.wait_available(self.estimated_tokens_per_request)
+
+    def get_stats(self) -> Dict:
+        """Estado de los limitadores y consumo"""
+        return {
+            "requests": self.request_limiter.get_stats(),
+            "tokens": self.token_limiter.get_stats(),
+            "estimated_tokens_per_request": self.estimated_tokens_per_request,
+            "requests_sent": self.requests,
+            "tokens_used": self.tokens_used
+        }
+
+
+# Instancia compartida por los clientes de Gemini y el procesador automático
+gemini_quota = None
+
+def get_gemini_quota() -> GeminiQuota:
+    """Obtener la cuota de Gemini del proceso"""
+    global gemini_quota
+    if gemini_quota is None:
+        gemini_quota = GeminiQuota()
+    return gemini_quota
@@ -0,0 +1,151 @@
+"""
+Detección del ticket dentro de la foto: recorte y enderezado antes de
+codificar la imagen para Gemini
+"""
+
+import os
+from typing import Optional
+
+import structlog
+from PIL import Image
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # opencv-python-headless es opcional: sin él no se recorta
+    cv2 = None
+    np = None
+
+logger = structlog.get_logger()
+
+
+class ReceiptCropper:
+    """
+    Recorta la zona del ticket en fotos tomadas con el móvil.
+
+    Busca el contorno del ticket (bordes con Canny y umbral de Otsu, porque
+    el papel suele ser más claro que la mesa) en una copia reducida, y con
+    sus cuatro esquinas aplica una transformación de perspectiva sobre la
+    imagen a resolución completa: el ticket queda recortado y derecho. Si
+    no se encuentra un contorno plausible la imagen no se toca.
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        detect_side: Optional[int] = None,
+        min_area_ratio: Optional[float] = None,
+        max_area_ratio: Optional[float] = None,
+        margin: Optional[float] = None,
+    ):
+        self.enabled = enabled if enabled is not None else os.getenv('IMAGE_CROP_ENABLED', 'false').lower() == 'true'
+        self.detect_side = detect_side or int(os.getenv('IMAGE_CROP_DETECT_SIDE', '512'))
+        # Por debajo del mínimo el contorno no es el ticket; por encima ya está encuadrado
+        self.min_area_ratio = min_area_ratio or float(os.getenv('IMAGE_CROP_MIN_AREA', '0.15'))
+        self.max_area_ratio = max_area_ratio or float(os.getenv('IMAGE_CROP_MAX_AREA', '0.9'))
+        self.margin = margin if margin is not None else float(os.getenv('IMAGE_CROP_MARGIN', '0.02'))
+        self.available = cv2 is not None
+
+        if self.enabled and not self.available:
+            logger.warning("Recorte de tickets activado pero opencv-python-headless no está instalado")
+
+    @property
+    def active(self) -> bool:
+        return self.enabled and self.available
+
+    def find_receipt_quad(self, gray):
+        """
+        Esquinas del ticket en una imagen en escala de grises (ya reducida)
+
+        Returns:
+            Array 4x2 con las esquinas o None si no se encuentra el ticket
+        """
+        height, width = gray.shape[:2]
+        image_area = float(width * height)
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+
+        edges = cv2.dilate(cv2.Canny(blurred, 50, 150), np.ones((5, 5), np.uint8), iterations=2)
+        _, bright = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+        best, best_area = None, 0.0
+        for mask in (edges, bright):
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                hull = cv2.convexHull(contour)
+                area = cv2.contourArea(hull)
+                if area > best_area and area <= self.max_area_ratio * image_area:
+                    best, best_area = hull, area
+
+        if best is None or best_area < self.min_area_ratio * image_area:
+            return None
+
+        approx = cv2.approxPolyDP(best, 0.02 * cv2.arcLength(best, True), True)
+        if len(approx) == 4:
+            quad = approx.reshape(4, 2).astype(np.float32)
+        else:
+            # Ticket arrugado o con esquinas tapadas: rectángulo girado mínimo
+            quad = cv2.boxPoints(cv2.minAreaRect(best)).astype(np.float32)
+        return quad
+
+    @staticmethod
+    def order_corners(quad):
+        """Ordenar las esquinas: arriba-izquierda, arriba-derecha, abajo-derecha, abajo-izquierda"""
+        sums = quad.sum(axis=1)
+        diffs = np.diff(quad, axis=1).ravel()
+        return np.array([
+            quad[np.argmin(sums)],
+            quad[np.argmin(diffs)],
+            quad[np.argmax(sums)],
+            quad[np.argmax(diffs)],
+        ], dtype=np.float32)
+
+    def crop(self, image: Image.Image) -> Image.Image:
+        """
+        Recortar y enderezar el ticket (devuelve la misma imagen si no se encuentra)
+        """
+        if not self.active:
+            return image
+
+        try:
+            source = image if image.mode in ('L', 'RGB') else image.convert('RGB')
+            pixels = np.asarray(source)
+            gray = pixels if pixels.ndim == 2 else cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+
+            scale = self.detect_side / max(gray.shape[:2])
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+            quad = self.find_receipt_quad(small)
+            if quad is None:
+                return image
+            if scale < 1:
+                quad /= scale
+
+            corners = self.order_corners(quad)
+            # Margen alrededor del contorno para no cortar texto del borde
+            center = corners.mean(axis=0)
+            corners = center + (corners - center) * (1 + self.margin)
+
+            top_left, top_right, bottom_right, bottom_left = corners
+            width = int(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left)))
+            height = int(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right)))
+            if width < 32 or height < 32:
+                return image
+
+            target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+            matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), target)
+            warped = cv2.warpPerspective(pixels, matrix, (width, height),
+                                         flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            return Image.fromarray(warped)
+        except Exception as e:
+            logger.warning("Error recortando el ticket, se usa la imagen completa", error=str(e))
+            return image
+
+    def get_config(self) -> dict:
+        """Configuración activa del recorte"""
+        return {
+            "enabled": self.enabled,
+            "available": self.available,
+            "detect_side": self.detect_side,
+            "min_area_ratio": self.min_area_ratio,
+            "max_area_ratio": self.max_area_ratio,
+            "margin": self.margin
+        }
@@ -0,0 +1,145 @@
+"""
+Corpus de replay: pares petición/respuesta completos de Gemini guardados
+comprimidos con zstd para reproducir tráfico real sin red
+"""
+
+import glob
+import io
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+import structlog
+import zstandard
+
+logger = structlog.get_logger()
+
+CORPUS_VERSION = 1
+CORPUS_SUFFIX = '.jsonl.zst'
+
+
+def write_records(path: str, records: List[Dict], level: int = 10):
+    """
+    Añadir registros a un fichero del corpus como un frame zstd de JSON lines
+
+    Un fichero puede tener varios frames seguidos (uno por volcado); zstd los
+    lee como un solo flujo.
+    """
+    data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+    with open(path, 'ab') as f:
+        f.write(zstandard.ZstdCompressor(level=level).compress(data))
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    """Leer los registros de un fichero o de todos los ficheros de un directorio del corpus"""
+    paths = sorted(glob.glob(os.path.join(path, f'*{CORPUS_SUFFIX}'))) if os.path.isdir(path) else [path]
+    for corpus_path in paths:
+        with open(corpus_path, 'rb') as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            for line in io.TextIOWrapper(reader, encoding='utf-8'):
+                if line.strip():
+                    yield json.loads(line)
+
+
+class ReplayCorpus:
+    """
+    Grabador del corpus de replay.
+
+    Cada extracción nueva (no cacheada) se guarda con la petición a Gemini
+    (sin la imagen salvo REPLAY_CORPUS_INCLUDE_IMAGES), la respuesta completa
+    del modelo y el resultado final. Los registros se acumulan en memoria y se
+    vuelcan por lotes a un fichero por día, así la compresión aprovecha la
+    repetición entre respuestas. Desactivado si no hay REPLAY_CORPUS_DIR.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        include_images: Optional[bool] = None,
+        flush_records: Optional[int] = None,
+        level: Optional[int] = None,
+    ):
+        self.directory = directory if directory is not None else os.getenv('REPLAY_CORPUS_DIR', '')
+        self.include_images = include_images if include_images is not None else \
+            os.getenv('REPLAY_CORPUS_INCLUDE_IMAGES', 'false').lower() == 'true'
+        self.flush_records = flush_records or int(os.getenv('REPLAY_CORPUS_FLUSH_RECORDS', '50'))
+        self.level = level or int(os.getenv('REPLAY_CORPUS_ZSTD_LEVEL', '10'))
+
+        self._buffer: List[Dict] = []
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.bytes_written = 0
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def current_path(self) -> str:
+        """Fichero del día (uno por proceso para no mezclar frames de varios escritores)"""
+        return os.path.join(self.directory, f"{datetime.now().strftime('%Y-%m-%d')}-{os.getpid()}{CORPUS_SUFFIX}")
+
+    def record(
+        self,
+        image_hash: str,
+        request: Dict,
+        response_text: str,
+        result: Dict,
+        image_base64: Optional[str] = None,
+    ):
+        """Guardar un par petición/respuesta (se vuelca al llenar el lote)"""
+        if not self.enabled:
+            return
+
+        entry = {
+            "version": CORPUS_VERSION,
+            "recorded_at": time.time(),
+            "image_hash": image_hash,
+            "request": request,
+            "response": response_text,
+            "result": result,
+        }
+        if self.include_images and image_base64:
+            entry["image_base64"] = image_base64
+
+        with self._lock:
+            self._buffer.append(entry)
+            self.recorded += 1
+            if len(self._buffer) < self.flush_records:
+                return
+            records, self._buffer = self._buffer, []
+        self._write(records)
+
+    def flush(self):
+        """Volcar los registros pendientes (al apagar el servicio)"""
+        with self._lock:
+            records, self._buffer = self._buffer, []
+        if records:
+            self._write(records)
+
+    def _write(self, records: List[Dict]):
+        path = self.current_path()
+        try:
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            write_records(path, records, self.level)
+            self.bytes_written += os.path.getsize(path) - size
+        except Exception as e:
+            logger.warning("Error escribiendo el corpus de replay", error=str(e), path=path)
+
+    def get_stats(self) -> Dict:
+        """Estado del grabador"""
+        with self._lock:
+            pending = len(self._buffer)
+        return {
+            "enabled": self.enabled,
+            "directory": self.directory or None,
+            "include_images": self.include_images,
+            "recorded": self.recorded,
+            "pending": pending,
+            "bytes_written": self.bytes_written
+        }
@@ -0,0 +1,30 @@
+"""
+Firma HMAC de los resultados de extracción que se envían al ticket service
+"""
+
+import hashlib
+import hmac
+import json
+import os
+from typing import Dict, Optional
+
+SIGNATURE_FIELD = 'result_signature'
+
+
+def canonical_result(result: Dict) -> bytes:
+    """Serialización estable del resultado (sin el campo de firma)"""
+    payload = {key: value for key, value in result.items() if key != SIGNATURE_FIELD}
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=True).encode('utf-8')
+
+
+def sign_result(result: Dict, key: Optional[str] = None) -> Optional[str]:
+    """
+    Firmar un resultado con HMAC-SHA256
+
+    Returns:
+        Firma en hexadecimal, o None si no hay clave configurada
+    """
+    key = key or os.getenv('AI_RESULT_SIGNING_KEY')
+    if not key:
+        return None
+    return hmac.new(key.encode('utf-8'), canonical_result(result), hashlib.sha256).hexdigest()
@@ -0,0 +1,51 @@
+"""
+Agrupación de peticiones idénticas en vuelo (single-flight)
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """
+    Ejecuta una sola vez el trabajo para cada clave mientras está en vuelo.
+
+    Si llegan varias peticiones con la misma clave (p. ej. el hash de la
+    imagen) a la vez, solo la primera lanza la tarea y el resto espera su
+    resultado. El trabajo corre en una tarea propia protegida con
+    `asyncio.shield`, así que cancelar a un llamante no lo cancela para los demás.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Ejecutar `fn` o unirse a la ejecución en curso para `key`
+
+        Returns:
+            Tupla (resultado, coalesced) donde coalesced indica si se reutilizó
+            una ejecución ya en vuelo
+        """
+        task = self._in_flight.get(key)
+        coalesced = task is not None
+
+        if coalesced:
+            self.coalesced += 1
+        else:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _, key=key: self._in_flight.pop(key, None))
+
+        return await asyncio.shield(task), coalesced
+
+    def get_stats(self) -> Dict:
+        """Contadores de ejecuciones y peticiones agrupadas"""
+        return {
+            "in_flight": len(self._in_flight),
+            "executions": self.executions,
+            "coalesced": self.coalesced
+        }
@@ -0,0 +1,251 @@
+"""
+Verificación de tiendas del mercado en el propio proceso: autómata
+Aho-Corasick sobre los nombres normalizados, con la lista de tiendas en
+caché y recargada por TTL o cuando cambia su versión en el ticket service
+"""
+
+import os
+import threading
+import time
+import unicodedata
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+import requests
+import structlog
+
+logger = structlog.get_logger()
+
+
+def normalize_store_name(name: str) -> str:
+    """Minúsculas, sin acentos y con los espacios colapsados ("Fruites  Maria" == "fruites maría")"""
+    decomposed = unicodedata.normalize('NFKD', name or '')
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(without_accents.casefold().split())
+
+
+class StoreAutomaton:
+    """
+    Autómata Aho-Corasick inmutable sobre los nombres de las tiendas.
+
+    Buscar un nombre cuesta O(len(nombre)) independientemente del número de
+    tiendas. Una tienda coincide si su nombre normalizado aparece dentro del
+    nombre leído del ticket (misma semántica que la comparación por
+    subcadenas de antes, ahora sin distinguir acentos).
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.names: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Optional[int]] = [None]
+
+        for name in names:
+            pattern = normalize_store_name(name)
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                state = next_state
+            if self._output[state] is None:
+                self._output[state] = len(self.names)
+            self.names.append(name)
+
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        """Enlaces de fallo por anchura; cada estado hereda la salida de su enlace"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def find(self, store_name: Optional[str]) -> Optional[str]:
+        """Primera tienda del mercado contenida en el nombre, o None"""
+        if not store_name or not self.names:
+            return None
+        state = 0
+        for char in normalize_store_name(store_name):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state] is not None:
+                return self.names[self._output[state]]
+        return None
+
+    def matches(self, store_name: Optional[str]) -> bool:
+        return self.find(store_name) is not None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+class MarketStoreMatcher:
+    """
+    Lista de tiendas del mercado en caché con su autómata.
+
+    La lista se descarga del ticket service la primera vez y se recarga
+    cuando cambia su versión (GET /market-stores/version, consultado como
+    mucho cada MARKET_STORES_VERSION_POLL segundos) o, como red de
+    seguridad, cada MARKET_STORES_TTL segundos. La recarga la hace un solo
+    hilo; el resto sigue usando el autómata anterior, así que verificar una
+    tienda no hace llamadas de red. Si la recarga falla se mantiene la lista
+    que había.
+    """
+
+    def __init__(
+        self,
+        ticket_service_url: Optional[str] = None,
+        ttl_seconds: Optional[float] = None,
+        version_poll_seconds: Optional[float] = None,
+        page_size: int = 500,
+    ):
+        self.ticket_service_url = (ticket_service_url or os.getenv('TICKET_SERVICE_URL', 'http://ticket-service:8003')).rstrip('/')
+        self.ttl_seconds = ttl_seconds or float(os.getenv('MARKET_STORES_TTL', '600'))
+        self.version_poll_seconds = version_poll_seconds if version_poll_seconds is not None else \
+            float(os.getenv('MARKET_STORES_VERSION_POLL', '30'))
+        self.page_size = page_size
+
+        self.automaton = StoreAutomaton([])
+        self.version: Optional[str] = None
+        self.loaded_at = 0.0
+        self.version_checked_at = 0.0
+        self.version_supported = True
+        self.retry_at = 0.0
+        self._refresh_lock = threading.Lock()
+
+        self.reloads = 0
+        self.version_checks = 0
+        self.refresh_errors = 0
+        self.lookups = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at > 0
+
+    def fetch_store_names(self) -> List[str]:
+        """Nombres de todas las tiendas activas (paginando el endpoint)"""
+        names, skip = [], 0
+        while True:
+            response = requests.get(
+                f"{self.ticket_service_url}/market-stores/",
+                params={"skip": skip, "limit": self.page_size},
+                timeout=10
+            )
+            response.raise_for_status()
+            page = response.json()
+            names.extend(store.get('name', '') for store in page if store.get('is_active', True))
+            if len(page) < self.page_size:
+                return names
+            skip += self.page_size
+
+    def fetch_version(self) -> Optional[str]:
+        """Versión de la lista en el ticket service (None si el endpoint no existe)"""
+        response = requests.get(f"{self.ticket_service_url}/market-stores/version", timeout=5)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json().get('version')
+
+    def reload(self, version: Optional[str] = None):
+        """Descargar la lista y construir un autómata nuevo"""
+        names = self.fetch_store_names()
+        self.automaton = StoreAutomaton(names)
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.reloads += 1
+        logger.info("Tiendas del mercado cargadas", stores=len(names), version=version)
+
+    def _pending_work(self, now: float):
+        """(lista caducada, toca consultar la versión)"""
+        expired = not self.loaded or now - self.loaded_at >= self.ttl_seconds
+        poll_due = self.version_supported and now - self.version_checked_at >= self.version_poll_seconds
+        return expired, poll_due
+
+    def refresh(self, force: bool = False):
+        """Recargar la lista si ha caducado o ha cambiado su versión"""
+        expired, poll_due = self._pending_work(time.monotonic())
+        if not force and not (expired or poll_due):
+            return
+        if not force and time.monotonic() < self.retry_at:
+            return
+
+        # Sin lista todavía hay que esperarla; con lista, solo un hilo refresca
+        if not self._refresh_lock.acquire(blocking=not self.loaded):
+            return
+        try:
+            now = time.monotonic()
+            expired, poll_due = self._pending_work(now)
+            expired = expired or force
+            if not (expired or poll_due):
+                return  # otro hilo acaba de refrescar
+            version = self.version
+            if self.version_supported:
+                self.version_checked_at = now
+                self.version_checks += 1
+                version = self.fetch_version()
+                if version is None:
+                    self.version_supported = False
+                    logger.info("Ticket service sin /market-stores/version, recarga solo por TTL")
+            if expired or version != self.version:
+                self.reload(version)
+        except Exception as e:
+            # No reintentar en cada ticket mientras el ticket service no responde
+            self.refresh_errors += 1
+            self.retry_at = time.monotonic() + max(5.0, self.version_poll_seconds)
+            logger.warning("Error actualizando las tiendas del mercado", error=str(e))
+        finally:
+            self._refresh_lock.release()
+
+    def find(self, store_name: Optional[str]) -> Optional[str]:
+        """Tienda del mercado que coincide con el nombre leído del ticket, o None"""
+        self.lookups += 1
+        self.refresh()
+        return self.automaton.find(store_name)
+
+    def matches(self, store_name: Optional[str]) -> bool:
+        return self.find(store_name) is not None
+
+    @property
+    def names(self) -> List[str]:
+        self.refresh()
+        return list(self.automaton.names)
+
+    def get_stats(self) -> Dict:
+        """Estado de la caché de tiendas"""
+        return {
+            "stores": len(self.automaton),
+            "version": self.version,
+            "age_seconds": round(time.monotonic() - self.loaded_at, 1) if self.loaded else None,
+            "ttl_seconds": self.ttl_seconds,
+            "version_poll_seconds": self.version_poll_seconds if self.version_supported else None,
+            "lookups": self.lookups,
+            "reloads": self.reloads,
+            "version_checks": self.version_checks,
+            "refresh_errors": self.refresh_errors
+        }
+
+
+# Instancia compartida por el sistema de IA y el procesador automático
+market_store_matcher = None
+
+def get_market_store_matcher() -> MarketStoreMatcher:
+    """Obtener la caché de tiendas del mercado del proceso"""
+    global market_store_matcher
+    if market_store_matcher is None:
+        market_store_matcher = MarketStoreMatcher()
+    return market_store_matcher
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Servidor stub de la API de Gemini para pruebas sin conexión
+
+Responde a generateContent con respuestas enlatadas, imitando el formato real
+de la API. Si la petición pide modo JSON (generationConfig.responseMimeType)
+devuelve el JSON tal cual; si no, lo envuelve en un bloque ```json como hace
+el modelo con texto libre.
+
+Uso:
+    python stub_gemini_server.py --port 8090
+    GEMINI_API_BASE=http://localhost:8090 GEMINI_API_KEY=stub python main.py
+
+Respuestas:
+    --responses-dir DIR   ficheros <sha256 de la imagen>.json con la respuesta
+                          para cada imagen; default.json para el resto. Un
+                          subdirectorio con el nombre de un modelo tiene
+                          prioridad para ese modelo (pruebas de la cascada)
+    --latency-ms N        latencia añadida a cada respuesta
+    --tail-rate F         fracción de peticiones lentas (cola de latencia, 0-1)
+    --tail-latency-ms N   latencia de las peticiones lentas
+    --failure-rate F      fracción de peticiones que devuelven 503 (0-1)
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+DEFAULT_RESPONSE = {
+    "fecha": "15/03/2024",
+    "hora": "10:32",
+    "tienda": "Fruites Maria",
+    "total": 12.45,
+    "tipo_ticket": "supermercado",
+    "productos": [
+        {"cantidad": 1, "nombre": "Pomes Golden", "precio": 3.2},
+        {"cantidad": 2, "nombre": "Plàtans", "precio": 4.1},
+        {"cantidad": 1, "nombre": "Taronges", "precio": 5.15}
+    ]
+}
+
+app = FastAPI(title="Gemini API stub")
+app.state.responses_dir = os.getenv('STUB_GEMINI_RESPONSES_DIR')
+app.state.latency_ms = float(os.getenv('STUB_GEMINI_LATENCY_MS', '0'))
+app.state.failure_rate = float(os.getenv('STUB_GEMINI_FAILURE_RATE', '0'))
+app.state.tail_rate = float(os.getenv('STUB_GEMINI_TAIL_RATE', '0'))
+app.state.tail_latency_ms = float(os.getenv('STUB_GEMINI_TAIL_LATENCY_MS', '20000'))
+app.state.requests = 0
+
+
+def load_canned_response(image_hash: str, model: str = "") -> dict:
+    """Respuesta enlatada para una imagen (por SHA-256) o la respuesta por defecto"""
+    responses_dir = app.state.responses_dir
+    if responses_dir:
+        for directory in (os.path.join(responses_dir, model), responses_dir):
+            for name in (f"{image_hash}.json", "default.json"):
+                path = os.path.join(directory, name)
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        return json.load(f)
+    return DEFAULT_RESPONSE
+
+
+def extract_image_hash(payload: dict) -> str:
+    """SHA-256 de la primera imagen inline de la petición"""
+    for content in payload.get('contents', []):
+        for part in content.get('parts', []):
+            inline_data = part.get('inline_data') or part.get('inlineData')
+            if inline_data and inline_data.get('data'):
+                return hashlib.sha256(base64.b64decode(inline_data['data'])).hexdigest()
+    return ""
+
+
+@app.post("/v1beta/models/{model_action}")
+async def generate_content(model_action: str, request: Request):
+    """Imitar POST /v1beta/models/{model}:generateContent"""
+    model, _, action = model_action.partition(':')
+    if action != 'generateContent':
+        raise HTTPException(status_code=404, detail=f"Acción no soportada: {action}")
+
+    app.state.requests += 1
+    payload = await request.json()
+
+    latency_ms = app.state.latency_ms
+    if app.state.tail_rate and random.random() < app.state.tail_rate:
+        latency_ms = app.state.tail_latency_ms
+    if latency_ms:
+        await asyncio.sleep(latency_ms / 1000)
+
+    if app.state.failure_rate and random.random() < app.state.failure_rate:
+        return JSONResponse(status_code=503, content={"error": {"code": 503, "status": "UNAVAILABLE"}})
+
+    canned = load_canned_response(extract_image_hash(payload), model)
+    structured = payload.get('generationConfig', {}).get('responseMimeType') == 'application/json'
+    text = json.dumps(canned, ensure_ascii=False)
+    if not structured:
+        text = f"```json\n{text}\n```"
+
+    return {
+        "candidates": [
+            {
+                "content": {"parts": [{"text": text}], "role": "model"},
+                "finishReason": "STOP"
+            }
+        ],
+        "modelVersion": model
+    }
+
+
+@app.get("/stats")
+async def stats():
+    """Número de peticiones recibidas (útil para comprobar aciertos de caché)"""
+    return {"requests": app.state.requests}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--responses-dir', default=app.state.responses_dir)
+    parser.add_argument('--latency-ms', type=float, default=app.state.latency_ms)
+    parser.add_argument('--failure-rate', type=float, default=app.state.failure_rate)
+    parser.add_argument('--tail-rate', type=float, default=app.state.tail_rate)
+    parser.add_argument('--tail-latency-ms', type=float, default=app.state.tail_latency_ms)
+    args = parser.parse_args()
+
+    app.state.responses_dir = args.responses_dir
+    app.state.latency_ms = args.latency_ms
+    app.state.failure_rate = args.failure_rate
+    app.state.tail_rate = args.tail_rate
+    app.state.tail_latency_ms = args.tail_latency_ms
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
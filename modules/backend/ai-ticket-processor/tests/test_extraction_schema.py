@@ -0,0 +1,90 @@
+"""
+Tests del parseo de respuestas de Gemini en modo JSON (GEMINI_STRUCTURED_OUTPUT=true)
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_system import GeminiTicketAI  # noqa: E402
+from extraction_schema import TicketExtraction, parse_partial_response, parse_structured_response  # noqa: E402
+
+CANNED_RESPONSE = {
+    "fecha": "15/03/2024",
+    "hora": "10:32",
+    "tienda": "Fruites Maria",
+    "total": 12.45,
+    "tipo_ticket": "supermercado",
+    "productos": [
+        {"cantidad": 1, "nombre": "Pomes Golden", "precio": 3.2},
+        {"cantidad": 2, "nombre": "Plàtans", "precio": 4.1},
+        {"cantidad": 1, "nombre": "Taronges", "precio": 5.15}
+    ]
+}
+
+
+@pytest.fixture
+def structured_ai():
+    """GeminiTicketAI sin inicializar: parse_gemini_response solo usa structured_output"""
+    ai = GeminiTicketAI.__new__(GeminiTicketAI)
+    ai.structured_output = True
+    return ai
+
+
+def test_ticket_extraction_from_canned_response():
+    extraction = TicketExtraction.model_validate(CANNED_RESPONSE)
+    assert extraction.tienda == "Fruites Maria"
+    assert extraction.total == 12.45
+    assert [producto.nombre for producto in extraction.productos] == ["Pomes Golden", "Plàtans", "Taronges"]
+
+
+def test_parse_structured_response_types():
+    parsed = parse_structured_response(json.dumps(CANNED_RESPONSE))
+    assert parsed["tipo_ticket"] == "supermercado"
+    assert isinstance(parsed["total"], float)
+    assert parsed["productos"][1] == {"cantidad": 2.0, "nombre": "Plàtans", "precio": 4.1}
+
+
+def test_parse_structured_response_nulls_and_extra_fields():
+    response = {**CANNED_RESPONSE, "total": None, "tienda": None, "moneda": "EUR", "productos": []}
+    parsed = parse_structured_response(json.dumps(response))
+    assert parsed["total"] is None
+    assert parsed["tienda"] is None
+    assert "moneda" not in parsed
+
+
+def test_parse_gemini_response_structured_mode(structured_ai):
+    parsed = structured_ai.parse_gemini_response(json.dumps(CANNED_RESPONSE, ensure_ascii=False))
+    assert parsed["fecha"] == "15/03/2024"
+    assert len(parsed["productos"]) == 3
+
+
+@pytest.mark.parametrize("changes", [
+    {"total": "doce euros"},
+    {"productos": [{"cantidad": 1, "precio": 3.2}]},
+    {"productos": [{"nombre": "Pomes", "precio": "caro"}]},
+    {"productos": "Pomes Golden"},
+])
+def test_parse_gemini_response_rejects_bad_types(structured_ai, changes):
+    with pytest.raises(ValueError, match="no cumple el esquema"):
+        structured_ai.parse_gemini_response(json.dumps({**CANNED_RESPONSE, **changes}))
+
+
+def test_parse_gemini_response_rejects_unknown_tipo_ticket(structured_ai):
+    with pytest.raises(ValueError, match="no cumple el esquema"):
+        structured_ai.parse_gemini_response(json.dumps({**CANNED_RESPONSE, "tipo_ticket": "ferreteria"}))
+
+
+def test_parse_gemini_response_rejects_free_text(structured_ai):
+    text = f"```json\n{json.dumps(CANNED_RESPONSE)}\n```"
+    with pytest.raises(ValueError):
+        structured_ai.parse_gemini_response(text)
+
+
+def test_parse_partial_response_only_requested_fields():
+    text = f"Campos corregidos: {json.dumps({'total': 12.45, 'fecha': '15/03/2024'})}"
+    assert parse_partial_response(text, ["total"]) == {"total": 12.45}
@@ -0,0 +1,58 @@
+"""
+Tests de la validación de extracciones con totales y precios en texto o nulos
+(GEMINI_STRUCTURED_OUTPUT=false)
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction_validator import (  # noqa: E402
+    ALL_CHECKS, ISSUE_MISSING_TOTAL, ISSUE_SUM_MISMATCH, parse_amount, products_sum_matches,
+    score_fields, validate_extraction
+)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (12.5, 12.5),
+    (3, 3.0),
+    ("12.50", 12.5),
+    ("12,50 €", 12.5),
+    ("1.234,56", 1234.56),
+    ("1,234.56", 1234.56),
+    (None, None),
+    ("", None),
+    ("N/A", None),
+    (True, None),
+])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+
+def test_sum_with_string_total_and_prices():
+    parsed = {'total': "5,40", 'productos': [{'precio': "1.20", 'cantidad': "2"}, {'precio': "3,00"}]}
+    assert products_sum_matches(parsed) is True
+
+
+def test_sum_mismatch_with_string_total():
+    parsed = {'total': "9.99", 'productos': [{'precio': "1.20"}]}
+    assert products_sum_matches(parsed) is False
+    assert ISSUE_SUM_MISMATCH in validate_extraction(parsed, list(ALL_CHECKS))
+
+
+@pytest.mark.parametrize("total", [None, "N/A"])
+def test_sum_without_numeric_total_is_not_checked(total):
+    parsed = {'total': total, 'productos': [{'precio': "1.20"}, {'precio': None}, "pan"]}
+    assert products_sum_matches(parsed) is None
+    assert ISSUE_SUM_MISMATCH not in validate_extraction(parsed, list(ALL_CHECKS))
+
+
+def test_score_fields_with_string_and_none_totals():
+    products = [{'precio': "2.50"}]
+    assert score_fields({'total': "2,50", 'productos': products})['total'] == 1.0
+    assert score_fields({'total': "total ilegible", 'productos': products})['total'] == 0.5
+    assert score_fields({'total': None, 'productos': products})['total'] == 0.0
+    assert ISSUE_MISSING_TOTAL in validate_extraction({'total': None}, list(ALL_CHECKS))
@@ -0,0 +1,82 @@
+"""
+Tests del cliente de Gemini contra el servidor stub (stub_gemini_server.py)
+"""
+
+import asyncio
+import base64
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stub_gemini_server  # noqa: E402
+from ai_system import GeminiTicketAI  # noqa: E402
+from gemini_client import GeminiUnavailableError  # noqa: E402
+
+IMAGE_BASE64 = base64.b64encode(b"ticket de prueba").decode('ascii')
+
+
+@pytest.fixture(scope="module")
+def stub_url():
+    """Servidor stub de Gemini en un puerto libre, en un hilo aparte"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(stub_gemini_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            pytest.fail("El servidor stub de Gemini no arrancó")
+        time.sleep(0.05)
+
+    yield f"http://127.0.0.1:{port}"
+
+    server.should_exit = True
+    thread.join(timeout=10)
+
+
+def make_ai(monkeypatch, stub_url, structured: bool) -> GeminiTicketAI:
+    monkeypatch.setenv('GEMINI_API_KEY', 'stub')
+    monkeypatch.setenv('GEMINI_API_BASE', stub_url)
+    monkeypatch.setenv('GEMINI_STRUCTURED_OUTPUT', 'true' if structured else 'false')
+    monkeypatch.setenv('GEMINI_MAX_RETRIES', '0')
+    monkeypatch.delenv('GEMINI_MODEL_CASCADE', raising=False)
+    return GeminiTicketAI()
+
+
+async def extract(ai: GeminiTicketAI):
+    try:
+        response_text = await ai.call_gemini_api(IMAGE_BASE64)
+        return ai.parse_gemini_response(response_text)
+    finally:
+        for client in ai.gemini_clients.values():
+            await client.aclose()
+
+
+@pytest.mark.parametrize("structured", [True, False])
+def test_extraction_against_stub(monkeypatch, stub_url, structured):
+    ai = make_ai(monkeypatch, stub_url, structured)
+    parsed = asyncio.run(extract(ai))
+
+    expected = stub_gemini_server.DEFAULT_RESPONSE
+    assert parsed["tienda"] == expected["tienda"]
+    assert float(parsed["total"]) == expected["total"]
+    assert [producto["nombre"] for producto in parsed["productos"]] == [
+        producto["nombre"] for producto in expected["productos"]
+    ]
+
+
+def test_stub_unavailable_raises(monkeypatch, stub_url):
+    monkeypatch.setattr(stub_gemini_server.app.state, "failure_rate", 1.0)
+    ai = make_ai(monkeypatch, stub_url, structured=True)
+    with pytest.raises(GeminiUnavailableError):
+        asyncio.run(extract(ai))
@@ -0,0 +1,108 @@
+"""
+Escucha de notificaciones de Postgres (LISTEN/NOTIFY) para tickets nuevos
+"""
+
+import select
+import threading
+import time
+from typing import Callable, Optional
+
+import psycopg2
+import psycopg2.extensions
+import structlog
+
+logger = structlog.get_logger()
+
+# Canal en el que el ticket service notifica los tickets pendientes
+TICKET_PENDING_CHANNEL = "ticket_pending"
+
+
+class TicketNotificationListener:
+    """
+    Hilo que hace LISTEN sobre el canal de tickets pendientes y llama a
+    `on_notify(payload)` en cuanto llega una notificación. Si se pierde la
+    conexión se reconecta con espera exponencial.
+    """
+
+    def __init__(
+        self,
+        database_url: str,
+        on_notify: Callable[[str], None],
+        channel: str = TICKET_PENDING_CHANNEL,
+        poll_timeout: float = 5.0,
+    ):
+        self.database_url = database_url
+        self.on_notify = on_notify
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+
+        self.is_running = False
+        self.is_connected = False
+        self.notifications_received = 0
+        self.last_notification_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Arrancar el hilo de escucha"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ticket-listener")
+        self._thread.start()
+
+    def stop(self):
+        """Detener el hilo de escucha"""
+        self.is_running = False
+        if self._thread:
+            self._thread.join(timeout=self.poll_timeout + 1)
+
+    def _run(self):
+        backoff = 1.0
+        while self.is_running:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.database_url)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel};")
+
+                self.is_connected = True
+                backoff = 1.0
+                print(f"👂 Escuchando notificaciones de tickets en el canal '{self.channel}'")
+                logger.info("Ticket listener connected", channel=self.channel)
+
+                while self.is_running:
+                    ready, _, _ = select.select([conn], [], [], self.poll_timeout)
+                    if not ready:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        self.notifications_received += 1
+                        self.last_notification_at = time.time()
+                        try:
+                            self.on_notify(notification.payload)
+                        except Exception as e:
+                            logger.error("Error handling ticket notification", error=str(e))
+
+            except Exception as e:
+                self.is_connected = False
+                logger.warning("Ticket listener disconnected", error=str(e), retry_in=backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                self.is_connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def get_stats(self) -> dict:
+        """Estado del listener"""
+        return {
+            "channel": self.channel,
+            "connected": self.is_connected,
+            "notifications_received": self.notifications_received,
+            "last_notification_at": self.last_notification_at
+        }
@@ -34,6 +34,9 @@ class Settings:
     
     # Configuración de detección de duplicados
     ENABLE_DUPLICATE_DETECTION: bool = os.getenv("ENABLE_DUPLICATE_DETECTION", "true").lower() == "true"
+    
+    # Clave compartida con el AI Ticket Processor para aceptar resultados ya calculados
+    AI_RESULT_SIGNING_KEY: str = os.getenv("AI_RESULT_SIGNING_KEY", "")
 
 # Instancia global de configuración
 settings = Settings() 
\ No newline at end of file
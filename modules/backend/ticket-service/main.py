@@ -1,8 +1,10 @@
 from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import os
+import json
 import uuid
 import shutil
 from datetime import datetime, timedelta
@@ -11,17 +13,30 @@ from database import get_db
 from models import Ticket, MarketStore
 from schemas import (
     TicketCreate, TicketResponse, TicketUploadResponse, 
-    MarketStoreCreate, MarketStoreResponse, MarketStoreUpdate,
-    TicketProcessingResult
+    MarketStoreCreate, MarketStoreResponse, MarketStoreUpdate, MarketStoreVersionResponse,
+    TicketProcessingResult, SignedProcessingResult,
+    TicketClaimRequest, TicketClaimResponse, TicketReleaseRequest, TicketRequeueRequest,
+    DeadLetterResponse, DeadLetterRequeueRequest
 )
 from market_store_service import MarketStoreService
 from purchase_history_client import get_purchase_history_client
 from gamification_client import get_gamification_client
 from config import settings
+from result_signing import SIGNATURE_FIELD, check_signing_key, verify_result_signature, compute_file_hash
+from ticket_queue import (
+    notify_ticket_pending, claim_tickets, requeue_tickets, release_ticket, clear_lease, is_lease_held_by_other,
+    renew_leases, next_retry_at, schedule_retry, is_retryable_result,
+    TICKET_PRIORITIES, REQUEUEABLE_STATUSES, DEAD_LETTER_STATUS
+)
 # Configuración del AI Ticket Processor
 AI_PROCESSOR_URL = "http://ai-ticket-processor:8004"
 AI_AVAILABLE = True
 print("✅ AI system disponible via HTTP")
+check_signing_key()
+
+# Procesamiento manual de pendientes: tickets reclamados por lote y lease de cada lote
+PROCESS_PENDING_BATCH_SIZE = int(os.getenv("PROCESS_PENDING_BATCH_SIZE", "10"))
+PROCESS_PENDING_LEASE_SECONDS = int(os.getenv("PROCESS_PENDING_LEASE_SECONDS", "300"))
 
 app = FastAPI(title="Ticket Service API", version="1.0.0")
 
@@ -51,30 +66,49 @@ def get_market_store_service(db: Session = Depends(get_db)):
 
 import requests
 
-def process_ticket_with_ai(file_path: str, market_service) -> dict:
-    """Procesar ticket usando el AI Ticket Processor via HTTP"""
+class AIProcessorUnavailable(Exception):
+    """El AI Ticket Processor no puede procesar ahora (Gemini degradado); reintentar más tarde"""
+    
+    def __init__(self, message: str, retry_after: int = 30):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def process_ticket_with_ai(file_path: str, user_id: uuid.UUID = None, ticket_id: uuid.UUID = None) -> dict:
+    """
+    Procesar ticket usando el AI Ticket Processor via HTTP (imagen en binario)
+    
+    La IA verifica la tienda con su propia copia en caché de las tiendas del
+    mercado, así que no se envía la lista con cada ticket.
+    
+    Raises:
+        AIProcessorUnavailable: si la IA responde 503; el ticket debe seguir pendiente
+    """
     try:
-        # Leer el archivo y convertirlo a base64
-        import base64
+        # Leer el archivo tal cual, sin convertirlo a base64
         with open(file_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
+            image_data = image_file.read()
         
-        # Preparar datos para el AI processor
-        payload = {
-            "image_base64": image_data,
-            "market_stores": market_service.get_market_store_names()
-        }
-        
-        # Llamar al AI Ticket Processor
+        # Llamar al AI Ticket Processor con los metadatos en cabeceras
         response = requests.post(
             f"{AI_PROCESSOR_URL}/process-ticket-api",
-            json=payload,
+            data=image_data,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "X-User-Id": str(user_id) if user_id else "",
+                "X-Ticket-Id": str(ticket_id) if ticket_id else ""
+            },
             timeout=60
         )
         
         if response.status_code == 200:
             result = response.json()
             return result
+        elif response.status_code == 503:
+            try:
+                retry_after = int(response.headers.get("Retry-After", 30))
+            except ValueError:
+                retry_after = 30
+            raise AIProcessorUnavailable(f"AI processor no disponible: {response.text}", retry_after)
         else:
             return {
                 "error": f"AI processor error: {response.status_code}",
@@ -82,6 +116,8 @@ def process_ticket_with_ai(file_path: str, market_service) -> dict:
                 "procesado_correctamente": False
             }
             
+    except AIProcessorUnavailable:
+        raise
     except Exception as e:
         return {
             "error": str(e),
@@ -378,6 +414,12 @@ def get_market_stores(
     service = MarketStoreService(db)
     return service.get_all_market_stores(skip=skip, limit=limit)
 
+@app.get("/market-stores/version", response_model=MarketStoreVersionResponse)
+def get_market_stores_version(db: Session = Depends(get_db)):
+    """Versión de la lista de tiendas (los clientes con caché la consultan para saber si recargarla)"""
+    service = MarketStoreService(db)
+    return service.get_market_stores_version()
+
 @app.get("/market-stores/{market_store_id}", response_model=MarketStoreResponse)
 def get_market_store(
     market_store_id: uuid.UUID,
@@ -430,14 +472,23 @@ def verify_market_store(store_name: str, db: Session = Depends(get_db)):
 async def upload_ticket(
     file: UploadFile = File(...),
     user_id: str = Form(...),
+    priority: str = Form("interactive"),
     db: Session = Depends(get_db)
 ):
-    """Subir un nuevo ticket"""
+    """
+    Subir un nuevo ticket
+    
+    `priority` indica la clase en la cola de procesamiento: las subidas de
+    usuarios son `interactive`; las importaciones masivas deberían usar `backfill`.
+    """
     try:
         # Validar archivo
         if not file.filename:
             raise HTTPException(status_code=400, detail="Nombre de archivo requerido")
         
+        if priority not in TICKET_PRIORITIES:
+            raise HTTPException(status_code=400, detail=f"Prioridad no válida. Usa: {', '.join(TICKET_PRIORITIES)}")
+        
         # Generar nombre único
         file_extension = os.path.splitext(file.filename)[1]
         unique_filename = f"{uuid.uuid4()}{file_extension}"
@@ -459,7 +510,8 @@ async def upload_ticket(
             ticket_metadata={
                 "file_size": saved_file_size,
                 "mime_type": file.content_type,
-                "upload_timestamp": datetime.now().isoformat()
+                "upload_timestamp": datetime.now().isoformat(),
+                "priority": priority
             }
         )
         
@@ -472,10 +524,13 @@ async def upload_ticket(
             file_size=saved_file_size,
             mime_type=file.content_type,
             ticket_metadata=ticket_data.ticket_metadata,
-            status="pending"
+            status="pending",
+            queued_at=datetime.now()
         )
         
         db.add(db_ticket)
+        # Avisar al procesador automático (se entrega al hacer commit)
+        notify_ticket_pending(db, db_ticket.id)
         db.commit()
         db.refresh(db_ticket)
         
@@ -484,6 +539,8 @@ async def upload_ticket(
             ticket=TicketResponse.from_orm(db_ticket)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error subiendo ticket: {str(e)}")
 
@@ -646,45 +703,211 @@ def get_tickets(
         response_tickets.append(response_dict)
     return response_tickets
 
-@app.get("/tickets/pending/", response_model=List[dict])
-def get_pending_tickets(db: Session = Depends(get_db)):
-    """Obtener todos los tickets pendientes de procesamiento con imagen en base64"""
-    tickets = db.query(Ticket).filter(Ticket.status == "pending").all()
+@app.get("/tickets/pending/", response_model=List[TicketResponse])
+def get_pending_tickets(limit: int = 100, offset: int = 0, db: Session = Depends(get_db)):
+    """
+    Obtener los tickets pendientes de procesamiento (más antiguo primero)
     
-    result = []
-    for ticket in tickets:
-        ticket_data = TicketResponse.from_orm(ticket).dict()
-        
-        # Leer la imagen y convertirla a base64
-        try:
-            import base64
-            with open(ticket.file_path, 'rb') as file:
-                image_data = file.read()
-                image_base64 = base64.b64encode(image_data).decode('utf-8')
-                ticket_data['image_base64'] = image_base64
-        except Exception as e:
-            print(f"Error leyendo imagen para ticket {ticket.id}: {str(e)}")
-            ticket_data['image_base64'] = None
-        
-        result.append(ticket_data)
+    Solo devuelve identificadores y metadatos; la imagen de cada ticket se
+    descarga en binario desde /tickets/{ticket_id}/image
+    """
+    limit = max(1, min(limit, 1000))
+    return db.query(Ticket).filter(Ticket.status == "pending")\
+        .order_by(Ticket.created_at)\
+        .offset(max(0, offset))\
+        .limit(limit)\
+        .all()
+
+@app.get("/tickets/pending/count")
+def get_pending_tickets_count(db: Session = Depends(get_db)):
+    """Número de tickets pendientes de procesamiento"""
+    return {"count": db.query(Ticket).filter(Ticket.status == "pending").count()}
+
+@app.get("/tickets/{ticket_id}/image")
+def get_ticket_image(ticket_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Descargar la imagen de un ticket en binario (se envía por bloques desde disco)"""
+    ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+    if not ticket:
+        raise HTTPException(status_code=404, detail="Ticket no encontrado")
+    
+    if not ticket.file_path or not os.path.exists(ticket.file_path):
+        raise HTTPException(status_code=404, detail="Imagen del ticket no encontrada")
+    
+    return FileResponse(
+        ticket.file_path,
+        media_type=ticket.mime_type or "application/octet-stream",
+        headers={
+            "X-Ticket-Id": str(ticket.id),
+            "X-User-Id": str(ticket.user_id)
+        }
+    )
+
+@app.post("/tickets/claim/", response_model=TicketClaimResponse)
+def claim_pending_tickets(request: TicketClaimRequest, db: Session = Depends(get_db)):
+    """
+    Reclamar un lote de tickets pendientes para un worker
+    
+    Los tickets pasan a `processing` con un lease; si el worker no los
+    procesa antes de que caduque, otro worker puede volver a reclamarlos.
+    La respuesta incluye el próximo reintento programado para que el worker
+    se despierte a tiempo.
+    """
+    tickets = claim_tickets(
+        db,
+        worker_id=request.worker_id,
+        batch_size=request.batch_size,
+        lease_seconds=request.lease_seconds,
+        ticket_ids=request.ticket_ids,
+        priority_weights=request.priority_weights,
+        default_priority=request.default_priority,
+        max_age_seconds=request.max_age_seconds
+    )
+    
+    return TicketClaimResponse(
+        worker_id=request.worker_id,
+        lease_expires_at=tickets[0].lease_expires_at if tickets else None,
+        tickets=[TicketResponse.from_orm(ticket) for ticket in tickets],
+        next_attempt_at=next_retry_at(db)
+    )
+
+@app.post("/tickets/requeue/")
+def requeue_pending_tickets(request: TicketRequeueRequest, db: Session = Depends(get_db)):
+    """
+    Volver a encolar tickets pendientes o fallidos con una clase de prioridad
+    
+    Un reprocesado masivo debe usar `backfill` para no retrasar las subidas
+    de los usuarios.
+    """
+    if request.priority not in TICKET_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Prioridad no válida. Usa: {', '.join(TICKET_PRIORITIES)}")
+    if request.status and request.status not in REQUEUEABLE_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Solo se pueden reencolar tickets en estado: {', '.join(REQUEUEABLE_STATUSES)}")
+    if not request.ticket_ids and not request.status:
+        raise HTTPException(status_code=400, detail="Indica ticket_ids o status")
+    
+    tickets = requeue_tickets(
+        db,
+        priority=request.priority,
+        ticket_ids=request.ticket_ids,
+        status=request.status,
+        limit=request.limit
+    )
+    
+    return {
+        "message": f"{len(tickets)} tickets reencolados",
+        "priority": request.priority,
+        "ticket_ids": [str(ticket.id) for ticket in tickets]
+    }
+
+@app.post("/tickets/{ticket_id}/release/")
+def release_claimed_ticket(ticket_id: uuid.UUID, request: TicketReleaseRequest, db: Session = Depends(get_db)):
+    """
+    Devolver a pendiente un ticket reclamado que el worker no ha podido procesar
+    
+    Con `error` se cuenta el intento y se programa el reintento con backoff
+    (o se pasa a dead-letter); con `retry_after` solo se aplaza.
+    """
+    ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
+    if not ticket:
+        raise HTTPException(status_code=404, detail="Ticket no encontrado")
+    
+    if not release_ticket(db, ticket, request.worker_id, error=request.error, retry_after=request.retry_after):
+        raise HTTPException(status_code=409, detail="El ticket no está reclamado por este worker")
     
-    return result
+    db.refresh(ticket)
+    return {
+        "message": "Ticket liberado",
+        "ticket_id": str(ticket.id),
+        "status": ticket.status,
+        "attempt_count": ticket.attempt_count,
+        "next_attempt_at": ticket.next_attempt_at
+    }
+
+@app.get("/admin/dead-letter/", response_model=DeadLetterResponse)
+def get_dead_letter_tickets(limit: int = 100, offset: int = 0, db: Session = Depends(get_db)):
+    """
+    Tickets que han agotado los reintentos, con su último error
+    
+    Se devuelven los más recientes primero (por fecha de actualización).
+    """
+    limit = max(1, min(limit, 500))
+    query = db.query(Ticket).filter(Ticket.status == DEAD_LETTER_STATUS)
+    tickets = query.order_by(Ticket.updated_at.desc()).offset(max(0, offset)).limit(limit).all()
+    return DeadLetterResponse(
+        total=query.count(),
+        tickets=[TicketResponse.from_orm(ticket) for ticket in tickets]
+    )
+
+@app.post("/admin/dead-letter/requeue")
+def requeue_dead_letter_tickets(request: DeadLetterRequeueRequest, db: Session = Depends(get_db)):
+    """
+    Volver a encolar tickets de la dead-letter (todos o los indicados)
+    
+    Los intentos se reinician y el procesador recibe un NOTIFY.
+    """
+    if request.priority not in TICKET_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Prioridad no válida. Usa: {', '.join(TICKET_PRIORITIES)}")
+    
+    tickets = requeue_tickets(
+        db,
+        priority=request.priority,
+        ticket_ids=request.ticket_ids,
+        status=DEAD_LETTER_STATUS,
+        limit=request.limit
+    )
+    
+    return {
+        "message": f"{len(tickets)} tickets reencolados desde dead-letter",
+        "priority": request.priority,
+        "ticket_ids": [str(ticket.id) for ticket in tickets]
+    }
+
+def is_trusted_processing_result(ticket: Ticket, payload: SignedProcessingResult) -> bool:
+    """
+    Comprobar que un resultado precalculado viene firmado por la IA y
+    corresponde a la imagen de este ticket
+    """
+    result = payload.processing_result
+    if not verify_result_signature(result, payload.signature or result.get(SIGNATURE_FIELD)):
+        print(f"   ⚠️ Firma del resultado inválida para ticket {ticket.id}")
+        return False
+    
+    try:
+        if result.get('image_hash') != compute_file_hash(ticket.file_path):
+            print(f"   ⚠️ El resultado firmado no corresponde a la imagen del ticket {ticket.id}")
+            return False
+    except Exception as e:
+        print(f"   ⚠️ No se pudo verificar la imagen del ticket {ticket.id}: {str(e)}")
+        return False
+    
+    return True
 
 @app.post("/tickets/{ticket_id}/process/")
 def process_ticket(
     ticket_id: uuid.UUID,
+    payload: Optional[SignedProcessingResult] = None,
     db: Session = Depends(get_db)
 ):
-    """Procesar un ticket específico con IA"""
+    """
+    Procesar un ticket específico con IA
+    
+    Si se envía un resultado firmado por el AI Ticket Processor para la imagen
+    de este ticket, se usa directamente y no se vuelve a llamar a Gemini.
+    """
     try:
         # Obtener ticket
         ticket = db.query(Ticket).filter(Ticket.id == ticket_id).first()
         if not ticket:
             raise HTTPException(status_code=404, detail="Ticket no encontrado")
         
-        if ticket.status != "pending":
+        if ticket.status not in ("pending", "processing"):
             raise HTTPException(status_code=400, detail="Ticket ya procesado")
         
+        # Un worker solo puede cerrar los tickets que tiene reclamados, y sin
+        # resultado firmado no se procesa un ticket que otro worker tiene en curso
+        if is_lease_held_by_other(ticket, payload.worker_id if payload is not None else None):
+            raise HTTPException(status_code=409, detail="Ticket reclamado por otro worker")
+        
         # Si el ticket ya tiene processing_result, significa que ya fue procesado por IA
         # y posiblemente marcado como duplicado
         if ticket.processing_result and ticket.status == "duplicate":
@@ -700,13 +923,42 @@ def process_ticket(
         # Si el ticket ya tiene processing_result, usarlo en lugar de procesar de nuevo
         if ticket.processing_result:
             result = ticket.processing_result
+        elif payload is not None and is_trusted_processing_result(ticket, payload):
+            result = {key: value for key, value in payload.processing_result.items() if key != SIGNATURE_FIELD}
+            print(f"   ♻️ Usando resultado firmado de la IA para ticket {ticket.id}")
         else:
             # Procesar con IA via HTTP
-            market_service = get_market_store_service(db)
-            result = process_ticket_with_ai(ticket.file_path, market_service)
+            try:
+                result = process_ticket_with_ai(ticket.file_path, ticket.user_id, ticket.id)
+            except AIProcessorUnavailable as e:
+                # No marcar como fallido: el ticket se aplaza sin gastar un intento
+                schedule_retry(ticket, str(e), delay=e.retry_after, count_attempt=False)
+                db.commit()
+                raise HTTPException(
+                    status_code=503,
+                    detail="AI processor temporalmente no disponible, el ticket sigue pendiente",
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+        
+        # Error de procesamiento: reintentar con backoff en lugar de dejarlo fallido
+        if is_retryable_result(result):
+            status = schedule_retry(ticket, result.get('error') or result.get('status_message'))
+            db.commit()
+            db.refresh(ticket)
+            if status == DEAD_LETTER_STATUS:
+                print(f"   ☠️ Ticket {ticket.id} a dead-letter tras {ticket.attempt_count} intentos")
+                update_gamification(ticket, result)
+            else:
+                print(f"   🔁 Reintento {ticket.attempt_count} del ticket {ticket.id} programado para {ticket.next_attempt_at}")
+            return {
+                "message": "Ticket en dead-letter" if status == DEAD_LETTER_STATUS else "Reintento programado",
+                "retry_scheduled": status != DEAD_LETTER_STATUS,
+                "ticket": TicketResponse.from_orm(ticket),
+                "processing_result": result
+            }
         
-        # Verificar si es un ticket duplicado
-        if result.get('procesado_correctamente', False):
+        # Verificar si es un ticket duplicado (salvo que la IA ya lo haya detectado por imagen)
+        if result.get('procesado_correctamente', False) and not result.get('duplicate_detected', False):
             is_duplicate = check_duplicate_ticket(result, ticket.user_id, db)
             if is_duplicate:
                 # Marcar como duplicado
@@ -719,6 +971,7 @@ def process_ticket(
         ticket.status = result.get('ticket_status', 'failed')
         ticket.processing_result = result
         ticket.updated_at = datetime.now()
+        clear_lease(ticket)
         
         db.commit()
         db.refresh(ticket)
@@ -737,76 +990,118 @@ def process_ticket(
             "processing_result": result
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error procesando ticket: {str(e)}")
 
 @app.post("/tickets/process-pending/")
 def process_all_pending_tickets(db: Session = Depends(get_db)):
-    """Procesar todos los tickets pendientes"""
+    """
+    Procesar todos los tickets pendientes
+    
+    Los tickets se reclaman por lotes de PROCESS_PENDING_BATCH_SIZE con un
+    lease fijo de PROCESS_PENDING_LEASE_SECONDS que se renueva antes de cada
+    ticket; al terminar cada lote se guardan sus resultados y se reclama el
+    siguiente. Se procesan como mucho los tickets pendientes al empezar.
+    """
     try:
-        # Obtener tickets pendientes
-        pending_tickets = db.query(Ticket).filter(Ticket.status == "pending").all()
+        pending_count = db.query(Ticket).filter(Ticket.status == "pending").count()
         
-        if not pending_tickets:
+        if not pending_count:
             return {"message": "No hay tickets pendientes de procesamiento"}
         
         if not AI_AVAILABLE:
             return {
                 "message": "AI system no disponible",
-                "total_tickets": len(pending_tickets),
+                "total_tickets": pending_count,
                 "processed_count": 0,
-                "failed_count": len(pending_tickets)
+                "failed_count": pending_count
             }
         
-        # Procesar cada ticket
-        market_service = get_market_store_service(db)
+        # Reclamar los tickets para no solaparse con el procesador automático
+        worker_id = f"ticket-service-{os.getpid()}"
+        total_tickets = 0
         processed_count = 0
         failed_count = 0
-        
-        for ticket in pending_tickets:
-            try:
-                result = process_ticket_with_ai(ticket.file_path, market_service)
-                
-                # Verificar si es un ticket duplicado
-                if result.get('procesado_correctamente', False):
-                    is_duplicate = check_duplicate_ticket(result, ticket.user_id, db)
-                    if is_duplicate:
-                        # Marcar como duplicado
-                        result['ticket_status'] = 'duplicate'
-                        result['status_message'] = 'Ticket duplicado detectado'
-                        result['duplicate_detected'] = True
-                        print(f"   ⚠️ Ticket duplicado detectado para usuario {ticket.user_id}")
-                
-                # Actualizar ticket
-                ticket.status = result.get('ticket_status', 'failed')
-                ticket.processing_result = result
-                ticket.updated_at = datetime.now()
+        deferred_count = 0
+        
+        while total_tickets < pending_count and not deferred_count:
+            pending_tickets = claim_tickets(
+                db,
+                worker_id=worker_id,
+                batch_size=min(PROCESS_PENDING_BATCH_SIZE, pending_count - total_tickets),
+                lease_seconds=PROCESS_PENDING_LEASE_SECONDS
+            )
+            if not pending_tickets:
+                break
+            total_tickets += len(pending_tickets)
+            
+            for position, ticket in enumerate(pending_tickets):
+                if deferred_count:
+                    # La IA no está disponible: devolver el resto del lote a pendiente
+                    ticket.status = "pending"
+                    clear_lease(ticket)
+                    deferred_count += 1
+                    continue
                 
-                if result.get('ticket_status') in ['done_approved', 'done_rejected'] and not result.get('duplicate_detected', False):
-                    processed_count += 1
-                    update_purchase_history(ticket, result) # Actualizar historial para tickets aprobados/rechazados
-                elif result.get('ticket_status') == 'duplicate':
-                    processed_count += 1  # Contar como procesado pero no actualizar historial
-                else:
-                    failed_count += 1
+                # Que el lease no caduque mientras se procesan los tickets anteriores del lote
+                if position:
+                    renew_leases(db, pending_tickets[position:], worker_id, PROCESS_PENDING_LEASE_SECONDS)
                 
-                # Actualizar gamificación para todos los tickets procesados (excepto duplicados)
-                if not result.get('duplicate_detected', False):
-                    update_gamification(ticket, result)
+                try:
+                    result = process_ticket_with_ai(ticket.file_path, ticket.user_id, ticket.id)
                     
-            except Exception as e:
-                ticket.status = "failed"
-                ticket.processing_result = {"error": str(e)}
-                ticket.updated_at = datetime.now()
-                failed_count += 1
-        
-        db.commit()
+                    if is_retryable_result(result):
+                        if schedule_retry(ticket, result.get('error') or result.get('status_message')) == DEAD_LETTER_STATUS:
+                            update_gamification(ticket, result)
+                        failed_count += 1
+                        continue
+                    
+                    # Verificar si es un ticket duplicado (salvo que la IA ya lo haya detectado por imagen)
+                    if result.get('procesado_correctamente', False) and not result.get('duplicate_detected', False):
+                        is_duplicate = check_duplicate_ticket(result, ticket.user_id, db)
+                        if is_duplicate:
+                            # Marcar como duplicado
+                            result['ticket_status'] = 'duplicate'
+                            result['status_message'] = 'Ticket duplicado detectado'
+                            result['duplicate_detected'] = True
+                            print(f"   ⚠️ Ticket duplicado detectado para usuario {ticket.user_id}")
+                    
+                    # Actualizar ticket
+                    ticket.status = result.get('ticket_status', 'failed')
+                    ticket.processing_result = result
+                    ticket.updated_at = datetime.now()
+                    clear_lease(ticket)
+                    
+                    if result.get('ticket_status') in ['done_approved', 'done_rejected'] and not result.get('duplicate_detected', False):
+                        processed_count += 1
+                        update_purchase_history(ticket, result) # Actualizar historial para tickets aprobados/rechazados
+                    elif result.get('ticket_status') == 'duplicate':
+                        processed_count += 1  # Contar como procesado pero no actualizar historial
+                    else:
+                        failed_count += 1
+                    
+                    # Actualizar gamificación para todos los tickets procesados (excepto duplicados)
+                    if not result.get('duplicate_detected', False):
+                        update_gamification(ticket, result)
+                        
+                except AIProcessorUnavailable as e:
+                    schedule_retry(ticket, str(e), delay=e.retry_after, count_attempt=False)
+                    deferred_count += 1
+                except Exception as e:
+                    schedule_retry(ticket, str(e))
+                    failed_count += 1
+            
+            # Guardar el lote y liberar sus leases antes de reclamar el siguiente
+            db.commit()
         
         return {
             "message": f"Procesamiento completado",
-            "total_tickets": len(pending_tickets),
+            "total_tickets": total_tickets,
             "processed_count": processed_count,
-            "failed_count": failed_count
+            "failed_count": failed_count,
+            "deferred_count": deferred_count
         }
         
     except Exception as e:
@@ -1,6 +1,6 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from typing import List, Optional
+from sqlalchemy import and_, func
+from typing import Dict, List, Optional
 from models import MarketStore
 from schemas import MarketStoreCreate, MarketStoreUpdate
 import uuid
@@ -81,4 +81,22 @@ class MarketStoreService:
     def get_market_store_names(self) -> List[str]:
         """Obtener lista de nombres de tiendas del mercado"""
         stores = self.db.query(MarketStore.name).filter(MarketStore.is_active == True).all()
-        return [store[0] for store in stores] 
\ No newline at end of file
+        return [store[0] for store in stores]
+
+    def get_market_stores_version(self) -> Dict:
+        """
+        Versión de la lista de tiendas para que los clientes sepan si recargarla
+
+        Cualquier alta, edición o baja lógica cambia el número de filas o el
+        updated_at más reciente.
+        """
+        total, active, last_update = self.db.query(
+            func.count(MarketStore.id),
+            func.count(MarketStore.id).filter(MarketStore.is_active == True),
+            func.max(MarketStore.updated_at)
+        ).one()
+        return {
+            "version": f"{total}-{active}-{last_update.timestamp() if last_update else 0}",
+            "active_stores": active,
+            "updated_at": last_update
+        }
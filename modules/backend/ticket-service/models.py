@@ -24,8 +24,14 @@ class Ticket(Base):
     file_path = Column(String(500), nullable=False)
     file_size = Column(Integer, nullable=False)
     mime_type = Column(String(100), nullable=False)
-    status = Column(String(50), default="pending")  # pending, done_rejected, done_approved, failed
+    status = Column(String(50), default="pending")  # pending, processing, done_rejected, done_approved, failed, dead_letter
     ticket_metadata = Column(JSONB, default={})  # Información adicional del ticket
     processing_result = Column(JSONB, default={})  # Resultado del procesamiento AI
+    lease_owner = Column(String(255), nullable=True)  # Worker que tiene reclamado el ticket
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)  # Fin del lease de procesamiento
+    queued_at = Column(DateTime(timezone=True), nullable=True)  # Entrada en la cola (envejecimiento de prioridad)
+    attempt_count = Column(Integer, nullable=False, default=0)  # Intentos de procesamiento fallidos
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)  # Próximo reintento programado
+    last_error = Column(Text, nullable=True)  # Último error de procesamiento
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now()) 
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Verificación de los resultados de extracción firmados por el AI Ticket Processor
+"""
+
+import hashlib
+import hmac
+import json
+from typing import Dict, Optional
+
+import structlog
+
+from config import settings
+
+logger = structlog.get_logger()
+
+SIGNATURE_FIELD = 'result_signature'
+
+
+def check_signing_key() -> bool:
+    """
+    Comprobar al arrancar que hay clave de firma configurada
+
+    Sin AI_RESULT_SIGNING_KEY se rechazan todos los resultados firmados y cada
+    ticket se vuelve a enviar a Gemini, así que se avisa con un error.
+    """
+    if settings.AI_RESULT_SIGNING_KEY:
+        return True
+    logger.error("AI_RESULT_SIGNING_KEY no configurada: se rechazarán todos los resultados firmados de la IA")
+    return False
+
+
+def canonical_result(result: Dict) -> bytes:
+    """Serialización estable del resultado (sin el campo de firma)"""
+    payload = {key: value for key, value in result.items() if key != SIGNATURE_FIELD}
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=True).encode('utf-8')
+
+
+def verify_result_signature(result: Dict, signature: Optional[str]) -> bool:
+    """
+    Comprobar que un resultado fue firmado por el AI Ticket Processor
+
+    Returns:
+        True si la firma HMAC-SHA256 es válida
+    """
+    key = settings.AI_RESULT_SIGNING_KEY
+    if not key:
+        logger.warning("Resultado firmado rechazado", reason="missing_key")
+        return False
+    if not signature:
+        logger.warning("Resultado firmado rechazado", reason="missing_signature")
+        return False
+    expected = hmac.new(key.encode('utf-8'), canonical_result(result), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        logger.warning("Resultado firmado rechazado", reason="invalid_signature", image_hash=result.get('image_hash'))
+        return False
+    return True
+
+
+def compute_file_hash(file_path: str) -> str:
+    """SHA-256 del fichero de la imagen, para ligar el resultado al ticket"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
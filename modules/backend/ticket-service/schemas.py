@@ -25,6 +25,11 @@ class MarketStoreResponse(MarketStoreBase):
     class Config:
         from_attributes = True
 
+class MarketStoreVersionResponse(BaseModel):
+    version: str = Field(..., description="Cambia con cualquier alta, baja o edición de tiendas")
+    active_stores: int
+    updated_at: Optional[datetime] = None
+
 # Esquemas para Ticket
 class TicketBase(BaseModel):
     original_filename: str = Field(..., description="Nombre original del archivo")
@@ -34,7 +39,7 @@ class TicketCreate(TicketBase):
     pass
 
 class TicketUpdate(BaseModel):
-    status: Optional[str] = Field(None, description="Estado del ticket (pending, done_rejected, done_approved, failed)")
+    status: Optional[str] = Field(None, description="Estado del ticket (pending, processing, done_rejected, done_approved, failed)")
     ticket_metadata: Optional[Dict[str, Any]] = Field(None, description="Metadatos del ticket")
     processing_result: Optional[Dict[str, Any]] = Field(None, description="Resultado del procesamiento")
 
@@ -49,6 +54,10 @@ class TicketResponse(TicketBase):
     processing_result: Dict[str, Any]
     created_at: datetime
     updated_at: datetime
+    queued_at: Optional[datetime] = None
+    attempt_count: int = 0
+    next_attempt_at: Optional[datetime] = None
+    last_error: Optional[str] = None
     
     @property
     def display_name(self) -> str:
@@ -117,4 +126,49 @@ class TicketProcessingResult(BaseModel):
     es_tienda_mercado: bool = Field(default=False, description="Si la tienda es del mercado")
     duplicate_detected: bool = Field(default=False, description="Si se detectó un ticket duplicado")
     status_message: Optional[str] = Field(None, description="Mensaje de estado del procesamiento")
-    error: Optional[str] = Field(None, description="Error si el procesamiento falló") 
\ No newline at end of file
+    error: Optional[str] = Field(None, description="Error si el procesamiento falló") 
+
+class SignedProcessingResult(BaseModel):
+    processing_result: Dict[str, Any] = Field(..., description="Resultado de la extracción ya calculado por la IA")
+    signature: Optional[str] = Field(None, description="Firma HMAC-SHA256 del resultado")
+    worker_id: Optional[str] = Field(None, description="Worker que tiene reclamado el ticket")
+
+# Esquemas para el reparto de tickets entre workers
+class TicketClaimRequest(BaseModel):
+    worker_id: str = Field(..., description="Identificador único del worker que reclama")
+    batch_size: int = Field(default=10, ge=1, le=100, description="Número máximo de tickets a reclamar")
+    lease_seconds: int = Field(default=300, ge=10, le=3600, description="Duración del lease")
+    ticket_ids: Optional[List[UUID]] = Field(None, description="Reclamar solo estos tickets")
+    priority_weights: Optional[Dict[str, float]] = Field(
+        None,
+        description="Peso por clase de prioridad; si se indica se reclama por peso x tiempo en cola en lugar de por antigüedad"
+    )
+    default_priority: str = Field(default="interactive", description="Clase de los tickets sin prioridad en los metadatos")
+    max_age_seconds: float = Field(default=3600, gt=0, description="Tope del tiempo en cola que cuenta para la puntuación")
+
+class TicketClaimResponse(BaseModel):
+    worker_id: str
+    lease_expires_at: Optional[datetime]
+    tickets: List[TicketResponse]
+    next_attempt_at: Optional[datetime] = Field(None, description="Próximo reintento programado, para despertar al worker")
+
+class TicketRequeueRequest(BaseModel):
+    ticket_ids: Optional[List[UUID]] = Field(None, description="Tickets a reencolar")
+    status: Optional[str] = Field(None, description="Reencolar los tickets en este estado (p. ej. failed)")
+    priority: str = Field(default="backfill", description="Clase de prioridad (interactive, retry, backfill)")
+    limit: int = Field(default=1000, ge=1, le=10000, description="Número máximo de tickets a reencolar")
+
+class TicketReleaseRequest(BaseModel):
+    worker_id: str = Field(..., description="Worker que tiene reclamado el ticket")
+    error: Optional[str] = Field(None, description="Error del intento; cuenta como fallo y programa un reintento con backoff")
+    retry_after: Optional[float] = Field(None, ge=0, description="Aplazar el ticket estos segundos sin contar un intento")
+
+# Esquemas de la cola de dead-letter
+class DeadLetterResponse(BaseModel):
+    total: int
+    tickets: List[TicketResponse]
+
+class DeadLetterRequeueRequest(BaseModel):
+    ticket_ids: Optional[List[UUID]] = Field(None, description="Tickets a reencolar (por defecto toda la dead-letter)")
+    priority: str = Field(default="retry", description="Clase de prioridad con la que vuelven a la cola")
+    limit: int = Field(default=1000, ge=1, le=10000, description="Número máximo de tickets a reencolar")
@@ -0,0 +1,335 @@
+"""
+Cola de tickets pendientes: notificación al AI Ticket Processor mediante
+Postgres NOTIFY, reparto de tickets entre workers con leases y prioridades,
+reintentos con backoff exponencial y cola de dead-letter
+"""
+
+import os
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence, Union
+
+from sqlalchemy import and_, case, func, or_, text
+from sqlalchemy.orm import Session
+
+from models import Ticket
+
+# Canal en el que escucha el procesador automático
+TICKET_PENDING_CHANNEL = "ticket_pending"
+
+# Clases de prioridad (ticket_metadata['priority'])
+TICKET_PRIORITIES = ("interactive", "retry", "backfill")
+DEFAULT_PRIORITY = "interactive"
+
+# Reintentos: tras TICKET_MAX_ATTEMPTS fallos el ticket pasa a dead-letter
+DEAD_LETTER_STATUS = "dead_letter"
+RETRY_PRIORITY = "retry"
+MAX_ATTEMPTS = int(os.getenv("TICKET_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = float(os.getenv("TICKET_RETRY_BASE_SECONDS", "30"))
+RETRY_MAX_SECONDS = float(os.getenv("TICKET_RETRY_MAX_SECONDS", "3600"))
+LEASE_EXPIRED_ERROR = "Lease caducado: el worker no terminó el procesamiento"
+
+# Estados que se pueden volver a encolar (los tickets completados no se reprocesan:
+# ya han actualizado el historial de compras y la gamificación)
+REQUEUEABLE_STATUSES = ("pending", "failed", DEAD_LETTER_STATUS)
+
+
+def notify_ticket_pending(db: Session, ticket_id: Union[str, uuid.UUID]) -> None:
+    """
+    Encolar un NOTIFY con el id del ticket en la transacción actual
+
+    Postgres solo entrega la notificación al hacer commit, así que el
+    procesador nunca recibe un ticket que todavía no es visible.
+    """
+    db.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": TICKET_PENDING_CHANNEL, "payload": str(ticket_id)}
+    )
+
+
+def priority_score(weights: Dict[str, float], default_priority: str = DEFAULT_PRIORITY, max_age_seconds: float = 3600):
+    """
+    Expresión SQL de la puntuación de un ticket: peso de su clase x segundos en cola
+
+    El envejecimiento evita la inanición: un ticket de backfill acaba
+    superando a los interactivos recientes cuando lleva el tiempo suficiente
+    en cola. El tope `max_age_seconds` limita cuánto puede esperar un ticket
+    interactivo detrás del backfill (max_age x peso backfill / peso interactivo).
+    """
+    priority = func.coalesce(Ticket.ticket_metadata['priority'].astext, default_priority)
+    weight = case(
+        *[(priority == name, float(value)) for name, value in weights.items()],
+        else_=float(weights.get(default_priority, 1.0))
+    )
+    waited = func.least(
+        func.extract('epoch', func.now() - func.coalesce(Ticket.queued_at, Ticket.created_at)),
+        max_age_seconds
+    ) + 1
+    return weight * waited
+
+
+def claim_tickets(
+    db: Session,
+    worker_id: str,
+    batch_size: int = 10,
+    lease_seconds: int = 300,
+    ticket_ids: Optional[Sequence[uuid.UUID]] = None,
+    priority_weights: Optional[Dict[str, float]] = None,
+    default_priority: str = DEFAULT_PRIORITY,
+    max_age_seconds: float = 3600
+) -> List[Ticket]:
+    """
+    Reclamar de forma atómica un lote de tickets para un worker
+
+    Pasa a `processing` los tickets pendientes cuyo reintento ya toca (y los
+    que llevan un lease caducado) más antiguos, o los de mayor puntuación si se indican pesos de
+    prioridad. `FOR UPDATE SKIP LOCKED` hace que dos workers reclamando a la
+    vez obtengan lotes disjuntos sin esperarse entre sí. Las fechas se
+    calculan con el reloj de la base de datos para que no influyan las
+    diferencias de hora entre réplicas.
+
+    Reclamar un lease caducado cuenta como intento fallido (el worker anterior
+    murió o se colgó con el ticket): si con él se agotan los MAX_ATTEMPTS el
+    ticket pasa a dead-letter en lugar de volver a procesarse, así un ticket
+    que tumba al worker no se reclama indefinidamente.
+    """
+    claimable = or_(
+        and_(
+            Ticket.status == "pending",
+            or_(Ticket.next_attempt_at.is_(None), Ticket.next_attempt_at <= func.now())
+        ),
+        and_(Ticket.status == "processing", Ticket.lease_expires_at < func.now())
+    )
+    query = db.query(Ticket.id).filter(claimable)
+    if ticket_ids:
+        query = query.filter(Ticket.id.in_(list(ticket_ids)))
+
+    if priority_weights:
+        query = query.order_by(priority_score(priority_weights, default_priority, max_age_seconds).desc(), Ticket.created_at)
+    else:
+        query = query.order_by(Ticket.created_at)
+
+    rows = (
+        query.add_columns(Ticket.status, Ticket.attempt_count)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    exhausted_ids = [
+        row.id for row in rows
+        if row.status == "processing" and (row.attempt_count or 0) + 1 >= MAX_ATTEMPTS
+    ]
+    claimed_ids = [row.id for row in rows if row.id not in exhausted_ids]
+
+    if exhausted_ids:
+        db.query(Ticket).filter(Ticket.id.in_(exhausted_ids)).update(
+            {
+                Ticket.status: DEAD_LETTER_STATUS,
+                Ticket.attempt_count: func.coalesce(Ticket.attempt_count, 0) + 1,
+                Ticket.last_error: LEASE_EXPIRED_ERROR,
+                Ticket.next_attempt_at: None,
+                Ticket.lease_owner: None,
+                Ticket.lease_expires_at: None
+            },
+            synchronize_session=False
+        )
+    if not claimed_ids:
+        db.commit()
+        return []
+
+    # Las expresiones del UPDATE ven la fila anterior: solo los leases caducados gastan intento
+    expired = Ticket.status == "processing"
+    db.query(Ticket).filter(Ticket.id.in_(claimed_ids)).update(
+        {
+            Ticket.status: "processing",
+            Ticket.attempt_count: func.coalesce(Ticket.attempt_count, 0) + case((expired, 1), else_=0),
+            Ticket.last_error: case((expired, LEASE_EXPIRED_ERROR), else_=Ticket.last_error),
+            Ticket.lease_owner: worker_id,
+            Ticket.lease_expires_at: func.now() + timedelta(seconds=lease_seconds)
+        },
+        synchronize_session=False
+    )
+    db.commit()
+
+    return db.query(Ticket).filter(Ticket.id.in_(claimed_ids)).order_by(Ticket.created_at).all()
+
+
+def renew_leases(db: Session, tickets: Sequence[Ticket], worker_id: str, lease_seconds: int = 300) -> int:
+    """
+    Prolongar el lease de los tickets que `worker_id` sigue teniendo reclamados
+
+    Returns:
+        Número de tickets renovados
+    """
+    ticket_ids = [ticket.id for ticket in tickets]
+    if not ticket_ids:
+        return 0
+
+    renewed = db.query(Ticket).filter(
+        Ticket.id.in_(ticket_ids),
+        Ticket.status == "processing",
+        Ticket.lease_owner == worker_id
+    ).update(
+        {Ticket.lease_expires_at: func.now() + timedelta(seconds=lease_seconds)},
+        synchronize_session=False
+    )
+    db.commit()
+    return renewed
+
+
+def next_retry_at(db: Session) -> Optional[datetime]:
+    """
+    Próximo reintento programado (o None si no hay ninguno)
+
+    Con el índice (status, next_attempt_at) es una sola lectura del índice:
+    el procesador lo usa para despertarse justo a tiempo en lugar de barrer
+    la tabla periódicamente.
+    """
+    return db.query(func.min(Ticket.next_attempt_at)).filter(
+        Ticket.status == "pending",
+        Ticket.next_attempt_at > func.now()
+    ).scalar()
+
+
+def retry_delay(attempt: int) -> float:
+    """
+    Espera antes del intento `attempt` + 1: backoff exponencial con jitter
+
+    El jitter (entre la mitad y el total del backoff) evita que los tickets
+    que fallaron juntos durante una caída se reintenten todos a la vez.
+    """
+    backoff = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** max(0, attempt - 1)))
+    return random.uniform(backoff / 2, backoff)
+
+
+def is_retryable_result(result: Dict) -> bool:
+    """Un resultado `failed` de la IA es un error del procesamiento, no del ticket"""
+    return result.get("ticket_status", "failed") == "failed" and not result.get("procesado_correctamente", False)
+
+
+def schedule_retry(
+    ticket: Ticket,
+    error: str,
+    delay: Optional[float] = None,
+    count_attempt: bool = True
+) -> str:
+    """
+    Programar el siguiente intento de un ticket que no se ha podido procesar
+
+    El ticket vuelve a `pending` con `next_attempt_at` en el futuro y la
+    prioridad `retry`; al agotar MAX_ATTEMPTS pasa a dead-letter. Un error de
+    disponibilidad de la IA (`count_attempt=False`) solo aplaza el ticket sin
+    gastar intentos. No hace commit.
+
+    Returns:
+        Nuevo estado del ticket (`pending` o `dead_letter`)
+    """
+    if count_attempt:
+        ticket.attempt_count = (ticket.attempt_count or 0) + 1
+    ticket.last_error = (error or "Error desconocido")[:2000]
+    ticket.processing_result = {}
+    clear_lease(ticket)
+
+    if ticket.attempt_count >= MAX_ATTEMPTS:
+        ticket.status = DEAD_LETTER_STATUS
+        ticket.next_attempt_at = None
+        return ticket.status
+
+    if delay is None:
+        delay = retry_delay(ticket.attempt_count)
+    ticket.status = "pending"
+    ticket.next_attempt_at = func.now() + timedelta(seconds=delay)
+    # El envejecimiento de la prioridad empieza cuando el ticket vuelve a ser reclamable
+    ticket.queued_at = ticket.next_attempt_at
+    ticket.ticket_metadata = {**(ticket.ticket_metadata or {}), "priority": RETRY_PRIORITY}
+    return ticket.status
+
+
+def requeue_tickets(
+    db: Session,
+    priority: str = "backfill",
+    ticket_ids: Optional[Sequence[uuid.UUID]] = None,
+    status: Optional[str] = None,
+    limit: int = 1000
+) -> List[Ticket]:
+    """
+    Volver a poner tickets en la cola con una clase de prioridad
+
+    Pensado para trabajos de reprocesado y para vaciar la dead-letter: los
+    tickets vuelven a `pending` con `queued_at` = ahora, así que envejecen
+    desde que se reencolan y no desde que se subieron, y con los intentos a
+    cero. Solo se reencolan tickets pendientes, fallidos o en dead-letter;
+    los reclamados por un worker no se tocan.
+    """
+    statuses = [status] if status else list(REQUEUEABLE_STATUSES)
+    query = db.query(Ticket).filter(Ticket.status.in_(statuses))
+    if ticket_ids:
+        query = query.filter(Ticket.id.in_(list(ticket_ids)))
+
+    tickets = query.order_by(Ticket.created_at).limit(limit).all()
+    for ticket in tickets:
+        ticket.status = "pending"
+        ticket.processing_result = {}
+        ticket.ticket_metadata = {**(ticket.ticket_metadata or {}), "priority": priority}
+        ticket.queued_at = func.now()
+        ticket.attempt_count = 0
+        ticket.next_attempt_at = None
+        ticket.last_error = None
+        clear_lease(ticket)
+
+    if tickets:
+        notify_ticket_pending(db, "requeue")
+    db.commit()
+    return tickets
+
+
+def release_ticket(
+    db: Session,
+    ticket: Ticket,
+    worker_id: str,
+    error: Optional[str] = None,
+    retry_after: Optional[float] = None
+) -> bool:
+    """
+    Devolver a `pending` un ticket reclamado por `worker_id`
+
+    Si el worker informa de un error se cuenta como intento fallido y se
+    programa el reintento con backoff; con `retry_after` (IA no disponible)
+    solo se aplaza. Sin ninguno de los dos el ticket queda libre al momento.
+
+    Returns:
+        True si el ticket se liberó, False si no lo tenía este worker
+    """
+    if ticket.status != "processing" or ticket.lease_owner != worker_id:
+        return False
+
+    if error:
+        schedule_retry(ticket, error)
+    elif retry_after:
+        schedule_retry(ticket, "AI processor no disponible", delay=retry_after, count_attempt=False)
+    else:
+        ticket.status = "pending"
+        clear_lease(ticket)
+    db.commit()
+    return True
+
+
+def clear_lease(ticket: Ticket) -> None:
+    """Quitar el lease de un ticket (al terminar o liberar su procesamiento)"""
+    ticket.lease_owner = None
+    ticket.lease_expires_at = None
+
+
+def is_lease_held_by_other(ticket: Ticket, worker_id: Optional[str]) -> bool:
+    """
+    Comprobar si el ticket está reclamado, con el lease en vigor, por un
+    worker distinto de `worker_id` (sin `worker_id`, por cualquier worker)
+    """
+    return bool(
+        ticket.status == "processing"
+        and ticket.lease_owner
+        and ticket.lease_owner != worker_id
+        and ticket.lease_expires_at
+        and ticket.lease_expires_at > datetime.now(timezone.utc)
+    )
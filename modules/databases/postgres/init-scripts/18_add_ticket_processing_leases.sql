@@ -0,0 +1,11 @@
+-- Script de inicialización: Leases de procesamiento de tickets
+-- Permite que varias réplicas del AI Ticket Processor reclamen tickets sin solaparse
+
+ALTER TABLE ticket_files ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(255);
+ALTER TABLE ticket_files ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE;
+
+-- Índice para la búsqueda de tickets reclamables (pendientes o con lease caducado)
+CREATE INDEX IF NOT EXISTS idx_ticket_files_status_lease ON ticket_files(status, lease_expires_at);
+
+COMMENT ON COLUMN ticket_files.lease_owner IS 'Worker que tiene reclamado el ticket mientras está en estado processing';
+COMMENT ON COLUMN ticket_files.lease_expires_at IS 'Fin del lease; pasado este momento otro worker puede reclamar el ticket';
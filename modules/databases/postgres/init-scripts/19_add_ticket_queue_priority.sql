@@ -0,0 +1,14 @@
+-- Script de inicialización: Prioridad y envejecimiento en la cola de tickets
+-- La clase de prioridad va en ticket_metadata->>'priority' (interactive, retry, backfill)
+-- y queued_at marca cuándo entró el ticket en la cola (para el envejecimiento)
+
+ALTER TABLE ticket_files ADD COLUMN IF NOT EXISTS queued_at TIMESTAMP WITH TIME ZONE;
+
+UPDATE ticket_files SET queued_at = created_at WHERE queued_at IS NULL AND status = 'pending';
+
+-- Índice parcial: la planificación solo recorre los tickets reclamables
+CREATE INDEX IF NOT EXISTS idx_ticket_files_claimable_queued_at
+    ON ticket_files(queued_at)
+    WHERE status IN ('pending', 'processing');
+
+COMMENT ON COLUMN ticket_files.queued_at IS 'Momento en que el ticket entró (o volvió) a la cola de procesamiento';
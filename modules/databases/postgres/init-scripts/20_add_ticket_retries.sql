@@ -0,0 +1,14 @@
+-- Script de inicialización: Reintentos con backoff y cola de dead-letter
+-- Un ticket que falla vuelve a 'pending' con next_attempt_at en el futuro;
+-- tras TICKET_MAX_ATTEMPTS fallos pasa al estado 'dead_letter'
+
+ALTER TABLE ticket_files ADD COLUMN IF NOT EXISTS attempt_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE ticket_files ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE ticket_files ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+-- Índice para reclamar los reintentos que ya tocan y calcular el próximo sin recorrer la tabla
+CREATE INDEX IF NOT EXISTS idx_ticket_files_status_next_attempt ON ticket_files(status, next_attempt_at);
+
+COMMENT ON COLUMN ticket_files.attempt_count IS 'Intentos de procesamiento fallidos (se reinicia al reencolar)';
+COMMENT ON COLUMN ticket_files.next_attempt_at IS 'Momento a partir del cual el ticket pendiente se puede volver a reclamar';
+COMMENT ON COLUMN ticket_files.last_error IS 'Último error de procesamiento del ticket';
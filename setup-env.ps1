@@ -13,6 +13,7 @@ GEMINI_API_KEY=tu_api_key_de_google_gemini_aqui
 # ========================================
 SECRET_KEY=genera_una_clave_secreta_segura_aqui
 ACCESS_TOKEN_EXPIRE_MINUTES=30
+AI_RESULT_SIGNING_KEY=genera_una_clave_secreta_segura_aqui
 
 # ========================================
 # DATABASE CREDENTIALS